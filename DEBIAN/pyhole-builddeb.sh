@@ -25,10 +25,10 @@ mkdir -p "$tmpdir/usr/share/pyhole"
 touch "$tmpdir/usr/share/pyhole/.keep"
 cp -R "$thisdir/../files/"* "$tmpdir/usr/share/pyhole"
 
-# /usr/lib/python3.4/pyhole
-mkdir -p "$tmpdir/usr/lib/python3.4/pyhole"
-touch "$tmpdir/usr/lib/python3.4/pyhole/.keep"
-cp -R "$thisdir/../lib/pyhole/"* "$tmpdir/usr/lib/python3.4/pyhole"
+# /usr/lib/python3/dist-packages/pyhole
+mkdir -p "$tmpdir/usr/lib/python3/dist-packages/pyhole"
+touch "$tmpdir/usr/lib/python3/dist-packages/pyhole/.keep"
+cp -R "$thisdir/../lib/pyhole/"* "$tmpdir/usr/lib/python3/dist-packages/pyhole"
 
 # /var/lib/pyhole
 mkdir -p "$tmpdir/var/lib/pyhole"
@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+
+# pyhole - a clone of the Pi-hole DNS adblocker, written in Python.
+# pyhole  (c) 2016 by ryt51V
+# Pi-Hole (c) 2015, 2016 by Jacob Salmela
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# Measure the pyhole-dns resolver: queries per second and latency.
+#
+# Usage: python3 bench/dns.py [seconds] [concurrency] [blocked percentage] [domains] [upstream ms] [cache MB] [race] [workers] [clients]
+#
+# Builds gravity.domains from a synthetic source, starts a stub upstream
+# server that answers every query after upstream ms, and a resolver
+# forwarding to it (each in its own process), then sends the resolver a mix
+# of blocked and forwarded queries over UDP, keeping concurrency queries in
+# flight.  The forwarded queries are for 10000 different names, so with a
+# cache (of cache MB, or none for 0) most are answered from it.
+#
+# upstream ms may be a comma separated list, for several upstream servers,
+# with "-" for one that never answers, and race is how many of them each
+# query is sent to at once, e.g. "5,40,-" 0 1 to see how the resolver copes
+# with a slow and a dead server without a cache.
+#
+# workers is how many resolver processes share the port, or a comma separated
+# list to measure each in turn, e.g. 1,2,4,8.  The queries come from clients
+# processes (by default one per two CPUs), each sending from several source
+# ports, so that the kernel spreads them over the workers.
+
+# For our paths and the command line.
+import os
+import sys
+# For temporary files
+import tempfile
+# For generating domains.
+import random
+# For timing.
+import time
+# For the stub server and the client.
+import asyncio
+import socket
+import struct
+# For running the stub server and resolver in their own processes.
+import multiprocessing
+import signal
+
+# Use the pyhole module from this repository rather than any installed one.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lib'))
+from pyhole import pyhole
+from pyhole import resolver
+from pyhole import dnscache
+
+seconds     = float(sys.argv[1]) if len(sys.argv) > 1 else 10
+concurrency = int(sys.argv[2])   if len(sys.argv) > 2 else 64
+blocked     = float(sys.argv[3]) if len(sys.argv) > 3 else 30
+domains     = int(sys.argv[4])   if len(sys.argv) > 4 else 100000
+delays      = [ None if delay == "-" else float(delay) for delay in (sys.argv[5] if len(sys.argv) > 5 else "0").split(",") ]
+cache_size  = int(sys.argv[6])   if len(sys.argv) > 6 else 16
+race        = int(sys.argv[7])   if len(sys.argv) > 7 else resolver.upstream_race
+workers     = [ int(count) for count in (sys.argv[8] if len(sys.argv) > 8 else "1").split(",") ]
+clients     = int(sys.argv[9])   if len(sys.argv) > 9 else max( 1, (os.cpu_count() or 1) // 2 )
+
+# How many source ports each client process sends from.
+client_sockets = 16
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+        s.bind( ("127.0.0.1", 0) )
+        return s.getsockname()[1]
+    #end with
+#end def free_port():
+
+def make_query(query_id, name):
+    return struct.pack("!HHHHHH", query_id, 0x0100, 1, 0, 0, 0) + b"".join( bytes([len(label)]) + label for label in name.split(b".") ) + b"\x00\x00\x01\x00\x01"
+#end def make_query(query_id, name):
+
+class StubUpstream(asyncio.DatagramProtocol):
+    """Answers every query with 192.0.2.1, after delay ms, or not at all for None."""
+    
+    def __init__(self, delay):
+        self.delay = delay
+    #end def __init__(self, delay):
+    
+    def connection_made(self, transport):
+        self.transport = transport
+    #end def connection_made(self, transport):
+    
+    def datagram_received(self, data, addr):
+        if self.delay is None:
+            return
+        #end if
+        flags = 0x8180 | (data[2] << 8 & 0x0100)
+        answer = b"\xc0\x0c" + struct.pack("!HHIH", 1, 1, 300, 4) + bytes([192, 0, 2, 1])
+        reply = data[:2] + struct.pack("!HHHHH", flags, 1, 1, 0, 0) + data[12:] + answer
+        if self.delay:
+            asyncio.get_event_loop().call_later(self.delay / 1000, self.transport.sendto, reply, addr)
+        else:
+            self.transport.sendto(reply, addr)
+        #end else
+    #end def datagram_received(self, data, addr):
+    
+#end class StubUpstream(asyncio.DatagramProtocol):
+
+def run_upstream(ports):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    for port, delay in zip(ports, delays):
+        loop.run_until_complete( loop.create_datagram_endpoint(lambda: StubUpstream(delay), local_addr = ("127.0.0.1", port)) )
+    #end for
+    loop.run_forever()
+#end def run_upstream(ports):
+
+def run_worker(sockets, upstream_ports, quiet):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    blocklist = pyhole.resolver_blocklist()
+    forwarder = resolver.Forwarder( [ "127.0.0.1#{0}".format(upstream_port) for upstream_port in upstream_ports ], race = race )
+    loop.run_until_complete( forwarder.start() )
+    cache = dnscache.ResponseCache(cache_size * 1048576) if cache_size else None
+    dns = resolver.Resolver(blocklist, forwarder, [ resolver.ipaddress.ip_address("192.168.1.2") ], cache = cache)
+    loop.run_until_complete( resolver.serve(dns, sockets) )
+    # Show how the cache did when we are stopped.
+    loop.add_signal_handler(signal.SIGTERM, loop.stop)
+    loop.run_forever()
+    if quiet:
+        return
+    #end if
+    if cache is not None:
+        stats = cache.stats()
+        print("Cache: {0} hits, {1} misses ({2:.1%} hit rate), {3} entries.".format(stats['hits'] + stats['stale_hits'], stats['misses'], stats['hit_rate'], stats['entries']) )
+    #end if
+    for upstream in forwarder.scoreboard():
+        print("Upstream {server}: {state}, {latency:.1f} ms average, {queries} queries, {replies} replies, {timeouts} timeouts.".format(
+                **dict( upstream, latency = upstream['latency'] * 1000 ) ) )
+    #end for
+#end def run_worker(sockets, upstream_ports, quiet):
+
+def run_resolver(port, upstream_ports, count):
+    sockets = [ resolver.listen_sockets(["127.0.0.1"], port, reuse_port = count > 1) for i in range(count) ]
+    if count == 1:
+        run_worker(sockets[0], upstream_ports, False)
+    else:
+        resolver.WorkerPool( sockets, lambda sockets: run_worker(sockets, upstream_ports, True) ).serve_forever( lambda: False )
+    #end else
+#end def run_resolver(port, upstream_ports, count):
+
+class Client(asyncio.DatagramProtocol):
+    """Sends queries, and times how long each takes to be answered."""
+    
+    def __init__(self):
+        self.waiting = {}
+    #end def __init__(self):
+    
+    def connection_made(self, transport):
+        self.transport = transport
+    #end def connection_made(self, transport):
+    
+    def datagram_received(self, data, addr):
+        future = self.waiting.pop(data[:2], None)
+        if future is not None and not future.done():
+            future.set_result(data)
+        #end if
+    #end def datagram_received(self, data, addr):
+    
+#end class Client(asyncio.DatagramProtocol):
+
+async def client_worker(client, names, deadline, latencies, next_id):
+    timeouts = 0
+    while time.perf_counter() < deadline:
+        query_id = next(next_id)
+        key = struct.pack("!H", query_id)
+        future = asyncio.Future()
+        client.waiting[key] = future
+        start = time.perf_counter()
+        client.transport.sendto( make_query(query_id, random.choice(names)) )
+        try:
+            await asyncio.wait_for(future, 2)
+        except asyncio.TimeoutError:
+            client.waiting.pop(key, None)
+            timeouts += 1
+            continue
+        #end except
+        latencies.append( time.perf_counter() - start )
+    #end while
+    return timeouts
+#end async def client_worker(client, names, deadline, latencies, next_id):
+
+def run_client(port, names, concurrency, pipe):
+    """Send queries for seconds, from several source ports, and send back the latencies, how many timed out, and how long it took."""
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    endpoints = [ loop.run_until_complete( loop.create_datagram_endpoint(Client, remote_addr = ("127.0.0.1", port)) )[1] for i in range(client_sockets) ]
+    latencies = []
+    next_id = ids()
+    deadline = time.perf_counter() + seconds
+    start = time.perf_counter()
+    timeouts = loop.run_until_complete( asyncio.gather( *[ client_worker(endpoints[i % client_sockets], names, deadline, latencies, next_id) for i in range(concurrency) ] ) )
+    pipe.send( (latencies, sum(timeouts), time.perf_counter() - start) )
+#end def run_client(port, names, concurrency, pipe):
+
+def ids():
+    while True:
+        for query_id in range(65536):
+            yield query_id
+        #end for
+    #end while True:
+#end def ids():
+
+with tempfile.TemporaryDirectory() as temp_dir:
+    # Keep everything pyhole writes in our temporary directory.
+    pyhole.var_dir = pyhole.unique_temp_dir = temp_dir
+    pyhole.whitelist_file = os.path.join(temp_dir, 'whitelist.txt')
+    pyhole.blacklist_file = os.path.join(temp_dir, 'blacklist.txt')
+    pyhole.gravity_domains = os.path.join(temp_dir, 'gravity.domains')
+    open(pyhole.whitelist_file, 'wt').close()
+    open(pyhole.blacklist_file, 'wt').close()
+    
+    random.seed(0)
+    listed = [ "ads{0}.tracker{1}.example.com".format(i, random.randrange(1000)).encode() for i in range(domains) ]
+    source = os.path.join(temp_dir, 'list.example.com.domains')
+    with open(source, 'wb') as f:
+        f.writelines( domain + b"\n" for domain in listed )
+    #end with
+    pyhole.gravity_domain_table([source], pyhole.gravity_domains)
+    
+    # A mix of blocked and forwarded names.
+    names = [ random.choice(listed) if random.random() * 100 < blocked else "www.site{0}.example.org".format(i).encode() for i in range(10000) ]
+    
+    upstream_ports = [ free_port() for delay in delays ]
+    upstream = multiprocessing.Process(target = run_upstream, args = (upstream_ports,), daemon = True)
+    upstream.start()
+    
+    for count in workers:
+        resolver_port = free_port()
+        process = multiprocessing.Process(target = run_resolver, args = (resolver_port, upstream_ports, count), daemon = True)
+        process.start()
+        time.sleep(1)
+        
+        pipes = []
+        client_processes = []
+        for i in range(clients):
+            receiver, sender = multiprocessing.Pipe(False)
+            pipes.append(receiver)
+            client_processes.append( multiprocessing.Process(target = run_client, args = (resolver_port, names, max(1, concurrency // clients), sender), daemon = True) )
+        #end for
+        for client_process in client_processes:
+            client_process.start()
+        #end for
+        latencies = []
+        timeouts = 0
+        elapsed = 0
+        for receiver in pipes:
+            client_latencies, client_timeouts, client_elapsed = receiver.recv()
+            latencies += client_latencies
+            timeouts += client_timeouts
+            elapsed = max(elapsed, client_elapsed)
+        #end for
+        for client_process in client_processes:
+            client_process.join()
+        #end for
+        
+        process.terminate()
+        process.join()
+        
+        latencies.sort()
+        percentile = lambda p: latencies[ min( len(latencies) - 1, int(len(latencies) * p / 100) ) ] * 1000
+        print()
+        print("{0} worker(s): {1} queries ({2:.0f}% blocked) in {3:.1f}s with {4} in flight: {5:.0f} queries/s, {6} timed out.".format(
+                count, len(latencies), blocked, elapsed, concurrency, len(latencies) / elapsed, timeouts ) )
+        print("Latency: p50 {0:.2f} ms, p99 {1:.2f} ms, max {2:.2f} ms.".format( percentile(50), percentile(99), latencies[-1] * 1000 ) )
+        sys.stdout.flush()
+    #end for
+    
+    upstream.terminate()
+    upstream.join()
+#end with
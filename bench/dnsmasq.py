@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+
+# pyhole - a clone of the Pi-hole DNS adblocker, written in Python.
+# pyhole  (c) 2016 by ryt51V
+# Pi-Hole (c) 2015, 2016 by Jacob Salmela
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+# Compare the "hosts" and "dnsmasq" gravity outputs.
+#
+# Usage: python3 bench/dnsmasq.py [domains] [dnsmasq binary]
+#
+# Generates a synthetic source of random domains, a third of them subdomains
+# of other blocked domains, and builds both gravity.hosts and gravity.conf
+# from it.  Prints how many entries each has, and, if dnsmasq is installed,
+# the resident memory of a dnsmasq loading each of them.
+
+# For running dnsmasq.
+import subprocess
+# For our paths and the command line.
+import os
+import sys
+# For temporary files
+import tempfile
+# For generating domains.
+import random
+# For waiting for dnsmasq.
+import socket
+import time
+# For finding dnsmasq.
+import shutil
+
+# Use the pyhole module from this repository rather than any installed one.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lib'))
+from pyhole import pyhole
+
+domains = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+dnsmasq = sys.argv[2] if len(sys.argv) > 2 else shutil.which('dnsmasq')
+
+# An A query for pyhole.isworking.ok.
+query = b"\x12\x34\x01\x00\x00\x01\x00\x00\x00\x00\x00\x00" + b"\x06pyhole\x09isworking\x02ok\x00" + b"\x00\x01\x00\x01"
+
+def dnsmasq_memory(options, port = 53535):
+    """Start dnsmasq with options, wait until it answers, and return its resident memory in KB."""
+    process = subprocess.Popen(
+        [ dnsmasq, "--keep-in-foreground", "--conf-file=/dev/null", "--no-resolv", "--no-hosts",
+          "--listen-address=127.0.0.1", "--bind-interfaces", "--port={0}".format(port) ] + options,
+        stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL
+    )
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+            s.settimeout(0.5)
+            for attempt in range(120):
+                s.sendto(query, ("127.0.0.1", port))
+                try:
+                    s.recv(512)
+                    break
+                except socket.timeout:
+                    pass
+                #end except
+            #end for
+        #end with
+        with open("/proc/{0}/status".format(process.pid), 'rt') as f:
+            for line in f:
+                if line.startswith("VmRSS:"): return int(line.split()[1])
+            #end for
+        #end with
+    finally:
+        process.terminate()
+        process.wait()
+    #end finally
+#end def dnsmasq_memory(options, port = 53535):
+
+with tempfile.TemporaryDirectory() as temp_dir:
+    # Keep everything pyhole writes in our temporary directory.
+    pyhole.var_dir = pyhole.unique_temp_dir = temp_dir
+    pyhole.whitelist_file = os.path.join(temp_dir, 'whitelist.txt')
+    pyhole.gravity_hosts  = os.path.join(temp_dir, 'gravity.hosts')
+    pyhole.gravity_conf   = os.path.join(temp_dir, 'gravity.conf')
+    pyhole.ipv4_addr = "192.168.0.2"
+    pyhole.ipv6_addr = "fd00::2"
+    open(pyhole.whitelist_file, 'wt').close()
+    
+    random.seed(0)
+    source = os.path.join(temp_dir, 'list.0.example.com.domains')
+    parents = []
+    with open(source, 'wt') as f:
+        for i in range(domains):
+            if parents and random.random() < 0.33:
+                domain = "ads{0}.{1}".format(i, random.choice(parents))
+            else:
+                domain = "ads{0}.tracker{1}.example{2}.com".format(i, random.randrange(1000), random.randrange(1000))
+                parents.append(domain)
+            #end else
+            f.write("0.0.0.0 {0}\n".format(domain))
+        #end for
+    #end with
+    
+    start = time.perf_counter()
+    pyhole.gravity_fused([source], pyhole.gravity_hosts, None, pyhole.ipv4_addr, pyhole.ipv6_addr)
+    hosts_time = time.perf_counter() - start
+    start = time.perf_counter()
+    pyhole.gravity_dnsmasq([source], pyhole.gravity_conf)
+    conf_time = time.perf_counter() - start
+    
+    with open(pyhole.gravity_hosts, 'rb') as f: hosts_entries = sum( 1 for line in f )
+    with open(pyhole.gravity_conf , 'rb') as f: conf_entries  = sum( 1 for line in f )
+    
+    print()
+    print("{0:>8} {1:>10} {2:>10} {3:>12}".format("output", "entries", "build", "dnsmasq RSS") )
+    outputs = (
+        ( "hosts"  , hosts_entries, hosts_time, [ "--addn-hosts=" + pyhole.gravity_hosts ] ),
+        ( "dnsmasq", conf_entries , conf_time , [ "--servers-file=" + pyhole.gravity_conf ] ),
+    )
+    for name, entries, build_time, options in outputs:
+        memory = "{0} KB".format( dnsmasq_memory(options) ) if dnsmasq else "no dnsmasq"
+        print("{0:>8} {1:>10} {2:>9.2f}s {3:>12}".format(name, entries, build_time, memory) )
+    #end for
+#end with
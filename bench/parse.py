@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+
+# pyhole - a clone of the Pi-hole DNS adblocker, written in Python.
+# pyhole  (c) 2016 by ryt51V
+# Pi-Hole (c) 2015, 2016 by Jacob Salmela
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+# Benchmark parsing gravity sources.
+#
+# Usage: python3 bench/parse.py [lines]
+#
+# Compares the old line by line parser with gravity_parse_source, on
+# synthetic hosts, domains only and adblock style sources.
+
+# For our paths and the command line.
+import os
+import sys
+# For generating sources.
+import random
+# For the synthetic source files.
+import tempfile
+# For timing.
+import time
+
+# Use the pyhole module from this repository rather than any installed one.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lib'))
+from pyhole import pyhole
+
+def line_by_line(source_filename, outfile):
+    """How gravity_advanced used to parse a source, returning how many domains it wrote."""
+    written = 0
+    with open(source_filename, 'r') as infile:
+        for line in infile:
+            line = line.partition('#')[0]
+            line = line.partition('/')[0]
+            line = line.strip()
+            if line:
+                split_line = line.split()
+                if len(split_line) >= 2:
+                    outfile.write(split_line[1])
+                else:
+                    outfile.write(split_line[0])
+                #end else
+                outfile.write("\n")
+                written += 1
+            #end if
+        #end for
+    #end with
+    return written
+#end def line_by_line(source_filename, outfile):
+
+def bulk(source_filename, outfile):
+    """How gravity_advanced parses a source now, returning how many domains it wrote."""
+    written = 0
+    for batch in pyhole.gravity_parse_source(source_filename):
+        pyhole.gravity_write_lines(outfile, [batch])
+        written += len(batch)
+    #end for
+    return written
+#end def bulk(source_filename, outfile):
+
+lines = int(sys.argv[1]) if len(sys.argv) > 1 else 500000
+
+random.seed(0)
+domains = [ "ads{0}.tracker{1}.example.com".format(i, random.randrange(1000)) for i in range(lines) ]
+header = "# Title: synthetic\n#\n127.0.0.1 localhost\n::1 localhost\n0.0.0.0 0.0.0.0\n\n"
+sources = [
+    ( "hosts"       , header + "".join( "0.0.0.0 {0}\n".format(d) for d in domains ) ),
+    ( "hosts+notes" , header + "".join( "0.0.0.0 {0} # ad\n".format(d) for d in domains ) ),
+    ( "domains only", "# A list of domains\n" + "".join( "{0}\n".format(d) for d in domains ) ),
+    ( "adblock"     , "[Adblock Plus 2.0]\n! Title: ads\n" + "".join( "||{0}^\n".format(d) for d in domains ) ),
+]
+
+print("{0:>14} {1:>10} {2:>14} {3:>14} {4:>10}".format("source", "lines", "line by line", "bulk", "bulk kept") )
+with tempfile.TemporaryDirectory() as temp_dir:
+    source_filename = os.path.join(temp_dir, "source")
+    for name, text in sources:
+        with open(source_filename, 'w') as source_file:
+            source_file.write(text)
+        #end with
+        
+        with open(os.devnull, 'w') as outfile:
+            start = time.perf_counter()
+            line_by_line(source_filename, outfile)
+            old_time = time.perf_counter() - start
+        #end with
+        
+        with open(os.devnull, 'wb') as outfile:
+            start = time.perf_counter()
+            kept = bulk(source_filename, outfile)
+            new_time = time.perf_counter() - start
+        #end with
+        
+        print("{0:>14} {1:>10} {2:>13.3f}s {3:>13.3f}s {4:>10}".format(name, lines, old_time, new_time, kept) )
+    #end for name, text in sources:
+#end with
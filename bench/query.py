@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+
+# pyhole - a clone of the Pi-hole DNS adblocker, written in Python.
+# pyhole  (c) 2016 by ryt51V
+# Pi-Hole (c) 2015, 2016 by Jacob Salmela
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# Time building gravity.domains, and looking domains up in it as pyhole-query does.
+#
+# Usage: python3 bench/query.py [domains] [lookups]
+#
+# Generates four synthetic sources of random domains, overlapping with each
+# other, builds gravity.domains from them and then looks up a mix of
+# listed domains, their subdomains and unlisted domains.
+
+# For our paths and the command line.
+import os
+import sys
+# For temporary files
+import tempfile
+# For generating domains.
+import random
+# For timing.
+import time
+
+# Use the pyhole module from this repository rather than any installed one.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lib'))
+from pyhole import pyhole
+
+domains = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+lookups = int(sys.argv[2]) if len(sys.argv) > 2 else 200000
+
+with tempfile.TemporaryDirectory() as temp_dir:
+    # Keep everything pyhole writes in our temporary directory.
+    pyhole.var_dir = pyhole.unique_temp_dir = temp_dir
+    pyhole.whitelist_file = os.path.join(temp_dir, 'whitelist.txt')
+    pyhole.blacklist_file = os.path.join(temp_dir, 'blacklist.txt')
+    pyhole.gravity_domains = os.path.join(temp_dir, 'gravity.domains')
+    open(pyhole.whitelist_file, 'wt').close()
+    open(pyhole.blacklist_file, 'wt').close()
+    
+    random.seed(0)
+    listed = [ "ads{0}.tracker{1}.example{2}.com".format(i, random.randrange(1000), random.randrange(1000)).encode() for i in range(domains) ]
+    sources = []
+    for number in range(4):
+        source = os.path.join(temp_dir, 'list.{0}.example.com.domains'.format(number))
+        with open(source, 'wb') as f:
+            for domain in listed:
+                if random.random() < 0.4: f.write(domain + b"\n")
+            #end for
+        #end with
+        sources.append(source)
+    #end for
+    
+    start = time.perf_counter()
+    pyhole.gravity_domain_table(sources, pyhole.gravity_domains)
+    build_time = time.perf_counter() - start
+    
+    queries = []
+    for i in range(lookups):
+        r = random.random()
+        if r < 0.2:
+            queries.append( random.choice(listed) )
+        elif r < 0.4:
+            queries.append( b"cdn." + random.choice(listed) )
+        else:
+            queries.append( "www.site{0}.example.org".format(i).encode() )
+        #end else
+    #end for
+    
+    table = pyhole.query_table()
+    whitelist, blacklist, allowed = pyhole.query_lists()
+    start = time.perf_counter()
+    found = 0
+    for domain in queries:
+        if pyhole.query_domain(domain, table, whitelist, blacklist, allowed)[1] is not None: found += 1
+    #end for
+    lookup_time = time.perf_counter() - start
+    table.close()
+    
+    print()
+    print("Built gravity.domains ({0} MB) in {1:.2f}s.".format( os.path.getsize(pyhole.gravity_domains) // 1048576, build_time ) )
+    print("{0} lookups ({1} listed) in {2:.2f}s: {3:.0f} lookups/s.".format(lookups, found, lookup_time, lookups / lookup_time) )
+#end with
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+
+# pyhole - a clone of the Pi-hole DNS adblocker, written in Python.
+# pyhole  (c) 2016 by ryt51V
+# Pi-Hole (c) 2015, 2016 by Jacob Salmela
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Benchmark gravity_unique against "sort -u".
+#
+# Usage: python3 bench/unique.py [lines] [memory MB]
+#
+# Generates a synthetic supernova file of random domains with duplicates,
+# then times gravity_unique and "LC_ALL=C sort -u" over it and checks that
+# their outputs are identical.
+
+# For running sort.
+import subprocess
+# For our paths and the command line.
+import os
+import sys
+# For temporary files
+import tempfile
+# For generating domains.
+import random
+# For timing.
+import time
+
+# Use the pyhole module from this repository rather than any installed one.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lib'))
+from pyhole import pyhole
+
+lines  = int(sys.argv[1]) if len(sys.argv) > 1 else 3000000
+memory = int(sys.argv[2]) if len(sys.argv) > 2 else pyhole.unique_memory
+
+with tempfile.TemporaryDirectory() as temp_dir:
+    source      = os.path.join(temp_dir, 'supernova')
+    python_out  = os.path.join(temp_dir, 'python')
+    sort_out    = os.path.join(temp_dir, 'sort')
+    
+    # Roughly a third of our lines will be duplicates.
+    random.seed(0)
+    with open(source, 'wt') as f:
+        for i in range(lines):
+            f.write("ads{0:x}.example.com\n".format(random.randrange(lines)) )
+        #end for
+    #end with
+    
+    start = time.perf_counter()
+    pyhole.gravity_unique(source, python_out, memory = memory, temp_dir = temp_dir)
+    python_time = time.perf_counter() - start
+    
+    env = dict(os.environ, LC_ALL = 'C')
+    start = time.perf_counter()
+    subprocess.check_call('sort -u "{0}" > "{1}"'.format(source, sort_out), shell = True, env = env)
+    sort_time = time.perf_counter() - start
+    
+    with open(python_out, 'rb') as a, open(sort_out, 'rb') as b:
+        identical = (a.read() == b.read())
+    #end with
+    
+    print("lines:          {0}".format(lines) )
+    print("memory:         {0} MB".format(memory) )
+    print("gravity_unique: {0:.2f}s".format(python_time) )
+    print("sort -u:        {0:.2f}s".format(sort_time) )
+    print("identical:      {0}".format(identical) )
+#end with
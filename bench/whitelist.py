@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+
+# pyhole - a clone of the Pi-hole DNS adblocker, written in Python.
+# pyhole  (c) 2016 by ryt51V
+# Pi-Hole (c) 2015, 2016 by Jacob Salmela
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Benchmark whitelist matching against gravity.hosts lines.
+#
+# Usage: python3 bench/whitelist.py [hosts lines]
+#
+# Compares the old nested loop (every line against every whitelist entry)
+# with domain_matcher, for growing whitelist sizes, with and without
+# wildcard entries.
+
+# For our paths and the command line.
+import os
+import sys
+# For generating domains.
+import random
+# For timing.
+import time
+
+# Use the pyhole module from this repository rather than any installed one.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lib'))
+from pyhole import pyhole
+
+def nested_loop(lines, whitelist):
+    """How gravity_hosts_add_whitelist used to match, returning how many lines matched."""
+    commented = 0
+    for line in lines:
+        split_line = line.split()
+        comment = False
+        for domain in whitelist:
+            if split_line[1].strip() == domain:
+                comment = True
+            #end if
+        #end for
+        if comment: commented += 1
+    #end for
+    return commented
+#end def nested_loop(lines, whitelist):
+
+def matcher(lines, whitelist):
+    """How gravity_hosts_add_whitelist matches now, returning how many lines matched."""
+    whitelist = pyhole.domain_matcher(whitelist)
+    commented = 0
+    for line in lines:
+        split_line = line.split()
+        if split_line[1] in whitelist: commented += 1
+    #end for
+    return commented
+#end def matcher(lines, whitelist):
+
+hosts_lines = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+
+random.seed(0)
+domains = [ "ads{0}.tracker{1}.example.com".format(i, i % 1000) for i in range(hosts_lines) ]
+lines = [ "192.168.0.2 {0}\n".format(d) for d in domains ]
+
+print("{0:>10} {1:>10} {2:>14} {3:>14} {4:>18}".format("lines", "whitelist", "nested loop", "matcher", "matcher+wildcards") )
+for size in (1, 10, 100, 500):
+    whitelist = random.sample(domains, size)
+    # Half exact entries, half wildcards covering whole trackers.
+    wildcards = whitelist[:size // 2] + [ "*.tracker{0}.example.com".format(i) for i in range(size - size // 2) ]
+    
+    start = time.perf_counter()
+    old = nested_loop(lines, whitelist)
+    old_time = time.perf_counter() - start
+    
+    start = time.perf_counter()
+    new = matcher(lines, whitelist)
+    new_time = time.perf_counter() - start
+    
+    start = time.perf_counter()
+    matcher(lines, wildcards)
+    wildcard_time = time.perf_counter() - start
+    
+    assert old == new
+    print("{0:>10} {1:>10} {2:>13.3f}s {3:>13.3f}s {4:>17.3f}s".format(hosts_lines, size, old_time, new_time, wildcard_time) )
+#end for size in (1, 10, 100, 500):
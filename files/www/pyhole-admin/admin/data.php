@@ -12,12 +12,27 @@
     // Include the variable $protocolfactor
     include('/etc/pyhole/pyhole-admin.php');
 
+    /* pyhole-querylog keeps running totals of the log in this file, so that we
+       don't have to read the whole log on every page load.  It is rewritten
+       every minute by cron; if it is any older than $summarymaxage seconds then
+       pyhole-querylog isn't running, and we read the log ourselves instead.
+    */
+    $summaryfile = "/var/lib/pyhole/querylog.json";
+    $summarymaxage = 180;
+    $summary = null;
+    $summaryread = false;
+
     /*******   Public Members ********/
     function getSummaryData() {
         global $protocolfactor;
+        $summary = readInSummary();
+        if ($summary !== null) {
+            return $summary['summary'];
+        }
         $domains = readInBlockList();
         $log = readInLog();
-        $domains_being_blocked = count($domains) / ($protocolfactor);
+        // gravity.conf has one line per domain, rather than one per address.
+        $domains_being_blocked = count($domains) / (useGravityConf() ? 1 : $protocolfactor);
 
         $dns_queries_today = count(getDnsQueries($log));
 
@@ -34,6 +49,10 @@
     }
 
     function getOverTimeData() {
+        $summary = readInSummary();
+        if ($summary !== null) {
+            return $summary['over_time'];
+        }
         $domains = readInBlockList();
         $log = readInLog();
         $dns_queries = getDnsQueries($log);
@@ -49,6 +68,10 @@
     }
 
     function getTopItems() {
+        $summary = readInSummary();
+        if ($summary !== null) {
+            return $summary['top_items'];
+        }
         $domains = readInBlockList();
         $log = readInLog();
         $dns_queries = getDnsQueries($log);
@@ -64,6 +87,21 @@
     }
 
     function getRecentItems($qty) {
+        $summary = readInSummary();
+        if ($summary !== null) {
+            $recent = array();
+            // Newest first.
+            foreach (array_slice($summary['recent_queries'], 0, $qty) as $query) {
+                array_push($recent, array(
+                    'time' => date('h:i:s a', $query[0]),
+                    'domain' => $query[1],
+                    'ip' => $query[2],
+                ));
+            }
+            return Array(
+                'recent_queries' => $recent
+            );
+        }
         $log = readInLog();
         $dns_queries = getDnsQueries($log);
         return Array(
@@ -72,6 +110,10 @@
     }
 
     function getIpvType() {
+        $summary = readInSummary();
+        if ($summary !== null) {
+            return $summary['query_types'];
+        }
         $log = readInLog();
         $dns_queries = getDnsQueries($log);
         $queryTypes = array();
@@ -91,6 +133,10 @@
     }
 
     function getForwardDestinations() {
+        $summary = readInSummary();
+        if ($summary !== null) {
+            return $summary['forward_destinations'];
+        }
         $log = readInLog();
         $forwards = getForwards($log);
         $destinations = array();
@@ -110,6 +156,10 @@
     }
 
     function getQuerySources() {
+        $summary = readInSummary();
+        if ($summary !== null) {
+            return $summary['query_sources'];
+        }
         $log = readInLog();
         $dns_queries = getDnsQueries($log);
         $sources = array();
@@ -147,10 +197,35 @@
     }
 
     /******** Private Members ********/
+    function readInSummary() {
+        global $summary, $summaryread, $summaryfile, $summarymaxage;
+        if ($summaryread) {
+            return $summary;
+        }
+        $summaryread = true;
+        $mtime = @filemtime($summaryfile);
+        if ($mtime !== false && time() - $mtime <= $summarymaxage) {
+            $decoded = json_decode(@file_get_contents($summaryfile), true);
+            if (is_array($decoded)) {
+                $summary = $decoded;
+            }
+        }
+        return $summary;
+    }
     function readInBlockList() {
         global $domains;
-        return count($domains) > 1 ? $domains :
-            file("/var/lib/pyhole/gravity.hosts");
+        if (count($domains) > 1) {
+            return $domains;
+        }
+        if (useGravityConf()) {
+            // Leave out the whitelist exceptions, "server=/example.com/#".
+            return array_filter(file("/var/lib/pyhole/gravity.conf"), "findBlocks");
+        }
+        return file("/var/lib/pyhole/gravity.hosts");
+    }
+    function useGravityConf() {
+        // gravity.conf is only non-empty with the "dnsmasq" gravity output.
+        return @filesize("/var/lib/pyhole/gravity.conf") > 0;
     }
     function readInLog() {
         global $log;
@@ -239,7 +314,12 @@
     }
 
     function findAds($var) {
-        return strpos($var, "gravity.hosts") !== false;
+        // Domains blocked by gravity.conf are logged as "config example.com is NXDOMAIN".
+        return strpos($var, "gravity.hosts") !== false || strpos($var, ": config ") !== false;
+    }
+
+    function findBlocks($var) {
+        return substr(rtrim($var), -2) !== "/#";
     }
 
     function findForwards($var) {
@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+
+# pyhole - a clone of the Pi-hole DNS adblocker, written in Python.
+# pyhole  (c) 2016 by ryt51V
+# Pi-Hole (c) 2015, 2016 by Jacob Salmela
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# A cache of the replies pyhole-dns gets from upstream DNS servers, so that
+# it only has to forward each question once in a while.
+#
+# Replies are kept for as long as their TTLs say, including negative replies
+# (NXDOMAIN and NODATA) for as long as their SOA record says, in the order
+# they were last used, and the least recently used are thrown away once the
+# cache holds more than its memory budget.  Expired replies are kept a while
+# longer, and given out (with a short TTL) while the resolver asks upstream
+# again in the background, as RFC 8767's serve-stale does.
+
+########################
+###      Imports     ###
+########################
+
+# For least recently used order.
+import collections
+# For packing and unpacking DNS messages.
+import struct
+# For knowing how old entries are.
+import time
+
+########################
+###     Variables    ###
+########################
+
+type_soa = 6
+type_opt = 41
+
+rcode_noerror  = 0
+rcode_nxdomain = 3
+
+# The longest we keep any reply, and any negative reply, for.
+max_ttl          = 86400
+max_negative_ttl = 3600
+
+# How long after they expire replies may still be given out, while the
+# resolver asks again, and the TTL they are given out with.
+stale_time = 86400
+stale_ttl  = 30
+
+# Roughly how much memory each entry takes besides its reply.
+entry_overhead = 300
+
+########################
+###      Helpers     ###
+########################
+
+def skip_name(message, offset):
+    """Return the offset just after a (possibly compressed) name."""
+    while True:
+        length = message[offset]
+        if length == 0:
+            return offset + 1
+        elif length & 0xC0 == 0xC0:
+            return offset + 2
+        #end elif
+        offset += length + 1
+    #end while True:
+#end def skip_name(message, offset):
+
+def reply_ttls(reply, question_end):
+    """Return how long a reply may be cached for, and where its TTLs are.
+    
+    Returns (ttl, [ (offset, ttl), ... ]), with a ttl of 0 for replies that
+    must not be cached: truncated replies, errors other than NXDOMAIN, and
+    negative replies without an SOA record to say how long to keep them.
+    OPT records are left out, as their TTL field is really flags.
+    """
+    flags, qdcount, ancount, nscount, arcount = struct.unpack_from("!HHHHH", reply, 2)
+    rcode = flags & 0x000F
+    if flags & 0x0200 or rcode not in (rcode_noerror, rcode_nxdomain) or qdcount != 1:
+        return 0, []
+    #end if
+    
+    ttls = []
+    answer_ttl = None
+    negative_ttl = None
+    offset = question_end
+    for index in range(ancount + nscount + arcount):
+        offset = skip_name(reply, offset)
+        rtype, rclass, ttl, rdlength = struct.unpack_from("!HHIH", reply, offset)
+        if rtype != type_opt:
+            ttls.append( (offset + 4, ttl) )
+        #end if
+        if index < ancount:
+            answer_ttl = ttl if answer_ttl is None else min(answer_ttl, ttl)
+        elif index < ancount + nscount and rtype == type_soa:
+            # RFC 2308: the lower of the SOA's own TTL and its minimum field.
+            minimum = struct.unpack_from("!I", reply, offset + 10 + rdlength - 4)[0]
+            negative_ttl = min(ttl, minimum)
+        #end elif
+        offset += 10 + rdlength
+    #end for
+    if offset > len(reply):
+        raise ValueError("short reply")
+    #end if
+    
+    if rcode == rcode_noerror and answer_ttl is not None:
+        return min(answer_ttl, max_ttl), ttls
+    #end if
+    # NXDOMAIN, or NODATA (no answers).
+    return min(negative_ttl or 0, max_negative_ttl), ttls
+#end def reply_ttls(reply, question_end):
+
+########################
+###   ResponseCache  ###
+########################
+
+class CacheEntry:
+    """A cached reply, and when it was cached."""
+    
+    __slots__ = ('reply', 'length', 'ttls', 'cached', 'expires', 'stale_until', 'size', 'refreshing')
+    
+    def __init__(self, reply, ttls, ttl, now):
+        self.reply = reply
+        self.length = len(reply)
+        self.ttls = ttls
+        self.cached = now
+        self.expires = now + ttl
+        self.stale_until = self.expires + stale_time
+        self.size = len(reply) + entry_overhead
+        # Whether the resolver is asking for this reply again.
+        self.refreshing = False
+    #end def __init__(self, reply, ttls, ttl, now):
+    
+#end class CacheEntry:
+
+class ResponseCache:
+    """Upstream replies, keyed by (name, type, class) of their question, up to a memory budget of size bytes."""
+    
+    def __init__(self, size, serve_stale = True):
+        self.size = size
+        self.serve_stale = serve_stale
+        self.entries = collections.OrderedDict()
+        self.used = 0
+        # Counters, for the curious.
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.inserts = 0
+        self.evictions = 0
+        self.expirations = 0
+    #end def __init__(self, size, serve_stale = True):
+    
+    def __len__(self):
+        return len(self.entries)
+    #end def __len__(self):
+    
+    def get(self, key, query, question_end, now = None, limit = None):
+        """Return our reply to a query from the cache, or None if we have none, and its entry if it is stale.
+        
+        The reply has the query's ID and question (in case its letters are in
+        different case), and TTLs counted down by how long it has been cached.
+        For stale replies, the caller should ask upstream again, unless the
+        entry is already refreshing.
+        
+        limit is the most bytes the client takes, e.g. over UDP.  Replies
+        longer than that (perhaps fetched over TCP) count as a miss, so that
+        the client's query goes upstream, and gets a reply it can take.
+        """
+        entry = self.entries.get(key)
+        if entry is None or (limit is not None and entry.length > limit):
+            self.misses += 1
+            return None, None
+        #end if
+        if now is None: now = time.monotonic()
+        
+        if now < entry.expires:
+            self.hits += 1
+            age = int(now - entry.cached)
+            stale = None
+        elif self.serve_stale and now < entry.stale_until:
+            self.stale_hits += 1
+            age = None
+            stale = entry
+        else:
+            self.remove(key)
+            self.expirations += 1
+            self.misses += 1
+            return None, None
+        #end else
+        self.entries.move_to_end(key)
+        
+        reply = bytearray(entry.reply)
+        reply[0:2] = query[0:2]
+        reply[12:question_end] = query[12:question_end]
+        for offset, ttl in entry.ttls:
+            struct.pack_into("!I", reply, offset, stale_ttl if age is None else max(0, ttl - age))
+        #end for
+        return bytes(reply), stale
+    #end def get(self, key, query, question_end, now = None, limit = None):
+    
+    def put(self, key, reply, question_end, now = None):
+        """Cache a reply, if it may be cached.  Returns whether it was."""
+        try:
+            ttl, ttls = reply_ttls(reply, question_end)
+        except (IndexError, ValueError, struct.error):
+            return False
+        #end except
+        if ttl <= 0:
+            return False
+        #end if
+        if now is None: now = time.monotonic()
+        
+        if key in self.entries:
+            self.remove(key)
+        #end if
+        entry = CacheEntry(bytes(reply), ttls, ttl, now)
+        self.entries[key] = entry
+        self.used += entry.size
+        self.inserts += 1
+        
+        # Make room by throwing away the least recently used.
+        while self.used > self.size and self.entries:
+            self.remove( next(iter(self.entries)) )
+            self.evictions += 1
+        #end while
+        return key in self.entries
+    #end def put(self, key, reply, question_end, now = None):
+    
+    def remove(self, key):
+        entry = self.entries.pop(key)
+        self.used -= entry.size
+    #end def remove(self, key):
+    
+    def clear(self):
+        self.entries.clear()
+        self.used = 0
+    #end def clear(self):
+    
+    def stats(self):
+        """Return our counters, as a dict."""
+        lookups = self.hits + self.stale_hits + self.misses
+        return collections.OrderedDict( [
+            ('entries'    , len(self.entries)),
+            ('bytes'      , self.used),
+            ('hits'       , self.hits),
+            ('stale_hits' , self.stale_hits),
+            ('misses'     , self.misses),
+            ('hit_rate'   , (self.hits + self.stale_hits) / lookups if lookups else 0.0),
+            ('inserts'    , self.inserts),
+            ('evictions'  , self.evictions),
+            ('expirations', self.expirations),
+        ] )
+    #end def stats(self):
+    
+#end class ResponseCache:
@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+
+# pyhole - a clone of the Pi-hole DNS adblocker, written in Python.
+# pyhole  (c) 2016 by ryt51V
+# Pi-Hole (c) 2015, 2016 by Jacob Salmela
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# DomainTable reads gravity.domains, which pyhole-gravity writes with
+# gravity_domain_table: every domain in our sources, and which sources list
+# each one.  The file is mapped into memory rather than read, so that every
+# process using it shares the one copy in the page cache, and a lookup only
+# touches a handful of pages.
+#
+# After the header (table_header) come, each on an 8 byte boundary as laid
+# out by table_layout:
+#     offsets  - count + 1 native 8 byte integers: where each domain starts
+#                in the domains section, and where the last one ends.
+#     slots    - an open addressing hash table of native 4 byte integers,
+#                each the row of a domain plus one, or 0 if empty.  A domain
+#                starts looking in slot table_slot(domain, slot_count), and
+#                carries on to the next slot until it finds itself or an
+#                empty slot.
+#     suffixes - count native 4 byte integers: the rows in order of their
+#                domains reversed, so that all of the domains ending with
+#                ".example.com" are next to each other.
+#     masks    - mask_size little endian bytes per domain, with bit n set if
+#                source n lists it.
+#     sources  - a JSON list of the URL of each source.
+#     domains  - the domains, sorted as bytes, one after the other.
+
+########################
+###      Imports     ###
+########################
+
+# For the header.
+import struct
+# For reading the table without loading it.
+import mmap
+# For the list of sources.
+import json
+# For hashing domains into slots.
+import zlib
+
+########################
+###     Variables    ###
+########################
+
+# The header: a magic string, how many domains, how many bytes each domain's
+# bitmask of sources takes, how many hash slots there are, and the size of
+# the JSON list of source names.
+table_magic  = b"PYHDOM02"
+table_header = struct.Struct("=8sQQQQ")
+
+########################
+##  Helper Functions  ##
+########################
+
+def table_layout(count, mask_size, slot_count, sources_size):
+    """Return where in the file the offsets, slots, suffixes, masks, source names and domains start."""
+    align = lambda position: (position + 7) & ~7
+    offsets  = align( table_header.size )
+    slots    = offsets + 8 * (count + 1)
+    suffixes = align( slots + 4 * slot_count )
+    masks    = align( suffixes + 4 * count )
+    sources  = align( masks + mask_size * count )
+    domains  = align( sources + sources_size )
+    return offsets, slots, suffixes, masks, sources, domains
+#end def table_layout(count, mask_size, slot_count, sources_size):
+
+def table_slot(domain, slot_count):
+    """Return the hash slot a domain (bytes) starts looking in.  slot_count must be a power of two."""
+    return zlib.crc32(domain) & (slot_count - 1)
+#end def table_slot(domain, slot_count):
+
+########################
+###    DomainTable   ###
+########################
+
+class DomainTable:
+    """A read only, memory mapped gravity.domains.
+    
+    Domains are bytes, lower case and without a trailing dot.  Each domain
+    has a row, its place in sorted order.  contains and find use the hash
+    slots; the prefix and suffix methods binary search the sorted offsets.
+    Use as a context manager, or call close, to unmap the file.
+    """
+    
+    def __init__(self, filename):
+        with open(filename, 'rb') as f:
+            self.map = mmap.mmap( f.fileno(), 0, access = mmap.ACCESS_READ )
+        #end with
+        try:
+            magic, self.rows, self.mask_size, slot_count, sources_size = table_header.unpack_from(self.map)
+        except struct.error:
+            magic = None
+        #end except
+        if magic != table_magic:
+            self.map.close()
+            raise ValueError("{0} is not a gravity.domains file".format(filename) )
+        #end if
+        offsets, slots, suffixes, self.masks, sources, self.base = table_layout(self.rows, self.mask_size, slot_count, sources_size)
+        
+        # Views of the map, rather than copies.
+        self.buffer   = memoryview(self.map)
+        self.offsets  = self.buffer[ offsets : offsets + 8 * (self.rows + 1) ].cast('Q')
+        self.slots    = self.buffer[ slots : slots + 4 * slot_count ].cast('I')
+        self.suffixes = self.buffer[ suffixes : suffixes + 4 * self.rows ].cast('I')
+        self.slot_count = slot_count
+        
+        # The URL of each source.
+        self.sources = json.loads( self.map[ sources : sources + sources_size ].decode() )
+    #end def __init__(self, filename):
+    
+    def close(self):
+        """Unmap the file.  Any views from view() must have been released first."""
+        # The map can't be closed while our views of it are still around.
+        for view in (self.offsets, self.slots, self.suffixes, self.buffer):
+            view.release()
+        #end for
+        self.map.close()
+    #end def close(self):
+    
+    def __enter__(self):
+        return self
+    #end def __enter__(self):
+    
+    def __exit__(self, *exc_info):
+        self.close()
+    #end def __exit__(self, *exc_info):
+    
+    def __len__(self):
+        return self.rows
+    #end def __len__(self):
+    
+    def __contains__(self, domain):
+        return self.find(domain) >= 0
+    #end def __contains__(self, domain):
+    
+    def contains(self, domain):
+        """Return whether a domain is in the table."""
+        return self.find(domain) >= 0
+    #end def contains(self, domain):
+    
+    def find(self, domain):
+        """Return the row of a domain, or -1 if it isn't in the table."""
+        slots = self.slots
+        offsets = self.offsets
+        slot_mask = self.slot_count - 1
+        slot = zlib.crc32(domain) & slot_mask
+        while True:
+            row = slots[slot]
+            if not row:
+                return -1
+            #end if
+            row -= 1
+            if self.map[ self.base + offsets[row] : self.base + offsets[row + 1] ] == domain:
+                return row
+            #end if
+            slot = (slot + 1) & slot_mask
+        #end while
+    #end def find(self, domain):
+    
+    def domain(self, row):
+        """Return the domain in a row."""
+        return self.map[ self.base + self.offsets[row] : self.base + self.offsets[row + 1] ]
+    #end def domain(self, row):
+    
+    def view(self, row):
+        """Return the domain in a row as a memoryview of the map, without copying it."""
+        return self.buffer[ self.base + self.offsets[row] : self.base + self.offsets[row + 1] ]
+    #end def view(self, row):
+    
+    def mask(self, row):
+        """Return the bitmask of the sources listing the domain in a row, with bit n set for source n."""
+        start = self.masks + row * self.mask_size
+        return int.from_bytes( self.map[ start : start + self.mask_size ], 'little' )
+    #end def mask(self, row):
+    
+    def source_names(self, row):
+        """Return the URLs of the sources listing the domain in a row."""
+        mask = self.mask(row)
+        return [ name for number, name in enumerate(self.sources) if mask >> number & 1 ]
+    #end def source_names(self, row):
+    
+    def iter_sources(self, domain):
+        """Yield the URL of each source listing a domain, which is none if it isn't in the table."""
+        row = self.find(domain)
+        if row >= 0:
+            for name in self.source_names(row):
+                yield name
+            #end for
+        #end if
+    #end def iter_sources(self, domain):
+    
+    def bisect(self, key, reverse = False):
+        """Return the first row (or, if reverse, place in suffix order) whose domain is not less than key.
+        
+        In suffix order domains are compared reversed, so key must be too.
+        """
+        lo = 0
+        hi = self.rows
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if reverse:
+                domain = self.domain( self.suffixes[mid] )[::-1]
+            else:
+                domain = self.domain(mid)
+            #end else
+            if domain < key:
+                lo = mid + 1
+            else:
+                hi = mid
+            #end else
+        #end while
+        return lo
+    #end def bisect(self, key, reverse = False):
+    
+    def prefix_range(self, prefix):
+        """Return the range of rows whose domains start with prefix."""
+        # Domains are ASCII, so anything starting with prefix sorts before prefix + 0xff.
+        return range( self.bisect(prefix), self.bisect(prefix + b"\xff") )
+    #end def prefix_range(self, prefix):
+    
+    def suffix_range(self, suffix):
+        """Return the range of places in suffix order whose domains end with suffix."""
+        key = suffix[::-1]
+        return range( self.bisect(key, reverse = True), self.bisect(key + b"\xff", reverse = True) )
+    #end def suffix_range(self, suffix):
+    
+    def count(self, prefix = None, suffix = None):
+        """Return how many domains start with prefix and end with suffix, or how many there are altogether."""
+        if suffix is None:
+            return len( self.prefix_range(prefix or b"") )
+        elif not prefix:
+            return len( self.suffix_range(suffix) )
+        else:
+            return sum( 1 for domain in self.iter_suffix(suffix) if domain.startswith(prefix) )
+        #end else
+    #end def count(self, prefix = None, suffix = None):
+    
+    def iter_prefix(self, prefix = b""):
+        """Yield the domains starting with prefix, in sorted order."""
+        for row in self.prefix_range(prefix):
+            yield self.domain(row)
+        #end for
+    #end def iter_prefix(self, prefix = b""):
+    
+    def iter_suffix(self, suffix = b""):
+        """Yield the domains ending with suffix, in order of their reversed domains.
+        
+        For example, b".example.com" yields every subdomain of example.com.
+        """
+        for place in self.suffix_range(suffix):
+            yield self.domain( self.suffixes[place] )
+        #end for
+    #end def iter_suffix(self, suffix = b""):
+    
+#end class DomainTable:
@@ -34,6 +34,10 @@ import configparser
 import getpass
 # For strtobool
 import distutils.util
+# For switching from root to the pyhole user.
+import pwd
+# For the blacklist and whitelist, which are ordered sets.
+import collections
 
 # Gravity
 
@@ -41,11 +45,39 @@ import distutils.util
 import shutil
 # For wildcard file / directory searches.
 import glob
+# For parsing sources.
+import re
 # For downloading files.
 import urllib.parse
 import urllib.request
 # For temporary files
 import tempfile
+# For downloading several sources at once.
+import concurrent.futures
+# For enforcing the download deadline.
+import time
+# For the source metadata store.
+import json
+# For hashing downloaded sources.
+import hashlib
+# For decompressing gzip / deflate downloads.
+import zlib
+# For merging sorted runs of domains.
+import heapq
+# For the gravity.hosts index.
+import struct
+import array
+
+# Query
+
+# For reading gravity.domains.
+from pyhole import domaintable
+# For following the query log.
+from pyhole import querylog
+# For keeping query statistics.
+from pyhole import statsdb
+# For only following the query log in one process at a time.
+import fcntl
 
 ########################
 ###     Variables    ###
@@ -58,6 +90,9 @@ var_dir    = '/var/lib/pyhole'
 
 conf_file_path = os.path.join(config_dir, 'pyhole.conf')
 
+# Written by pyhole-config, with the upstream DNS servers.
+dnsmasq_conf_file = '/etc/dnsmasq.d/01-pyhole.conf'
+
 adlists_default = os.path.join(config_dir, 'adlists.default')
 adlists_file    = os.path.join(config_dir, 'adlists.list')
 
@@ -66,6 +101,76 @@ blacklist_file  = os.path.join(config_dir, 'blacklist.txt')
 
 gravity_hosts      = os.path.join(var_dir   , 'gravity.hosts'   )
 blacklist_hosts    = os.path.join(var_dir   , 'blacklist.hosts' )
+# ETag, Last-Modified, size and hash of each downloaded source.
+gravity_sources    = os.path.join(var_dir   , 'gravity.sources.json' )
+# The byte offset of each domain in gravity.hosts.
+gravity_hosts_index = os.path.join(var_dir  , 'gravity.hosts.index' )
+# dnsmasq servers-file, used instead of gravity.hosts with the "dnsmasq" output.
+gravity_conf       = os.path.join(var_dir   , 'gravity.conf' )
+# Every domain in our sources, and which sources list it - see gravity_domain_table.
+gravity_domains    = os.path.join(var_dir   , 'gravity.domains' )
+# Each gravity run is built into its own gravity.<generation> directory, and
+# gravity.current links to the one in use.  gravity.hosts, gravity.hosts.index,
+# gravity.conf and gravity.domains above are links into gravity.current, so
+# that switching generations switches them all at once.
+gravity_current    = os.path.join(var_dir   , 'gravity.current' )
+# Kept in each gravity.<generation> directory: the digest of its lists, and
+# how they differ from the generation before - see gravity_compare_generations.
+gravity_build_file = 'gravity.build.json'
+
+# dnsmasq's log-queries output - see pyhole_querylog.
+querylog_file    = '/var/log/pyhole.log'
+# How far pyhole-querylog has got through the log, and its totals so far.
+querylog_state   = os.path.join(var_dir   , 'querylog.state.json' )
+# Those totals as the admin pages show them.
+querylog_summary = os.path.join(var_dir   , 'querylog.json' )
+# Query statistics kept for longer than the log is - see statsdb.
+querylog_db      = os.path.join(var_dir   , 'querylog.db' )
+# Held by whichever process is following the log - see querylog_lock.
+querylog_lock_file = os.path.join(var_dir , 'querylog.lock' )
+# querylog.json is rewritten at least this often, even if nothing has changed,
+# as the admin pages go by how old it is to tell whether we are still running.
+querylog_summary_interval = 60
+
+# Bump this whenever gravity_advanced changes how it parses sources,
+# so that any cached parses of unchanged sources are thrown away.
+gravity_parser_version = 3
+
+# How many domains each stage of gravity hands on to the next at a time.
+gravity_batch_size = 10000
+
+# How many lines at the start of a source gravity_detect_format looks at.
+gravity_detect_lines = 100
+
+# Used by the gravity_parse_* functions on whole (lower cased) blocks of a source.
+# A comment runs from the comment character to the end of the line.
+gravity_comment_regex = re.compile(rb"#[^\n]*")
+# A URL scheme at the start of the domain, e.g. "0.0.0.0 http://example.com/".
+gravity_scheme_regex  = re.compile(rb"^([ \t]*(?:\S+[ \t]+)?)[a-z][a-z0-9+.-]*://", re.MULTILINE)
+# A URL port and path, e.g. "example.com:8080/ads/banner.js".
+gravity_path_regex    = re.compile(rb"(?::[0-9]+)?/\S*")
+# Every character a domain can have.
+gravity_domain_chars  = b"abcdefghijklmnopqrstuvwxyz0123456789-_."
+# Domains with dots in them that hosts files map to themselves.
+gravity_local_domains = { b"localhost.localdomain" }
+# An adblock rule that blocks a whole domain, e.g. "||example.com^".
+gravity_adblock_regex = re.compile(rb"^[ \t]*\|\|([a-z0-9_.-]+)\^[ \t\r]*$", re.MULTILINE)
+# A dnsmasq option that gives the address of domains, e.g. "address=/example.com/0.0.0.0"
+gravity_dnsmasq_regex = re.compile(rb"^[ \t]*(address|local|server)=/(.*)/([^/\n]*)$", re.MULTILINE)
+# In dnsmasq configuration, a comment starts a line or follows whitespace.
+# Any other "#" is part of the option, e.g. "server=/example.com/#" (use
+# the usual upstream servers) or "server=/example.com/10.0.0.1#5353".
+gravity_dnsmasq_comment_regex = re.compile(rb"(?:^|(?<=[ \t]))#[^\n]*", re.MULTILINE)
+
+# The gravity.hosts.index header: a magic string, the size of gravity.hosts
+# it was built for, and how many offsets follow.  The offsets themselves are
+# native 8 byte unsigned integers.
+gravity_index_magic  = b"PYHIDX01"
+gravity_index_header = struct.Struct("=8sQQ")
+
+# Whitelisting fewer domains than this patches gravity.hosts in place using
+# gravity.hosts.index.  Any more and we rewrite the whole file.
+gravity_incremental_limit = 100
 
 ########################
 ##  Helper Functions  ##
@@ -126,6 +231,25 @@ def services_changestate(web_server = None, stop = False, start = False, reload
 
 
 
+def read_dnsmasq_servers():
+    """Read the upstream DNS servers from the "server=" lines of our dnsmasq config."""
+    servers = []
+    try:
+        with open(dnsmasq_conf_file, 'rt') as f:
+            for line in f:
+                line = line.strip()
+                # Leave out domain specific servers, e.g. "server=/example.com/#".
+                if line.startswith("server=") and not line.startswith("server=/"):
+                    servers.append( line[7:] )
+                #end if
+            #end for
+        #end with
+    except OSError:
+        pass
+    #end except
+    return servers
+#end def read_dnsmasq_servers():
+
 def read_config():
     """Read the pyhole config from file."""
     global config
@@ -133,6 +257,22 @@ def read_config():
     global configured
     global ipv4_addr
     global ipv6_addr
+    global download_concurrency
+    global download_deadline
+    global download_compression
+    global unique_memory
+    global unique_temp_dir
+    global gravity_pipeline
+    global gravity_output
+    global gravity_prune
+    global gravity_generations_kept
+    global stats_keep
+    global dns_servers
+    global dns_cache_memory
+    global dns_serve_stale
+    global dns_race
+    global dns_upstream_tcp
+    global dns_workers
     
     # Reinitialise the config object.
     config = configparser.ConfigParser()
@@ -166,6 +306,86 @@ def read_config():
         
     #end if 'Network' in config.sections():
     
+    # Upstream DNS servers, as chosen in pyhole-config.  Installs configured
+    # before pyhole.conf kept them fall back to those in our dnsmasq config.
+    dns_servers = []
+    
+    if 'DNS' in config.sections():
+        dns_servers = config['DNS'].get('servers', '').split()
+    #end if
+    if not dns_servers:
+        dns_servers = read_dnsmasq_servers()
+    #end if
+    
+    # pyhole-dns settings, also optional.
+    #   cache_memory - Roughly how many MB of replies pyhole-dns caches.  0 for none.
+    #   serve_stale  - Whether expired replies are given out while asking again.
+    #   race         - How many of the fastest upstream servers each query is sent to at once.
+    #   upstream_tcp - Whether to forward over persistent TCP connections, e.g. to a local DNS over TLS stub.
+    #   workers      - How many processes answer queries.  0 for one per CPU.
+    dns_cache_memory = 16
+    dns_serve_stale  = True
+    dns_race         = 2
+    dns_upstream_tcp = False
+    dns_workers      = 1
+    
+    if 'DNS' in config.sections():
+        dns_cache_memory = max( 0, config['DNS'].getint('cache_memory', dns_cache_memory) )
+        dns_serve_stale  = config['DNS'].getboolean('serve_stale', dns_serve_stale)
+        dns_race         = max( 1, config['DNS'].getint('race', dns_race) )
+        dns_upstream_tcp = config['DNS'].getboolean('upstream_tcp', dns_upstream_tcp)
+        dns_workers      = max( 0, config['DNS'].getint('workers', dns_workers) )
+    #end if
+    
+    # Gravity settings.  These are optional, so we fall back to defaults.
+    #   download_concurrency - How many sources to download at once.
+    #   download_deadline    - Seconds allowed for all downloads in one run.
+    #   download_compression - Whether to ask for gzip / deflate downloads.
+    #   unique_memory        - Roughly how many MB gravity_unique may use.
+    #   unique_temp_dir      - Where gravity_unique keeps its sorted runs.
+    #   pipeline             - "fused" to build gravity.hosts in a single pass,
+    #                          or "staged" to keep the pyhole.* stages for debugging.
+    #   output               - "hosts" to block domains with gravity.hosts, or
+    #                          "dnsmasq" to block them (and their subdomains)
+    #                          with gravity.conf.
+    #   prune                - Whether outputs that block subdomains leave out
+    #                          the subdomains of blocked domains.
+    #   generations          - How many gravity.<generation> directories to
+    #                          keep, including the one in use, for rollback.
+    download_concurrency = 8
+    download_deadline    = 300
+    download_compression = True
+    unique_memory        = 32
+    unique_temp_dir      = var_dir
+    gravity_pipeline     = "fused"
+    gravity_output       = "hosts"
+    gravity_prune        = True
+    gravity_generations_kept = 3
+    
+    if 'Gravity' in config.sections():
+        download_concurrency = config['Gravity'].getint('download_concurrency', download_concurrency)
+        download_deadline    = config['Gravity'].getint('download_deadline'   , download_deadline   )
+        download_compression = config['Gravity'].getboolean('download_compression', download_compression)
+        unique_memory        = config['Gravity'].getint('unique_memory'       , unique_memory       )
+        unique_temp_dir      = config['Gravity'].get('unique_temp_dir'        , unique_temp_dir     )
+        gravity_pipeline     = config['Gravity'].get('pipeline'               , gravity_pipeline    )
+        gravity_output       = config['Gravity'].get('output'                 , gravity_output      )
+        gravity_prune        = config['Gravity'].getboolean('prune'           , gravity_prune       )
+        gravity_generations_kept = max( 1, config['Gravity'].getint('generations', gravity_generations_kept) )
+    #end if 'Gravity' in config.sections():
+    
+    # Query statistics settings, also optional.
+    #   keep_minutes - How many days of per-minute totals to keep.
+    #   keep_hours   - How many days of per-hour statistics to keep.
+    #   keep_days    - How many days of per-day statistics to keep.
+    stats_keep = dict(statsdb.keep_defaults)
+    
+    if 'Stats' in config.sections():
+        for period in stats_keep:
+            stats_keep[period] = max( 1, config['Stats'].getint('keep_' + period + 's', stats_keep[period]) )
+        #end for
+    #end if 'Stats' in config.sections():
+    
 #end def read_config():
 
 def write_config():
@@ -212,6 +432,17 @@ def sudo_pyhole():
     #end if getpass.getuser() != "pyhole":
 #end def sudo_pyhole():
 
+def drop_root(user = "pyhole"):
+    """If running as root, carry on as user instead, e.g. once we have bound to port 53."""
+    if os.geteuid() != 0:
+        return
+    #end if
+    entry = pwd.getpwnam(user)
+    os.setgroups( os.getgrouplist(user, entry.pw_gid) )
+    os.setgid(entry.pw_gid)
+    os.setuid(entry.pw_uid)
+#end def drop_root(user = "pyhole"):
+
 # It is poor practice to require root.  It is better to try making changes and
 # gracefully exit when they fail, perhaps with the message "Are you root?".
 # However requiring root is significantly easier to code, so we will use this for now.
@@ -254,16 +485,116 @@ def gravity_collapse(adlists_file):
 #   so we save a lot of stuff in files rather than in memory
 #   so that we're not wasting RAM.
 
-def gravity_download_source(url : str, destination_filename : str, headers = {}, post_values = {} ):
-    """Download the source to a file, using any headers or POST data required."""
-    # Unlike curl in the original Pi-Hole, with urllib we don't seem to have
-    # the facility to download filex newer than xyz datetime.
-    # So empty files here are leaning more towards errors.
+def read_sources_meta():
+    """Read the source metadata store into a dict, keyed by list file basename."""
+    try:
+        with open(gravity_sources, 'rt') as f:
+            sources_meta = json.load(f)
+        #end with
+    except (OSError, ValueError):
+        # Missing or corrupt - we just won't make any conditional requests.
+        sources_meta = {}
+    #end except
+    return sources_meta
+#end def read_sources_meta():
+
+def write_sources_meta(sources_meta : dict):
+    """Write the source metadata store back to file."""
+    # Write to a temp file alongside and rename, so that the store is
+    # never left half written.
+    temp_file = gravity_sources + ".tmp"
+    with open(temp_file, 'wt') as f:
+        json.dump(sources_meta, f, indent = 4, sort_keys = True)
+    #end with
+    os.replace(temp_file, gravity_sources)
+#end def write_sources_meta(sources_meta : dict):
+
+class gravity_decoder:
+    """Undo any gzip / deflate Content-Encoding, a chunk at a time."""
+    
+    def __init__(self, content_encoding):
+        encoding = (content_encoding or "").strip().lower()
+        self.decompressor = None
+        self.deflate = False
+        if encoding in ("gzip", "x-gzip"):
+            # 16 + MAX_WBITS expects a gzip header.
+            self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif encoding == "deflate":
+            # Servers send deflate either zlib wrapped (per the RFC) or raw.
+            # We find out which from the first chunk.
+            self.deflate = True
+        elif encoding not in ("", "identity"):
+            raise ValueError("unsupported Content-Encoding {0}".format(encoding))
+        #end elif
+    #end def __init__(self, content_encoding):
+    
+    def decode(self, chunk):
+        if self.decompressor is None:
+            if not self.deflate:
+                return chunk
+            #end if
+            try:
+                self.decompressor = zlib.decompressobj()
+                return self.decompressor.decompress(chunk)
+            except zlib.error:
+                self.decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+            #end except
+        #end if
+        return self.decompressor.decompress(chunk)
+    #end def decode(self, chunk):
+    
+    def flush(self):
+        if self.decompressor is None:
+            return b""
+        #end if
+        return self.decompressor.flush()
+    #end def flush(self):
+    
+#end class gravity_decoder:
+
+def gravity_download_source(url : str, destination_filename : str, headers = {}, post_values = {}, deadline = None, meta = None ):
+    """Download the source to a file, using any headers or POST data required.
+    
+    If meta holds the ETag / Last-Modified of our previous download, then only
+    download if the source is newer.  Returns a 2-tuple of the status
+    ("downloaded", "empty" or "notmodified") and the metadata for the file.
+    """
+    # Unlike curl in the original Pi-Hole, urllib has no "only if newer"
+    # download, so we send If-None-Match / If-Modified-Since ourselves.
+    # Empty files here are leaning more towards errors.
+    
+    # Only ask for a conditional download if we still have the file it refers to.
+    headers = dict(headers)
+    if meta and meta.get('url') == url and os.path.isfile(destination_filename):
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        #end if
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+        #end if
+    #end if
+    
+    # Never wait longer on a single socket operation than our deadline allows.
+    timeout = 20
+    if deadline is not None:
+        timeout = max( 1, min( timeout, deadline - time.monotonic() ) )
+    #end if
+    
+    # Ask for a compressed download if we're allowed to.
+    if download_compression:
+        headers['Accept-Encoding'] = 'gzip, deflate'
+    #end if
     
-    # We will first save to a temp file, so that if our result is an empty file
-    # then we won't overwrite an old nonempty file.  So let's initialise one.
+    # We will first stream to a temp file, so that if our result is an empty
+    # file then we won't overwrite an old nonempty file.  It's created next to
+    # the destination so that we can rename it into place rather than copy.
     # This type won't be automatically deleted upon close.
-    temp_file = tempfile.mkstemp()[1]
+    temp_fd, temp_file = tempfile.mkstemp(
+                                            dir    = os.path.dirname(destination_filename),
+                                            prefix = os.path.basename(destination_filename) + ".",
+                                            suffix = ".download"
+                                         )
+    temp_file_object = os.fdopen(temp_fd, 'wb')
     
     # PROTIP: Below, Replace post_values with True to get
     # an HTTP error with some providers.  Useful for testing
@@ -274,31 +605,191 @@ def gravity_download_source(url : str, destination_filename : str, headers = {},
         data = None
     #end else:
     req = urllib.request.Request(url, data, headers)
-    with urllib.request.urlopen(req, timeout = 20) as response, open (temp_file, 'wb') as f:
-        f.write( response.read() )
-    #end with
+    try:
+        try:
+            with urllib.request.urlopen(req, timeout = timeout) as response, temp_file_object as f:
+                decoder = gravity_decoder( response.headers.get('Content-Encoding') )
+                # Hash and count the decoded content as we go.
+                sha256 = hashlib.sha256()
+                size = 0
+                
+                # Stream in chunks, so that we never hold a whole list in memory.
+                while True:
+                    chunk = response.read(65536)
+                    if not chunk: break
+                    
+                    # Give up between chunks if we've run past the deadline.
+                    if deadline is not None and time.monotonic() > deadline:
+                        raise TimeoutError("download still running at the gravity deadline")
+                    #end if
+                    
+                    chunk = decoder.decode(chunk)
+                    f.write(chunk)
+                    sha256.update(chunk)
+                    size += len(chunk)
+                #end while True:
+                
+                chunk = decoder.flush()
+                f.write(chunk)
+                sha256.update(chunk)
+                size += len(chunk)
+                
+                new_meta = {
+                    'url'           : url,
+                    'etag'          : response.headers.get('ETag'),
+                    'last_modified' : response.headers.get('Last-Modified'),
+                    'size'          : size,
+                    'sha256'        : sha256.hexdigest()
+                }
+            #end with
+        except urllib.error.HTTPError as inst:
+            # 304 Not Modified - our previous download is still current.
+            if inst.code == 304:
+                return "notmodified", meta
+            #end if
+            raise
+        #end except urllib.error.HTTPError as inst:
+        
+        # If the run's deadline passed while we were downloading, then gravity
+        # has already moved on without us.  Don't touch the destination file.
+        if deadline is not None and time.monotonic() > deadline:
+            raise TimeoutError("download finished after the gravity deadline")
+        #end if
+        
+        if new_meta['size'] == 0:
+            status = "empty"
+            new_meta = meta
+        elif meta and meta.get('url') == url and meta.get('sha256') == new_meta['sha256'] and os.path.isfile(destination_filename):
+            # The server doesn't do conditional requests, but the content is
+            # the same as last time.  Keep our file and any parse of it.
+            status = "downloaded"
+            for key in ('parsed_sha256', 'parser_version', 'format', 'rejected'):
+                if key in meta: new_meta[key] = meta[key]
+            #end for
+        else:
+            status = "downloaded"
+            # Atomically replace any previous download.
+            os.replace(temp_file, destination_filename)
+        #end else
+    finally:
+        # If urlopen failed then the temp file was never closed.
+        temp_file_object.close()
+        # Delete the temporary file, if we haven't renamed it into place.
+        try:
+            os.remove(temp_file)
+        except FileNotFoundError:
+            pass
+        #end except
+    #end finally:
+    
+    return status, new_meta
     
-    if os.path.getsize(temp_file) == 0:
-        nonempty = False
+#end def gravity_download_source(url : str, destination_filename : str, headers = {}, post_values = {}, deadline = None, meta = None ):
+
+def gravity_source_options(source : str):
+    """Return the headers and POST values required to download the source."""
+    
+    # Our default headers and post values...
+    headers = {
+                    'User-Agent' : 'Mozilla/10.0'
+              }
+    post_values = {}
+    # Handle our special cases
+    if "adblock.mahakala.is" in source:
+        headers = {
+                        'User-Agent'    : 'Mozilla/5.0 (X11; Linux x86_64; rv:30.0) Gecko/20100101 Firefox/30.0',
+                        'Referer'       : 'http://forum.xda-developers.com/'
+                  }
+    elif "pgl.yoyo.org" in source:
+        post_values = {
+                            'mimetype'      : 'plaintext',
+                            'hostformat'    : 'hosts'
+                      }
+    #end elif
+    
+    return headers, post_values
+#end def gravity_source_options(source : str):
+
+def gravity_previous_download(filename : str):
+    """Check for an older download of a source.  Returns success and a message."""
+    # But do we already have an older version of this file?
+    nonempty_oldfile = False
+    try:
+        nonempty_oldfile = (os.path.getsize(filename) >= 0)
+    except:
+        pass
+    #end except
+    
+    if nonempty_oldfile:
+        return True, "Using previous download."
     else:
-        nonempty = True
-        shutil.copyfile(temp_file, destination_filename)
-    #end if
+        return False, "No previous download."
+    #end else
+#end def gravity_previous_download(filename : str):
+
+def gravity_fetch_source(source : str, domain : str, filename : str, deadline = None, meta = None):
+    """Download one source, falling back to any previous download.
+    
+    Returns a 3-tuple of success, a message, and the source's metadata.
+    """
+    
+    headers, post_values = gravity_source_options(source)
+    
+    # We may be running alongside other downloads, so rather than printing
+    # as we go we build up our message and let gravity_spinup print it.
+    message = "::: Getting {0} list...".format(domain)
+    
+    tryold = False
+    success = False
+    
+    try:
+        status, meta = gravity_download_source( source, filename, headers, post_values, deadline, meta )
+    except urllib.error.HTTPError as inst:
+        message += "encountered error {0} {1}.  ".format(inst.code, inst.reason)
+        tryold = True
+    except TimeoutError:
+        message += "timed out.  "
+        tryold = True
+    except:
+        message += "encountered an unknown error: {0}.  ".format(sys.exc_info()[0])
+        tryold = True
+    else:
+        if status == "empty":
+            message += "downloaded an empty file.  "
+            tryold = True
+        elif status == "notmodified":
+            message += "not modified.  Using previous download."
+            success = True
+        else:
+            message += "successful!"
+            success = True
+        #end else
+    #end else
     
-    # Delete the temporary file
-    os.remove(temp_file)
+    if tryold == True:
+        success, old_message = gravity_previous_download(filename)
+        message += old_message
+    #end if
     
-    return nonempty
+    return success, message, meta
+#end def gravity_fetch_source(source : str, domain : str, filename : str, deadline = None, meta = None):
+
+def gravity_spinup(sources : list, sources_meta = None):
+    """Download each source to a file, several at a time.
     
-#end def gravity_download_source(url : str, destination_filename : str, headers = {}, post_values = {} ):
+    sources_meta is the source metadata store, which is updated in place.
+    """
+    if sources_meta is None: sources_meta = {}
 
-def gravity_spinup(sources : list):
-    """Download each source to a file."""
     print(":::")
-    i = 0
-    sources_out = []
-    for s in sources:
-        
+    
+    # All downloads must be finished by this time, otherwise we use whatever
+    # we downloaded previously.
+    deadline = time.monotonic() + download_deadline
+    
+    # A list of 3-tuples of the source, its domain and its save filename.
+    jobs = []
+    for i, s in enumerate(sources):
         # Get just the domain name itself.
         domain = urllib.parse.urlparse(s).netloc
         
@@ -306,121 +797,537 @@ def gravity_spinup(sources : list):
         basename = "list.{0}.{1}.domains".format( i, domain )
         filename = os.path.join( var_dir, basename )
         
-        # Our default headers and post values...
-        headers = {
-                        'User-Agent' : 'Mozilla/10.0'
-                  }
-        post_values = {}
-        # Handle our special cases
-        if "adblock.mahakala.is" in s:
-            headers = {
-                            'User-Agent'    : 'Mozilla/5.0 (X11; Linux x86_64; rv:30.0) Gecko/20100101 Firefox/30.0',
-                            'Referer'       : 'http://forum.xda-developers.com/'
-                      }
-        elif "pgl.yoyo.org" in s:
-            post_values = {
-                                'mimetype'      : 'plaintext',
-                                'hostformat'    : 'hosts'
-                          }
-        #end elif
-        
-        print("::: Getting {0} list...".format(domain) , end='')
-        
-        tryold = False
-        success = False
-        
-        try:
-            nonempty = gravity_download_source( s, filename, headers, post_values)
-        except urllib.error.HTTPError as inst:
-            print("encountered error {0} {1}.  ".format(inst.code, inst.reason), end='' )
-            tryold = True
-        except:
-            print("encountered an unknown error: {0}.  ".format(sys.exc_info()[0]), end='' )
-            tryold = True
-        else:
-            if nonempty == False:
-                print("downloaded an empty file.  ", end='')
-                tryold = True
+        jobs.append( ( s, domain, filename ) )
+    #end for i, s in enumerate(sources):
+    
+    # We don't use "with" here, as that would wait on any download still
+    # running after the deadline.
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers = max(1, download_concurrency) )
+    futures = {}
+    for job in jobs:
+        basename = os.path.basename(job[2])
+        future = executor.submit( gravity_fetch_source, job[0], job[1], job[2], deadline, sources_meta.get(basename) )
+        futures[future] = job
+    #end for job in jobs:
+    
+    # Print each result as it comes in.
+    results = {}
+    try:
+        for future in concurrent.futures.as_completed( futures, timeout = max(0, deadline - time.monotonic()) ):
+            success, message, meta = future.result()
+            print(message)
+            job = futures[future]
+            results[job] = success
+            # Only keep metadata that describes the file we actually have.
+            basename = os.path.basename(job[2])
+            if meta and meta.get('url') == job[0]:
+                sources_meta[basename] = meta
             else:
-                print("successful!")
-                success = True
+                sources_meta.pop(basename, None)
             #end else
+        #end for
+    except concurrent.futures.TimeoutError:
+        # Anything still outstanding has run out of time.
+        for future, job in futures.items():
+            if job in results: continue
+            future.cancel()
+            success, old_message = gravity_previous_download(job[2])
+            print("::: Getting {0} list...timed out.  {1}".format(job[1], old_message) )
+            results[job] = success
+        #end for future, job in futures.items():
+    #end except concurrent.futures.TimeoutError:
+    
+    executor.shutdown(wait = False)
+    
+    # Add to sources_out a 2-tuple of the source and filename,
+    # keeping the order of our adlists file.
+    sources_out = [ ( job[0], job[2] ) for job in jobs if results[job] ]
+    
+    return sources_out
+#end def gravity_spinup(sources : list):
+
+def gravity_parse_source(source_filename, stats = None):
+    """Read one source file, remove all comments, and yield batches of just the domains.
+    
+    The format of the source is detected from its first few lines.  If stats
+    is given, its 'format' is set to the format of the source and its
+    'rejected' to how many entries in the source were not domains we can use.
+    """
+    
+    if stats is None: stats = {}
+    
+    source_format = gravity_detect_format(source_filename)
+    parse_block = gravity_parsers[source_format]
+    stats['format'] = source_format
+    stats['rejected'] = 0
+    
+    # We work in bytes throughout, as every later stage does too.
+    # We also work on a whole block of the file at a time, so that as much of
+    # the work as possible is done by bytes methods rather than line by line.
+    for block in gravity_read_blocks(source_filename):
+        batch, rejected = parse_block(block)
+        stats['rejected'] += rejected
+        if batch: yield batch
+    #end for
+    
+#end def gravity_parse_source(source_filename, stats = None):
+
+def gravity_detect_format(source_filename):
+    """Guess the format of a source from its first gravity_detect_lines lines, returning a key of gravity_parsers."""
+    
+    votes = collections.Counter()
+    lines = next( gravity_read_blocks(source_filename), b"" ).lower().split(b"\n")
+    for line in lines[:gravity_detect_lines]:
+        line = line.strip()
+        if not line or line.startswith(b"#"):
+            continue
+        elif line.startswith(b"[adblock"):
+            return "adblock"
+        elif line.startswith( (b"!", b"||", b"@@") ) or b"##" in line:
+            votes["adblock"] += 1
+        elif line.startswith( (b"address=/", b"local=/", b"server=/") ):
+            votes["dnsmasq"] += 1
+        elif line.startswith( (b";", b"$ttl", b"$origin") ):
+            votes["rpz"] += 1
+        else:
+            fields = line.split()
+            if b"cname" in fields or b"soa" in fields:
+                votes["rpz"] += 1
+            elif len(fields) == 1:
+                votes["domains"] += 1
+            elif valid_ip( fields[0].decode("ascii", "replace") ):
+                votes["hosts"] += 1
+            #end elif
         #end else
+    #end for
+    
+    if not votes: return "hosts"
+    return votes.most_common(1)[0][0]
+#end def gravity_detect_format(source_filename):
+
+def gravity_count_entries(lines, comments):
+    """Count the lines that are not blank, and do not start with one of the comments characters."""
+    return sum( 1 for line in lines if line.strip() and line.lstrip()[0] not in comments )
+#end def gravity_count_entries(lines, comments):
+
+def gravity_check_domains(batch):
+    """Return just the domains in batch that we can use, removing any trailing dots."""
+    
+    # Throw out anything that isn't a domain at all, e.g. adblock rules.
+    # Checking the whole batch at once means we only have to go through it
+    # domain by domain if something needs throwing out.
+    joined = b"".join(batch)
+    if joined.translate(None, gravity_domain_chars):
+        batch = [ domain for domain in batch if not domain.translate(None, gravity_domain_chars) ]
+    #end if
+    # Throw out anything without a dot, e.g. "localhost", and IP addresses,
+    # e.g. "0.0.0.0 0.0.0.0".  The last label of a domain always has a letter
+    # in it, so we only need to look closer at the few that end in a digit
+    # (or a dot, for fully qualified domains).  The order doesn't matter, as
+    # the domains get sorted later on.
+    dot, nine = ord("."), ord("9")
+    suspects = [ domain for domain in batch if domain[-1] <= nine ]
+    batch = [ domain for domain in batch if domain[-1] > nine and dot in domain ]
+    for domain in suspects:
+        domain = domain.rstrip(b".")
+        if dot in domain and not domain.rpartition(b".")[2].isdigit(): batch.append(domain)
+    #end for
+    if b"localhost" in joined:
+        batch = [ domain for domain in batch if domain not in gravity_local_domains ]
+    #end if
+    
+    return batch
+#end def gravity_check_domains(batch):
+
+def gravity_parse_hosts(block):
+    """Parse a block of a hosts (or plain domains) source, returning a list of just the domains and how many entries were rejected."""
+    
+    block = block.lower()
+    # Remove any comments - from the comment character to the end of the line,
+    # along with the space or tab before it, if there is one.
+    if b"#" in block:
+        block = gravity_comment_regex.sub(b"", block)
+        block = block.replace(b" \n", b"\n").replace(b"\t\n", b"\n").rstrip()
+    #end if
+    # Remove any URL scheme, port and path, leaving just the host.
+    if b"/" in block:
+        if b"://" in block: block = gravity_scheme_regex.sub(rb"\1", block)
+        block = gravity_path_regex.sub(b"", block)
+    #end if
+    
+    # Nearly every line of a hosts file starts with the same address, so take
+    # the address from the last line and remove it from every line in one go.
+    domains = block
+    last_line = block[block.rfind(b"\n") + 1:]
+    fields = last_line.split(None, 1)
+    if len(fields) == 2 and valid_ip(fields[0].decode("ascii", "replace")):
+        address = b"\n" + last_line[:len(last_line) - len(fields[1])]
+        domains = (b"\n" + block).replace(address, b"\n")
+    #end if
+    
+    if b" " in domains or b"\t" in domains:
+        # Some lines are more than just a domain, so we go line by line.
+        # If a line has more than one component the domain has to be the
+        # second component.  If not then it has to be the only component.
+        batch = [ fields[len(fields) > 1] for fields in map(bytes.split, block.split(b"\n")) if fields ]
+    else:
+        # Every line is either blank or just a domain.
+        batch = domains.split()
+    #end else
+    
+    # Every line left has an entry on it, so batch has one for each entry.
+    entries = len(batch)
+    batch = gravity_check_domains(batch)
+    return batch, entries - len(batch)
+#end def gravity_parse_hosts(block):
+
+def gravity_parse_adblock(block):
+    """Parse a block of an adblock (Adblock Plus) source, returning a list of just the domains and how many entries were rejected."""
+    
+    block = block.lower()
+    # Only rules that block a whole domain can be used.  Exception rules,
+    # element hiding rules, and rules with paths or options are rejected.
+    batch = gravity_check_domains( gravity_adblock_regex.findall(block) )
+    # "!" starts a comment, and "[" the "[Adblock Plus 2.0]" header.
+    entries = gravity_count_entries(block.split(b"\n"), b"![")
+    return batch, entries - len(batch)
+#end def gravity_parse_adblock(block):
+
+def gravity_parse_dnsmasq(block):
+    """Parse a block of a dnsmasq configuration source, returning a list of just the domains and how many entries were rejected."""
+    
+    block = block.lower()
+    if b"#" in block: block = gravity_dnsmasq_comment_regex.sub(b"", block)
+    
+    batch = []
+    used = 0
+    for option, domains, address in gravity_dnsmasq_regex.findall(block):
+        # "address=/example.com/" and "address=/example.com/0.0.0.0" block.
+        # So do "server=/example.com/" and "local=/example.com/", which answer
+        # locally, but not "server=/example.com/8.8.8.8" which forwards, nor
+        # "server=/example.com/#" which forwards to the usual servers.
+        # Each option can give several domains - "address=/a.com/b.com/".
+        if option == b"address" or not address.strip():
+            domains = gravity_check_domains([ domain for domain in domains.split(b"/") if domain ])
+            if domains:
+                batch.extend(domains)
+                used += 1
+            #end if
+        #end if
+    #end for
+    
+    entries = gravity_count_entries(block.split(b"\n"), b"#")
+    return batch, entries - used
+#end def gravity_parse_dnsmasq(block):
+
+def gravity_parse_rpz(block):
+    """Parse a block of an RPZ (DNS response policy zone) source, returning a list of just the domains and how many entries were rejected."""
+    
+    batch = []
+    entries = 0
+    for line in block.lower().split(b"\n"):
+        line = line.partition(b";")[0]
+        # Skip blank lines, directives such as $TTL, records for the zone
+        # itself, and lines that carry on the record before.
+        if not line.strip() or line[0] in b" \t$@": continue
+        entries += 1
         
-        if tryold == True:
-            # But do we already have an older version of this file?
-            nonempty_oldfile = False
-            try:
-                nonempty_oldfile = (os.path.getsize(filename) >= 0)
-            except:
-                pass
-            #end except
-            
-            if nonempty_oldfile:
-                print("Using previous download.")
-                success = True
+        # A record is "name [ttl] [class] type data".  "CNAME ." means
+        # NXDOMAIN and "CNAME *." means NODATA, both of which block the name.
+        # Anything else, e.g. "CNAME rpz-passthru.", is not a block.
+        fields = line.split()
+        if b"cname" in fields and fields[fields.index(b"cname") + 1:] in ( [b"."], [b"*."] ):
+            batch.append(fields[0])
+        #end if
+    #end for
+    
+    batch = gravity_check_domains(batch)
+    return batch, entries - len(batch)
+#end def gravity_parse_rpz(block):
+
+# The source formats we can parse, and the function that parses a block of each.
+gravity_parsers = collections.OrderedDict([
+    ( "hosts"   , gravity_parse_hosts   ),
+    ( "domains" , gravity_parse_hosts   ),
+    ( "adblock" , gravity_parse_adblock ),
+    ( "dnsmasq" , gravity_parse_dnsmasq ),
+    ( "rpz"     , gravity_parse_rpz     ),
+])
+
+def gravity_read_blocks(source_filename, block_size = 1048576):
+    """Read a file in blocks, yielding each block cut at a line break, without the final line break."""
+    with open(source_filename, 'rb') as infile:
+        carry = b""
+        while True:
+            block = infile.read(block_size)
+            data = carry + block
+            if block:
+                # Keep any partial last line for the next block.
+                cut = data.rfind(b"\n")
+                if cut < 0:
+                    carry = data
+                    continue
+                #end if
+                carry = data[cut + 1:]
+                data = data[:cut]
             else:
-                print("No previous download.")
+                # End of file.  The last line may or may not have a line break.
+                if not data: break
+                if data.endswith(b"\n"): data = data[:-1]
             #end else
             
-        #end if
+            yield data
+            
+            if not block: break
+        #end while True:
+    #end with
+#end def gravity_read_blocks(source_filename, block_size = 1048576):
+
+def gravity_read_lines(source_filename, block_size = 1048576):
+    """Read a file in blocks, yielding each block as a list of lines without line breaks."""
+    for block in gravity_read_blocks(source_filename, block_size):
+        yield block.split(b"\n")
+    #end for
+#end def gravity_read_lines(source_filename, block_size = 1048576):
+
+def gravity_write_lines(outfile, batches):
+    """Write batches of lines to outfile, adding line breaks."""
+    for batch in batches:
+        if batch: outfile.write(b"\n".join(batch) + b"\n")
+    #end for
+#end def gravity_write_lines(outfile, batches):
+
+def gravity_parsed_filename(source_filename):
+    """Turn "list.N.domain.domains" into "list.N.domain.parsed"  """
+    return os.path.splitext(source_filename)[0] + ".parsed"
+#end def gravity_parsed_filename(source_filename):
+
+def gravity_source_domains(source_files, sources_meta = None, with_source = False, report = True):
+    """Yield batches of domains from all of the source files.
+    
+    Each source's parsed domains are kept in a list.*.*.parsed file.  If
+    sources_meta shows that a source's content hash has not changed since it
+    was last parsed, then we reuse that file rather than parsing again.
+    sources_meta is updated in place.
+    
+    If with_source is True, (source file, batch) tuples are yielded instead.
+    If report is False, we don't print how many sources we parsed.
+    """
+    
+    if sources_meta is None: sources_meta = {}
+    
+    reused = 0
+    # How many sources of each format we have, and how many entries we rejected from them.
+    formats = collections.OrderedDict( (source_format, [0, 0]) for source_format in gravity_parsers )
+    for s in source_files:
+        parsed_filename = gravity_parsed_filename(s)
+        meta = sources_meta.get( os.path.basename(s) )
         
-        if success == True:
-            # Add to sources_out a 2-tuple of the source and filename.
-            sources_out.append( ( s, filename ) )
-        #end if
+        # Can we reuse our previous parse of this source?
+        unchanged = (
+            meta
+            and meta.get('sha256')
+            and meta.get('parsed_sha256') == meta['sha256']
+            and meta.get('parser_version') == gravity_parser_version
+            and meta.get('format') in gravity_parsers
+            and os.path.isfile(parsed_filename)
+        )
         
-        i = i + 1
-    #end for s in sources:
+        if unchanged:
+            reused += 1
+            for batch in gravity_read_lines(parsed_filename):
+                yield (s, batch) if with_source else batch
+            #end for
+            stats = meta
+        else:
+            stats = {}
+            with open(parsed_filename, 'wb') as parsedfile:
+                for batch in gravity_parse_source(s, stats):
+                    gravity_write_lines(parsedfile, [batch])
+                    yield (s, batch) if with_source else batch
+                #end for
+            #end with
+            # Only now is the parse complete.
+            if meta and meta.get('sha256'):
+                meta['parsed_sha256']  = meta['sha256']
+                meta['parser_version'] = gravity_parser_version
+                meta['format']         = stats['format']
+                meta['rejected']       = stats['rejected']
+            #end if
+        #end else
+        
+        formats[ stats['format'] ][0] += 1
+        formats[ stats['format'] ][1] += stats.get('rejected', 0)
+    #end for s in source_files:
     
-    return sources_out
-#end def gravity_spinup(sources : list):
+    if not report:
+        return
+    #end if
+    if reused > 0:
+        print("::: Reused the previous parse of {0} unchanged source(s).".format(reused) )
+    #end if
+    for source_format, (sources, rejected) in formats.items():
+        if sources > 0:
+            print("::: Parsed {0} {1} source(s), rejecting {2} entries.".format(sources, source_format, rejected) )
+        #end if
+    #end for
+    
+#end def gravity_source_domains(source_files, sources_meta = None, with_source = False, report = True):
 
-def gravity_advanced(source_files, destination_filename):
+def gravity_advanced(source_files, destination_filename, sources_meta = None):
     """Read all of the source files, remove all comments, and outputs just the domain."""
     
     print("::: Aggregating list of domains and formatting to remove comments...")
     
-    # This looks inefficient but runs surprisingly fast!
-    with open (destination_filename, 'wt') as outfile:
-        for s in source_files:
-            with open(s, 'rt') as infile:
-                for line in infile:
-                    # Remove any trailing comments - from the comment character to the end of the line
-                    line = line.partition('#')[0]
-                    line = line.partition('/')[0]
-                    # Remove all leading and trailing whitespace.
-                    # Note that this includes line breaks.
-                    line = line.strip()
-                    # If it's not blank at this point...
-                    if line:
-                        # If we split it, does it have more than one component?
-                        split_line = line.split()
-                        if len(split_line) >= 2:
-                            # If so then the domain has to be the second component.
-                            outfile.write(split_line[1])
-                        else:
-                            # If not then it has to be the only component.
-                            outfile.write(split_line[0])
-                        #end else
-                        # Put back in that line break.
-                        outfile.write("\n")
-                    #end if
-                #end for
-            #end with
-        #end for
+    with open (destination_filename, 'wb') as outfile:
+        gravity_write_lines( outfile, gravity_source_domains(source_files, sources_meta) )
     #end with
     
-#end def gravity_advanced(source_files, destination_filename):
+#end def gravity_advanced(source_files, destination_filename, sources_meta = None):
+
+def gravity_unique_write_run(lines, temp_dir):
+    """Write an already sorted list of lines to a new run file, and return its filename."""
+    temp_fd, run_filename = tempfile.mkstemp(dir = temp_dir, suffix = ".run")
+    with os.fdopen(temp_fd, 'wb') as f:
+        gravity_write_lines(f, [lines])
+    #end with
+    return run_filename
+#end def gravity_unique_write_run(lines, temp_dir):
+
+def gravity_unique_merge(run_filenames):
+    """Merge sorted run files, dropping duplicates, and yield batches of lines."""
+    infiles = [ open(f, 'rb') for f in run_filenames ]
+    try:
+        # Compare lines without their line break, just like sort does.
+        # Otherwise "abc\t" would sort before "abc".
+        runs = [ ( line[:-1] for line in infile ) for infile in infiles ]
+        previous = None
+        batch = []
+        for line in heapq.merge(*runs):
+            if line != previous:
+                batch.append(line)
+                previous = line
+                if len(batch) >= gravity_batch_size:
+                    yield batch
+                    batch = []
+                #end if
+            #end if
+        #end for
+        if batch: yield batch
+    finally:
+        for infile in infiles:
+            infile.close()
+        #end for
+    #end finally:
+#end def gravity_unique_merge(run_filenames):
+
+def gravity_unique_stream(batches, run_dir, memory, counts = None):
+    """Sort and remove duplicates from batches of lines, yielding batches of unique lines in order.
+    
+    This is an external merge sort: lines are gathered until they take up
+    roughly "memory" MB, then sorted and deduplicated into a run file in
+    run_dir, and the runs are finally merged with heapq.merge.  If all of
+    the lines fit into memory then no run files are written at all.  Lines
+    are compared as bytes, so the order is that of "LC_ALL=C sort -u".
+    
+    If given, counts is a dict that is filled in with the number of lines
+    "read" and "written".
+    """
+    
+    if counts is None: counts = {}
+    
+    # Python needs roughly four times the raw size of short lines once they
+    # are held in a list and a set, so gather a quarter of our memory
+    # allowance at a time.
+    run_size = max(65536, memory * 1024 * 1024 // 4)
+    # Don't hold open more than this many run files at once while merging.
+    max_open_runs = 64
+    
+    read = 0
+    written = 0
+    run_filenames = []
+    pending = []
+    pending_size = 0
+    
+    for batch in batches:
+        read += len(batch)
+        pending.extend(batch)
+        pending_size += sum( map(len, batch) ) + len(batch)
+        if pending_size >= run_size:
+            run_filenames.append( gravity_unique_write_run( sorted(set(pending)), run_dir ) )
+            pending = []
+            pending_size = 0
+        #end if
+    #end for batch in batches:
+    
+    if not run_filenames:
+        # Everything fit in memory, so there's nothing to merge.
+        lines = sorted(set(pending))
+        del pending
+        for i in range(0, len(lines), gravity_batch_size):
+            batch = lines[i:i + gravity_batch_size]
+            written += len(batch)
+            yield batch
+        #end for
+    else:
+        if pending:
+            run_filenames.append( gravity_unique_write_run( sorted(set(pending)), run_dir ) )
+        #end if
+        del pending
+        
+        # If we have too many runs, merge them in batches into bigger runs.
+        while len(run_filenames) > max_open_runs:
+            merged_filenames = []
+            for i in range(0, len(run_filenames), max_open_runs):
+                group = run_filenames[i:i + max_open_runs]
+                temp_fd, merged_filename = tempfile.mkstemp(dir = run_dir, suffix = ".run")
+                with os.fdopen(temp_fd, 'wb') as outfile:
+                    gravity_write_lines( outfile, gravity_unique_merge(group) )
+                #end with
+                for f in group: os.remove(f)
+                merged_filenames.append(merged_filename)
+            #end for
+            run_filenames = merged_filenames
+        #end while len(run_filenames) > max_open_runs:
+        
+        for batch in gravity_unique_merge(run_filenames):
+            written += len(batch)
+            yield batch
+        #end for
+    #end else
+    
+    counts['read']    = read
+    counts['written'] = written
+    
+#end def gravity_unique_stream(batches, run_dir, memory, counts = None):
+
+def gravity_unique_report(counts):
+    """Print how many duplicates gravity_unique_stream removed."""
+    print("::: Removed {0} duplicates from {1} domains, leaving {2}.".format(
+            counts['read'] - counts['written'], counts['read'], counts['written'] ) )
+#end def gravity_unique_report(counts):
 
-def gravity_unique( source_filename, destination_filename ):
-    """Sort and remove duplicates."""
+def gravity_unique( source_filename, destination_filename, memory = None, temp_dir = None ):
+    """Sort and remove duplicates.  Returns a 2-tuple of the number of lines read and written.
+    
+    The output is identical to "LC_ALL=C sort -u", but memory use is bounded
+    by "memory" MB.  See gravity_unique_stream.
+    """
     print("::: Removing duplicate domains....")
-    # The 'sort' binary still seems the best way to do this.
-    cmd = 'sort -u "{0}" > "{1}"'.format(source_filename, destination_filename)
-    os.system(cmd)
     
-#end def gravity_unique( infile, outfile ):
+    if memory is None: memory = unique_memory
+    if temp_dir is None: temp_dir = unique_temp_dir
+    
+    counts = {}
+    with tempfile.TemporaryDirectory(dir = temp_dir) as run_dir, open(destination_filename, 'wb') as outfile:
+        lines = gravity_read_lines(source_filename)
+        gravity_write_lines( outfile, gravity_unique_stream(lines, run_dir, memory, counts) )
+    #end with
+    
+    gravity_unique_report(counts)
+    
+    return counts['read'], counts['written']
+#end def gravity_unique( source_filename, destination_filename, memory = None, temp_dir = None ):
 
 def domain_hostformat(addr, domain):
     """Turn "domain" into "192.168.x.y domain"  """
@@ -434,28 +1341,739 @@ def gravity_hostformat( source_filename, destination_filename, ipv4_addr = None,
         # Add a dummy record to the start
         dummy = ""
         if ipv4_addr:
-            dummy += domain_hostformat(ipv4_addr, "pyhole.isworking.ok")
+            dummy += " " + domain_hostformat(ipv4_addr, "pyhole.isworking.ok")
+            dummy += "\n"
+        #end if
+        if ipv6_addr:
+            dummy += " " + domain_hostformat(ipv6_addr, "pyhole.isworking.ok")
             dummy += "\n"
         #end if
-        if ipv6_addr:
-            dummy += domain_hostformat(ipv6_addr, "pyhole.isworking.ok")
-            dummy += "\n"
+        outfile.write(dummy)
+        for line in infile:
+            # Note that we don't need /n here as it's already included.
+            # Each line starts with a space, which whitelisting swaps for a
+            # hash - see gravity_hosts_lines.
+            if ipv4_addr:
+                outfile.write( " " + domain_hostformat(ipv4_addr, line) )
+            #end if
+            if ipv6_addr:
+                outfile.write( " " + domain_hostformat(ipv6_addr, line) )
+            #end if
+        #end for
+    #end with
+#end def gravity_hostformat( source_filename, destination_filename ):
+
+class gravity_index_writer:
+    """Write gravity.hosts.index - the byte offset in gravity.hosts of each domain, in domain order."""
+    
+    def __init__(self, index_filename):
+        # Replace what gravity.hosts.index links to, not the link itself.
+        self.index_filename = index_filename = os.path.realpath(index_filename)
+        temp_fd, self.temp_file = tempfile.mkstemp(
+                                                    dir    = os.path.dirname(index_filename),
+                                                    prefix = os.path.basename(index_filename) + ".",
+                                                    suffix = ".tmp"
+                                                  )
+        self.f = os.fdopen(temp_fd, 'wb')
+        # We fill in the header once we know what goes in it.
+        self.f.write( b"\0" * gravity_index_header.size )
+        self.count = 0
+    #end def __init__(self, index_filename):
+    
+    def add(self, offsets):
+        """Add an array('Q') of offsets."""
+        offsets.tofile(self.f)
+        self.count += len(offsets)
+    #end def add(self, offsets):
+    
+    def close(self, hosts_size):
+        """Finish the index for a gravity.hosts of hosts_size bytes and move it into place."""
+        self.f.seek(0)
+        self.f.write( gravity_index_header.pack(gravity_index_magic, hosts_size, self.count) )
+        self.f.close()
+        os.chmod(self.temp_file, 0o644)
+        os.replace(self.temp_file, self.index_filename)
+    #end def close(self, hosts_size):
+    
+    def abort(self):
+        """Throw the index away."""
+        self.f.close()
+        try:
+            os.remove(self.temp_file)
+        except FileNotFoundError:
+            pass
+        #end except
+    #end def abort(self):
+    
+#end class gravity_index_writer:
+
+def gravity_hosts_build_index(hosts_filename = None, index_filename = None):
+    """Scan a hosts file and write its index.  Returns False and removes any index if it can't be indexed.
+    
+    Only files written by gravity can be indexed: every line must start with
+    a space or a hash, and the domains must be in sorted order (apart from
+    the pyhole.isworking.ok dummy record at the start).
+    """
+    if hosts_filename is None: hosts_filename = gravity_hosts
+    if index_filename is None: index_filename = gravity_hosts_index
+    
+    writer = gravity_index_writer(index_filename)
+    offsets = array.array('Q')
+    offset = 0
+    previous = None
+    indexable = True
+    with open(hosts_filename, 'rb') as infile:
+        for line in infile:
+            split_line = line.split()
+            if line[:1] not in (b" ", b"#") or len(split_line) < 2:
+                indexable = False
+                break
+            #end if
+            domain = split_line[1]
+            
+            if previous is None and domain == b"pyhole.isworking.ok":
+                # Skip the dummy record.
+                pass
+            elif previous is None or domain > previous:
+                offsets.append(offset)
+                previous = domain
+            elif domain < previous:
+                indexable = False
+                break
+            #end elif
+            
+            offset += len(line)
+        #end for
+    #end with
+    
+    if indexable:
+        writer.add(offsets)
+        writer.close(offset)
+    else:
+        writer.abort()
+        try:
+            os.remove(index_filename)
+        except FileNotFoundError:
+            pass
+        #end except
+    #end else
+    
+    return indexable
+#end def gravity_hosts_build_index(hosts_filename = None, index_filename = None):
+
+def gravity_hosts_lines(domains, addrs, whitelist):
+    """Turn a batch of domains into hosts file lines for each address, commenting out whitelisted domains."""
+    # Every line starts with either a space or, if whitelisted, a hash.
+    # dnsmasq skips the leading space, and as both are one byte long
+    # whitelisting can be done in place - see gravity_hosts_patch.
+    lines = []
+    for domain in domains:
+        if domain in whitelist:
+            lines.extend( b"#" + addr + domain + b"\n" for addr in addrs )
+        else:
+            lines.extend( b" " + addr + domain + b"\n" for addr in addrs )
+        #end else
+    #end for
+    return lines
+#end def gravity_hosts_lines(domains, addrs, whitelist):
+
+def gravity_fused( source_files, destination_filename, sources_meta = None, ipv4_addr = None, ipv6_addr = None ):
+    """Parse, deduplicate, whitelist and hostformat all of the sources in a single pass.
+    
+    This produces exactly the same hosts file as gravity_advanced,
+    gravity_unique, gravity_hostformat and gravity_hosts_add_whitelist, but
+    streams the domains from one stage to the next rather than writing each
+    stage to disk.  The result is written to a temp file alongside
+    destination_filename and renamed into place, so readers only ever see
+    the old or the new file.
+    """
+    print("::: Aggregating, deduplicating and formatting domains into a HOSTS file...")
+    
+    # Replace what gravity.hosts links to, not the link itself.
+    destination_filename = os.path.realpath(destination_filename)
+    
+    whitelist = domain_matcher( domain.encode() for domain in read_list(whitelist_file) )
+    
+    # Our "192.168.x.y " prefixes.
+    addrs = [ addr.encode() + b" " for addr in (ipv4_addr, ipv6_addr) if addr ]
+    
+    temp_fd, temp_file = tempfile.mkstemp(
+                                            dir    = os.path.dirname(destination_filename),
+                                            prefix = os.path.basename(destination_filename) + ".",
+                                            suffix = ".tmp"
+                                         )
+    # We build gravity.hosts.index as we go.
+    index = gravity_index_writer(destination_filename + ".index")
+    # Each domain takes one line per address, and each line is a space or
+    # hash, the address and space, the domain and a line break.
+    addrs_size = sum( len(addr) + 2 for addr in addrs )
+    
+    counts = {}
+    try:
+        with tempfile.TemporaryDirectory(dir = unique_temp_dir) as run_dir, os.fdopen(temp_fd, 'wb') as outfile:
+            # Add a dummy record to the start
+            outfile.writelines( gravity_hosts_lines( [b"pyhole.isworking.ok"], addrs, whitelist ) )
+            offset = outfile.tell()
+            
+            domains = gravity_source_domains(source_files, sources_meta)
+            for batch in gravity_unique_stream(domains, run_dir, unique_memory, counts):
+                outfile.writelines( gravity_hosts_lines(batch, addrs, whitelist) )
+                
+                if addrs:
+                    offsets = array.array('Q')
+                    for domain in batch:
+                        offsets.append(offset)
+                        offset += addrs_size + len(addrs) * len(domain)
+                    #end for
+                    index.add(offsets)
+                #end if
+            #end for
+        #end with
+        
+        # mkstemp files are only readable by us, but dnsmasq needs to read this.
+        os.chmod(temp_file, 0o644)
+        os.replace(temp_file, destination_filename)
+        index.close( os.path.getsize(destination_filename) )
+    except:
+        index.abort()
+        raise
+    finally:
+        # Delete the temporary file, if we haven't renamed it into place.
+        try:
+            os.remove(temp_file)
+        except FileNotFoundError:
+            pass
+        #end except
+    #end finally:
+    
+    gravity_unique_report(counts)
+    
+#end def gravity_fused( source_files, destination_filename, sources_meta = None, ipv4_addr = None, ipv6_addr = None ):
+
+def gravity_dnsmasq_key(domain):
+    """Turn b"ads.example.com" into b"com\\texample\\tads", which sorts each domain straight before its subdomains."""
+    # A tab sorts before every character a domain can have, so nothing can
+    # come between "com\texample" and "com\texample\tads" - not even
+    # "com\texample-ads".
+    return b"\t".join( domain.split(b".")[::-1] )
+#end def gravity_dnsmasq_key(domain):
+
+def gravity_dnsmasq_lines(keys, allowed, counts, prune = True):
+    """Turn sorted batches of blocked domain keys into batches of dnsmasq servers-file lines.
+    
+    Each key is followed by a NUL and the source it came from, and the same
+    domain may come from several sources.
+    
+    "server=/example.com/" answers example.com and all of its subdomains
+    locally, i.e. NXDOMAIN for both IPv4 and IPv6, so if prune is True any
+    blocked domain under an already blocked domain is pruned.  allowed is a
+    sorted list of whitelisted domain keys; any that are under a blocked
+    domain get "server=/example.com/#", which forwards them as normal.
+    
+    The sorted keys are a depth first walk of the label trie of the domains,
+    so the blocked and allowed domains that enclose the current one are
+    always on our stack.  counts is filled in with the number of "domains",
+    "entries", "pruned" subdomains and whitelist "exceptions", and
+    "pruned_sources", a Counter of how many pruned domains each source had.
+    """
+    
+    domains = entries = pruned = exceptions = 0
+    pruned_sources = collections.Counter()
+    # (key followed by a tab, whether it's blocked) for each enclosing domain.
+    stack = []
+    allowed = iter(allowed)
+    next_allowed = next(allowed, None)
+    # The previous domain, and whether it was pruned.
+    previous = None
+    previous_pruned = False
+    
+    def enclosed(key):
+        """Pop the stack down to the domains enclosing key, and return whether the nearest is blocked."""
+        while stack and not key.startswith(stack[-1][0]): stack.pop()
+        return stack[-1][1] if stack else False
+    #end def enclosed(key):
+    
+    for batch in keys:
+        lines = []
+        for key in batch:
+            key, _, source = key.partition(b"\0")
+            if key == previous:
+                # The same domain, from another source.
+                if previous_pruned: pruned_sources[source] += 1
+                continue
+            #end if
+            previous = key
+            previous_pruned = False
+            domains += 1
+            
+            # Whitelisted domains go first, and win over a blocked domain with the same key.
+            skip = False
+            while next_allowed is not None and next_allowed <= key:
+                if enclosed(next_allowed):
+                    lines.append( b"server=/" + b".".join( next_allowed.split(b"\t")[::-1] ) + b"/#\n" )
+                    stack.append( (next_allowed + b"\t", False) )
+                    exceptions += 1
+                #end if
+                skip = skip or next_allowed == key
+                next_allowed = next(allowed, None)
+            #end while
+            if skip: continue
+            
+            if enclosed(key) and prune:
+                pruned += 1
+                pruned_sources[source] += 1
+                previous_pruned = True
+            else:
+                lines.append( b"server=/" + b".".join( key.split(b"\t")[::-1] ) + b"/\n" )
+                stack.append( (key + b"\t", True) )
+                entries += 1
+            #end else
+        #end for key in batch:
+        yield lines
+    #end for batch in keys:
+    
+    counts['domains']        = domains
+    counts['entries']        = entries
+    counts['pruned']         = pruned
+    counts['exceptions']     = exceptions
+    counts['pruned_sources'] = pruned_sources
+    
+#end def gravity_dnsmasq_lines(keys, allowed, counts, prune = True):
+
+def gravity_dnsmasq( source_files, destination_filename, sources_meta = None ):
+    """Parse, deduplicate, whitelist and prune all of the sources into a dnsmasq servers-file.
+    
+    Rather than a hosts line per domain per address, this writes one
+    "server=/example.com/" line per domain, leaving out any subdomains of
+    domains that are already blocked if gravity_prune is True - see
+    gravity_dnsmasq_lines.  Like gravity_fused, the file is built alongside
+    destination_filename and renamed into place.
+    """
+    print("::: Aggregating, deduplicating and pruning domains into a dnsmasq servers file...")
+    
+    whitelist_domains = [ domain.encode() for domain in read_list(whitelist_file) ]
+    whitelist = domain_matcher(whitelist_domains)
+    # dnsmasq can't whitelist the subdomains of a domain without also
+    # whitelisting the domain itself, so "*.example.com" allows example.com too.
+    allowed = sorted( gravity_dnsmasq_key( domain[2:] if domain.startswith(b"*.") else domain ) for domain in whitelist_domains )
+    
+    # Replace what gravity.conf links to, not the link itself.
+    destination_filename = os.path.realpath(destination_filename)
+    
+    temp_fd, temp_file = tempfile.mkstemp(
+                                            dir    = os.path.dirname(destination_filename),
+                                            prefix = os.path.basename(destination_filename) + ".",
+                                            suffix = ".tmp"
+                                         )
+    
+    # Each key is tagged with the number of its source, so that we can tell
+    # which sources the pruned domains came from.
+    source_numbers = {}
+    def tagged_keys():
+        for source, batch in gravity_source_domains(source_files, sources_meta, with_source = True):
+            tag = b"\0" + str( source_numbers.setdefault(source, len(source_numbers)) ).encode()
+            yield [ gravity_dnsmasq_key(domain) + tag for domain in batch if domain not in whitelist ]
+        #end for
+    #end def tagged_keys():
+    
+    counts = {}
+    dnsmasq_counts = {}
+    try:
+        with tempfile.TemporaryDirectory(dir = unique_temp_dir) as run_dir, os.fdopen(temp_fd, 'wb') as outfile:
+            keys = gravity_unique_stream(tagged_keys(), run_dir, unique_memory, counts)
+            for lines in gravity_dnsmasq_lines(keys, allowed, dnsmasq_counts, gravity_prune):
+                outfile.writelines(lines)
+            #end for
+        #end with
+        
+        # mkstemp files are only readable by us, but dnsmasq needs to read this.
+        os.chmod(temp_file, 0o644)
+        os.replace(temp_file, destination_filename)
+    finally:
+        # Delete the temporary file, if we haven't renamed it into place.
+        try:
+            os.remove(temp_file)
+        except FileNotFoundError:
+            pass
+        #end except
+    #end finally:
+    
+    # The same domain from two sources is two keys, so count the domains instead.
+    gravity_unique_report( { 'read' : counts['read'], 'written' : dnsmasq_counts['domains'] } )
+    
+    # How many lines gravity.hosts would have needed for the same domains.
+    addresses = len([ addr for addr in (ipv4_addr, ipv6_addr) if addr ]) or 1
+    print("::: {0} domain(s) need {1} dnsmasq entries rather than {2} hosts lines.".format(dnsmasq_counts['domains'], dnsmasq_counts['entries'], dnsmasq_counts['domains'] * addresses) )
+    print("::: Pruned {0} subdomain(s) of blocked domains, and added {1} whitelist exception(s).".format(dnsmasq_counts['pruned'], dnsmasq_counts['exceptions']) )
+    for source, number in source_numbers.items():
+        pruned = dnsmasq_counts['pruned_sources'][ str(number).encode() ]
+        if pruned > 0:
+            print(":::     {0} of them from {1}".format(pruned, os.path.basename(source)) )
+        #end if
+    #end for
+    
+#end def gravity_dnsmasq( source_files, destination_filename, sources_meta = None ):
+
+def gravity_domain_table(source_files, destination_filename, sources_meta = None):
+    """Write gravity.domains: every domain in the sources, and which of the sources list it.
+    
+    The layout of the file is described in domaintable, which reads it.
+    Whitelisting isn't applied, so that pyhole-query can tell whether a
+    whitelisted domain would otherwise be blocked.
+    """
+    print("::: Indexing domains and their sources for pyhole-query...")
+    
+    if sources_meta is None: sources_meta = {}
+    
+    # Replace what gravity.domains links to, not the link itself.
+    destination_filename = os.path.realpath(destination_filename)
+    
+    names = [ sources_meta.get( os.path.basename(s), {} ).get('url') or os.path.basename(s) for s in source_files ]
+    sources_json = json.dumps(names).encode()
+    mask_size = max( 1, (len(source_files) + 7) // 8 )
+    
+    # Each domain is tagged with the number of its source, so that the
+    # sorted domains come out grouped with all of their sources together.
+    source_numbers = { s : str(i).encode() for i, s in enumerate(source_files) }
+    def tagged_domains():
+        for source, batch in gravity_source_domains(source_files, sources_meta, with_source = True, report = False):
+            tag = b"\0" + source_numbers[source]
+            yield [ domain + tag for domain in batch ]
+        #end for
+    #end def tagged_domains():
+    
+    temp_fd, temp_file = tempfile.mkstemp(
+                                            dir    = os.path.dirname(destination_filename),
+                                            prefix = os.path.basename(destination_filename) + ".",
+                                            suffix = ".tmp"
+                                         )
+    offsets  = array.array('Q', [0])
+    hashes   = array.array('I')
+    masks    = bytearray()
+    suffixes = array.array('I')
+    try:
+        with tempfile.TemporaryDirectory(dir = unique_temp_dir) as run_dir, os.fdopen(temp_fd, 'wb') as outfile:
+            # The domains go last, but we only know how many there are once
+            # we've seen them all, so they wait in a temp file.  So do the
+            # reversed domains, each tagged with its row, to be sorted again
+            # for the suffixes.
+            reversed_filename = os.path.join(run_dir, 'reversed')
+            with tempfile.TemporaryFile(dir = run_dir) as domains:
+                with open(reversed_filename, 'wb') as reversed_domains:
+                    previous = None
+                    mask = 0
+                    for batch in gravity_unique_stream(tagged_domains(), run_dir, unique_memory):
+                        new_domains = []
+                        for entry in batch:
+                            domain, _, number = entry.partition(b"\0")
+                            if domain != previous:
+                                if previous is not None:
+                                    masks += mask.to_bytes(mask_size, 'little')
+                                #end if
+                                new_domains.append(domain)
+                                offsets.append( offsets[-1] + len(domain) )
+                                hashes.append( zlib.crc32(domain) )
+                                previous = domain
+                                mask = 0
+                            #end if
+                            mask |= 1 << int(number)
+                        #end for entry in batch:
+                        if not new_domains: continue
+                        domains.write( b"".join(new_domains) )
+                        row = len(hashes) - len(new_domains)
+                        gravity_write_lines( reversed_domains, [[ domain[::-1] + b"\0" + str(row + i).encode() for i, domain in enumerate(new_domains) ]] )
+                    #end for batch in gravity_unique_stream(...):
+                #end with
+                if previous is not None:
+                    masks += mask.to_bytes(mask_size, 'little')
+                #end if
+                
+                # At least twice as many slots as domains keeps the runs short.
+                count = len(hashes)
+                slot_count = 1
+                while slot_count < 2 * count: slot_count *= 2
+                slots = array.array('I', bytes(4 * slot_count))
+                for row, h in enumerate(hashes, 1):
+                    # As domaintable.table_slot.
+                    slot = h & (slot_count - 1)
+                    while slots[slot]:
+                        slot = (slot + 1) & (slot_count - 1)
+                    #end while
+                    slots[slot] = row
+                #end for
+                del hashes
+                
+                # The rows in order of their reversed domains.
+                for batch in gravity_unique_stream( gravity_read_lines(reversed_filename), run_dir, unique_memory ):
+                    suffixes.extend( int( entry.rpartition(b"\0")[2] ) for entry in batch )
+                #end for
+                
+                layout = domaintable.table_layout(count, mask_size, slot_count, len(sources_json))
+                outfile.write( domaintable.table_header.pack(domaintable.table_magic, count, mask_size, slot_count, len(sources_json)) )
+                for position, data in zip(layout, (offsets, slots, suffixes, masks, sources_json, b"")):
+                    # Pad up to the start of the next section.
+                    outfile.write( b"\0" * (position - outfile.tell()) )
+                    outfile.write(data)
+                #end for
+                domains.seek(0)
+                shutil.copyfileobj(domains, outfile)
+            #end with
+        #end with
+        
+        # mkstemp files are only readable by us, but pyhole-query may be run by anyone.
+        os.chmod(temp_file, 0o644)
+        os.replace(temp_file, destination_filename)
+    finally:
+        # Delete the temporary file, if we haven't renamed it into place.
+        try:
+            os.remove(temp_file)
+        except FileNotFoundError:
+            pass
+        #end except
+    #end finally:
+    
+    print("::: Indexed {0} domain(s) from {1} source(s).".format(count, len(source_files)) )
+    
+#end def gravity_domain_table(source_files, destination_filename, sources_meta = None):
+
+def gravity_placeholder(output, hosts_filename, conf_filename):
+    """Write an empty version of whichever of gravity.hosts and gravity.conf the given output doesn't use.
+    
+    dnsmasq reads both files whatever the output, so both have to exist.
+    """
+    if output == "dnsmasq":
+        # Just the dummy record.
+        addrs = [ addr.encode() + b" " for addr in (ipv4_addr, ipv6_addr) if addr ]
+        with open(hosts_filename, 'wb') as f:
+            f.writelines( gravity_hosts_lines( [b"pyhole.isworking.ok"], addrs, domain_matcher() ) )
+        #end with
+        gravity_hosts_build_index(hosts_filename, hosts_filename + ".index")
+    else:
+        open(conf_filename, 'wt').close()
+    #end else
+#end def gravity_placeholder(output, hosts_filename, conf_filename):
+
+def gravity_generations():
+    """Return the numbers of the gravity.<generation> directories, oldest first."""
+    generations = []
+    for path in glob.glob( os.path.join(var_dir, 'gravity.*') ):
+        suffix = path.rsplit('.', 1)[1]
+        if suffix.isdigit() and os.path.isdir(path):
+            generations.append( int(suffix) )
+        #end if
+    #end for
+    return sorted(generations)
+#end def gravity_generations():
+
+def gravity_generation_dir(generation):
+    """Return the directory a generation of gravity is built in."""
+    return os.path.join(var_dir, 'gravity.{0}'.format(generation) )
+#end def gravity_generation_dir(generation):
+
+def gravity_current_generation():
+    """Return the generation gravity.current links to, or None if there isn't one."""
+    try:
+        suffix = os.readlink(gravity_current).rsplit('.', 1)[-1]
+    except OSError:
+        return None
+    #end except
+    return int(suffix) if suffix.isdigit() else None
+#end def gravity_current_generation():
+
+def gravity_symlink(target, link_name):
+    """Point link_name at target, replacing whatever file or link was there in one step."""
+    temp_link = "{0}.{1}.tmp".format(link_name, os.getpid())
+    try:
+        os.remove(temp_link)
+    except FileNotFoundError:
+        pass
+    #end except
+    os.symlink(target, temp_link)
+    os.replace(temp_link, link_name)
+#end def gravity_symlink(target, link_name):
+
+def gravity_switch(generation):
+    """Make generation the one dnsmasq and the admin pages use.
+    
+    Only gravity.current changes, so anything opening gravity.hosts or
+    gravity.conf sees either all of the old generation or all of the new one.
+    """
+    gravity_symlink( os.path.basename( gravity_generation_dir(generation) ), gravity_current )
+    
+    # The first time round, replace the files from before generations with
+    # links into gravity.current.
+    for filename in (gravity_hosts, gravity_hosts_index, gravity_conf, gravity_domains):
+        target = os.path.relpath( os.path.join( gravity_current, os.path.basename(filename) ), os.path.dirname(filename) )
+        if not os.path.islink(filename) or os.readlink(filename) != target:
+            gravity_symlink(target, filename)
+        #end if
+    #end for
+#end def gravity_switch(generation):
+
+def gravity_prune_generations(keep):
+    """Delete all but the newest keep generations, and never the one in use."""
+    current = gravity_current_generation()
+    for generation in gravity_generations()[:-keep]:
+        if generation != current:
+            shutil.rmtree( gravity_generation_dir(generation) )
         #end if
-        outfile.write(dummy)
-        for line in infile:
-            # Note that we don't need /n here as it's already included.
-            if ipv4_addr:
-                outfile.write( domain_hostformat(ipv4_addr, line) )
+    #end for
+#end def gravity_prune_generations(keep):
+
+def gravity_generation_files(directory):
+    """Return the [size, mtime] of a generation's gravity.hosts and gravity.conf, keyed by name."""
+    files = {}
+    for filename in (gravity_hosts, gravity_conf):
+        name = os.path.basename(filename)
+        stat = os.stat( os.path.join(directory, name) )
+        files[name] = [ stat.st_size, stat.st_mtime_ns ]
+    #end for
+    return files
+#end def gravity_generation_files(directory):
+
+def gravity_generation_digest(directory):
+    """Return the sha256 of a generation's gravity.hosts and gravity.conf."""
+    sha256 = hashlib.sha256()
+    for filename in (gravity_hosts, gravity_conf):
+        name = os.path.basename(filename)
+        sha256.update( name.encode() + b"\0" )
+        with open( os.path.join(directory, name), 'rb' ) as f:
+            for block in iter( lambda: f.read(1048576), b"" ):
+                sha256.update(block)
+            #end for
+        #end with
+    #end for
+    return sha256.hexdigest()
+#end def gravity_generation_digest(directory):
+
+def gravity_hosts_entries(hosts_filename):
+    """Yield each domain a gravity.hosts blocks, in order.  Raises ValueError if they aren't sorted."""
+    previous = b""
+    for lines in gravity_read_lines(hosts_filename):
+        for line in lines:
+            # Whitelisted lines start with a hash.
+            if line[:1] != b" ": continue
+            domain = line[ line.rfind(b" ") + 1: ]
+            # There is a line per address, and a dummy record at the start.
+            if domain == previous or domain == b"pyhole.isworking.ok": continue
+            if domain < previous:
+                raise ValueError("{0} is not sorted".format(hosts_filename) )
             #end if
-            if ipv6_addr:
-                outfile.write( domain_hostformat(ipv6_addr, line) )
+            previous = domain
+            yield domain
+        #end for
+    #end for
+#end def gravity_hosts_entries(hosts_filename):
+
+def gravity_conf_entries(conf_filename):
+    """Yield each domain a gravity.conf blocks or excepts, as gravity_dnsmasq_key keys in order.  Raises ValueError if they aren't sorted."""
+    previous = b""
+    for lines in gravity_read_lines(conf_filename):
+        for line in lines:
+            if not line.startswith(b"server=/"): continue
+            domain, _, exception = line[8:].rpartition(b"/")
+            key = gravity_dnsmasq_key(domain)
+            # A whitelist exception sorts where the domain would.
+            if exception: key += b"\0" + exception
+            if key < previous:
+                raise ValueError("{0} is not sorted".format(conf_filename) )
             #end if
+            previous = key
+            yield key
         #end for
+    #end for
+#end def gravity_conf_entries(conf_filename):
+
+def gravity_diff(old_entries, new_entries):
+    """Count the entries added and removed between two sorted iterables, by merging them."""
+    added = removed = 0
+    old_entries = iter(old_entries)
+    new_entries = iter(new_entries)
+    old = next(old_entries, None)
+    new = next(new_entries, None)
+    while old is not None and new is not None:
+        if old == new:
+            old = next(old_entries, None)
+            new = next(new_entries, None)
+        elif old < new:
+            removed += 1
+            old = next(old_entries, None)
+        else:
+            added += 1
+            new = next(new_entries, None)
+        #end else
+    #end while
+    if old is not None: removed += 1 + sum( 1 for entry in old_entries )
+    if new is not None: added   += 1 + sum( 1 for entry in new_entries )
+    return added, removed
+#end def gravity_diff(old_entries, new_entries):
+
+def gravity_read_build(directory):
+    """Read what gravity_compare_generations stored for a generation, or None."""
+    try:
+        with open( os.path.join(directory, gravity_build_file), 'rt' ) as f:
+            return json.load(f)
+        #end with
+    except (OSError, ValueError):
+        return None
+    #end except
+#end def gravity_read_build(directory):
+
+def gravity_compare_generations(directory, previous_directory = None):
+    """Digest a new generation and diff it against the previous one, storing the result with it and returning it.
+    
+    The returned dict has the "digest", and the "added" and "removed" counts
+    of blocked domains (None if they couldn't be counted).  "changed" is
+    False only if both generations have exactly the same content, in which
+    case dnsmasq has nothing to reload.
+    """
+    build = {
+                'digest'  : gravity_generation_digest(directory),
+                'files'   : gravity_generation_files(directory),
+                'changed' : True,
+                'added'   : None,
+                'removed' : None,
+            }
+    
+    if previous_directory is not None:
+        previous = gravity_read_build(previous_directory)
+        if previous is None or previous.get('files') != gravity_generation_files(previous_directory):
+            # Missing, or the whitelist has changed the files since.
+            previous = { 'digest' : gravity_generation_digest(previous_directory) }
+        #end if
+        
+        if previous['digest'] == build['digest']:
+            build.update( changed = False, added = 0, removed = 0 )
+        else:
+            added = removed = 0
+            try:
+                for filename, entries in ( (gravity_hosts, gravity_hosts_entries), (gravity_conf, gravity_conf_entries) ):
+                    name = os.path.basename(filename)
+                    counts = gravity_diff( entries( os.path.join(previous_directory, name) ), entries( os.path.join(directory, name) ) )
+                    added   += counts[0]
+                    removed += counts[1]
+                #end for
+                build.update( added = added, removed = removed )
+            except (OSError, ValueError):
+                # Not written by this version of gravity, so we can't tell.
+                pass
+            #end except
+        #end else
+    #end if previous_directory is not None:
+    
+    with open( os.path.join(directory, gravity_build_file), 'wt' ) as f:
+        json.dump(build, f, indent = 4, sort_keys = True)
     #end with
-#end def gravity_hostformat( source_filename, destination_filename ):
+    return build
+#end def gravity_compare_generations(directory, previous_directory = None):
+
+def gravity_downloaded_sources():
+    """Return the list.*.*.domains files from our last gravity run."""
+    return sorted( glob.glob( os.path.join(var_dir, 'list.*.*.domains') ) )
+#end def gravity_downloaded_sources():
 
 def gravity_blackbody( dir, source_files ):
-    """Delete all list.*.*.domains files are not in our source_files list, and any pyhole.* files."""
+    """Delete all list.*.*.domains and list.*.*.parsed files that are not for our source_files list."""
     glob_string = os.path.join(dir, 'list.*.*.domains')
     files = glob.glob(glob_string)
     for f in files:
@@ -463,13 +2081,23 @@ def gravity_blackbody( dir, source_files ):
             os.remove(f)
         #end if
     #end for
+    
+    parsed_files = [ gravity_parsed_filename(f) for f in source_files ]
+    glob_string = os.path.join(dir, 'list.*.*.parsed')
+    files = glob.glob(glob_string)
+    for f in files:
+        if not f in parsed_files:
+            os.remove(f)
+        #end if
+    #end for
 #end def gravity_blackbody( dir, source_files )
 
 def gravity_resetpermissions():
     """If we have been running as root, we may need to chown files in /var/lib/pyhole to pyhole:pyhole."""
     
-    path = os.path.join(var_dir, "*")
-    for file in glob.glob(path):
+    # Including the files in each gravity.<generation> directory.
+    files = glob.glob( os.path.join(var_dir, "*") ) + glob.glob( os.path.join(var_dir, "gravity.*", "*") )
+    for file in files:
         # If we are running as root then these commands should work fine.
         # If not then they will fail, but in that case we are almost certainly
         # running as pyhole, in which case the files will already have correct
@@ -489,7 +2117,44 @@ def gravity_reload():
     os.system("sudo --non-interactive /usr/bin/pyhole-reloadservices")
 #end def gravity_reload():
 
-def pyhole_gravity():
+def gravity_build(pipeline, source_files, sources_meta, hosts_filename, conf_filename, p_supernova, p_eventhorizon, p_accretiondisc):
+    """Build gravity.hosts and gravity.conf for one generation, whitelist included - see pyhole_gravity."""
+    if gravity_output == "dnsmasq":
+        # Block domains and their subdomains with gravity.conf rather than gravity.hosts.
+        gravity_dnsmasq(source_files, conf_filename, sources_meta)
+    elif pipeline == "staged":
+        # Read all of the source files, remove all comments,
+        # and for now just keep the domain names.
+        gravity_advanced(source_files, p_supernova, sources_meta)
+        # Sort and remove duplicates
+        gravity_unique(p_supernova, p_eventhorizon)
+        # Re-add the IPs to make a hosts file.
+        gravity_hostformat(p_eventhorizon, p_accretiondisc, ipv4_addr, ipv6_addr)
+
+        # Copy this file to the final location.
+        shutil.copyfile(p_accretiondisc, hosts_filename)
+        gravity_hosts_build_index(hosts_filename, hosts_filename + ".index")
+        
+        # Comment out any domains in whitelist.txt, before dnsmasq ever sees this generation.
+        print("::: Commenting out whitelisted domains in gravity.hosts file....")
+        gravity_hosts_add_whitelist(hosts_filename = hosts_filename)
+    else:
+        # All of the above, plus whitelisting, straight into gravity.hosts.
+        gravity_fused(source_files, hosts_filename, sources_meta, ipv4_addr, ipv6_addr)
+    #end else
+    gravity_placeholder(gravity_output, hosts_filename, conf_filename)
+    
+    # Which sources list each domain, for pyhole-query.
+    gravity_domain_table( source_files, os.path.join( os.path.dirname(hosts_filename), os.path.basename(gravity_domains) ), sources_meta )
+#end def gravity_build(pipeline, source_files, sources_meta, hosts_filename, conf_filename, p_supernova, p_eventhorizon, p_accretiondisc):
+
+def pyhole_gravity(pipeline = None):
+    """Download, aggregate and install our adlists.
+    
+    pipeline is "fused" or "staged" - see gravity_pipeline.
+    """
+    
+    if pipeline is None: pipeline = gravity_pipeline
 
     # Variables for various stages of downloading and formatting the list
     # Trying to keep with the original Pi-Hole here...
@@ -524,56 +2189,204 @@ def pyhole_gravity():
     # Get our sources
     sources = gravity_collapse(adlists_file_using)
 
+    # What we know about our previous downloads, for conditional requests.
+    sources_meta = read_sources_meta()
+
     # Download our sources.  sources_out is a list of 2-tuples with URLs and filenames.
-    sources_downloaded = gravity_spinup(sources)
+    sources_downloaded = gravity_spinup(sources, sources_meta)
     # Split the tuple just into a list of filenames
     source_files = [ x[1] for x in sources_downloaded ]
 
-    # Read all of the source files, remove all comments,
-    # and for now just keep the domain names.
-    gravity_advanced(source_files, p_supernova)
-    # Sort and remove duplicates
-    gravity_unique(p_supernova, p_eventhorizon)
-    # Re-add the IPs to make a hosts file.
-    gravity_hostformat(p_eventhorizon, p_accretiondisc, ipv4_addr, ipv6_addr)
-
-    # Copy this file to the final location.
-    shutil.copyfile(p_accretiondisc, gravity_hosts)
+    # Build everything into a new generation, leaving the one dnsmasq is
+    # using alone until the new one is complete.
+    generation = max( gravity_generations() + [ gravity_current_generation() or 0 ] ) + 1
+    generation_dir = gravity_generation_dir(generation)
+    os.mkdir(generation_dir)
+    hosts_filename = os.path.join( generation_dir, os.path.basename(gravity_hosts) )
+    conf_filename  = os.path.join( generation_dir, os.path.basename(gravity_conf ) )
+    try:
+        gravity_build(pipeline, source_files, sources_meta, hosts_filename, conf_filename, p_supernova, p_eventhorizon, p_accretiondisc)
+    except:
+        # Don't leave a half built generation around to be rolled back to.
+        shutil.rmtree(generation_dir, ignore_errors = True)
+        raise
+    #end except
+    
+    # Compare it with the generation in use.  If nothing has changed there's
+    # no point making dnsmasq reload (and so drop its cache).
+    current = gravity_current_generation()
+    current_dir = gravity_generation_dir(current) if current is not None else None
+    if current_dir is not None and not os.path.isdir(current_dir): current_dir = None
+    build = gravity_compare_generations(generation_dir, current_dir)
+    if build['changed']:
+        if current_dir is None:
+            print("::: Built gravity generation {0}, digest {1}.".format(generation, build['digest'][:16]) )
+        elif build['added'] is None:
+            print("::: Gravity generation {0} differs from generation {1}, digest {2}.".format(generation, current, build['digest'][:16]) )
+        else:
+            print("::: Gravity generation {0} adds {1} and removes {2} domain(s) from generation {3}, digest {4}.".format(
+                                generation, build['added'], build['removed'], current, build['digest'][:16] ) )
+        #end else
+        print("::: Switching to gravity generation {0}...".format(generation) )
+        gravity_switch(generation)
+        gravity_prune_generations(gravity_generations_kept)
+    else:
+        print("::: Nothing has changed since gravity generation {0}, digest {1}.".format(current, build['digest'][:16]) )
+        # Which sources list each domain may still have changed, and dnsmasq doesn't read it.
+        name = os.path.basename(gravity_domains)
+        os.replace( os.path.join(generation_dir, name), os.path.join(current_dir, name) )
+        shutil.rmtree(generation_dir)
+    #end else
 
     # Remove any list.*.*.domains files that we aren't aware of.
     gravity_blackbody(var_dir, source_files)
 
+    # Save our source metadata, forgetting any sources we no longer have.
+    source_basenames = [ os.path.basename(f) for f in source_files ]
+    sources_meta = { k : v for k, v in sources_meta.items() if k in source_basenames }
+    write_sources_meta(sources_meta)
+
     # Remove the pyhole.* files; we're done with them now.
     glob_string = os.path.join(var_dir, 'pyhole.*')
     files = glob.glob(glob_string)
     for f in files:
         os.remove(f)
     #end for
+    
+    # Try to ensure all files in /var/lib/pyhole are chowned pyhole:pyhole
+    gravity_resetpermissions()
+    
+    # Reload dnsmasq settings, if there's anything new to load.
+    if build['changed']:
+        gravity_reload()
+    else:
+        print("::: Leaving dnsmasq (and its cache) alone.")
+    #end else
+
+#end def pyhole_gravity(pipeline = None):
 
-    # Run pyhole_whitelist to comment out any domains in whitelist.txt in gravity.hosts.
-    print("::: Running pyhole-whitelist to update gravity.hosts file....")
-    pyhole_whitelist( domains = None, delete = False, force = True, no_reload = True )
+def pyhole_gravity_rollback():
+    """Switch back to the gravity generation before the one in use, and reload.  Returns False if there isn't one.
+    
+    The whitelist may have changed since that generation was built, so with
+    the "hosts" output it is brought up to date first.  gravity.conf, with
+    the "dnsmasq" output, keeps the whitelist it was built with.
+    """
+    current = gravity_current_generation()
+    previous = [ generation for generation in gravity_generations() if current is None or generation < current ]
+    if not previous:
+        print("::: There is no earlier gravity generation to roll back to.")
+        return False
+    #end if
+    generation = previous[-1]
+    
+    if gravity_output != "dnsmasq":
+        hosts_filename = os.path.join( gravity_generation_dir(generation), os.path.basename(gravity_hosts) )
+        changed = gravity_hosts_sync_whitelist(hosts_filename)
+        print("::: Updated the whitelisting of {0} line(s) in gravity generation {1}.".format(changed, generation) )
+    #end if
+    
+    print("::: Rolling back from gravity generation {0} to {1}...".format(current, generation) )
+    gravity_switch(generation)
     
     # Try to ensure all files in /var/lib/pyhole are chowned pyhole:pyhole
     gravity_resetpermissions()
     
     # Reload dnsmasq settings.
     gravity_reload()
-
-#end def pyhole_gravity():
+    
+    return True
+#end def pyhole_gravity_rollback():
 
 ########################
 ## White / Black list ##
 ########################
 
+def normalise_domain(domain : str):
+    """Lower case a domain, remove any trailing dot and IDNA encode it.  Returns None if it is not a valid domain.
+    
+    Wildcards such as *.example.com are allowed.
+    """
+    domain = domain.strip().rstrip('.')
+    
+    wildcard = domain.startswith('*.')
+    if wildcard: domain = domain[2:]
+    
+    try:
+        # Plain ASCII domains are by far the most common, and don't need
+        # the (slow) IDNA codec.
+        domain.encode('ascii')
+        domain = domain.lower()
+    except UnicodeError:
+        try:
+            domain = domain.encode('idna').decode('ascii')
+        except UnicodeError:
+            return None
+        #end except
+    #end except
+    
+    if not domain or len(domain) > 253:
+        return None
+    #end if
+    for label in domain.split('.'):
+        if not label or len(label) > 63 or label.split() != [label]:
+            return None
+        #end if
+    #end for
+    
+    if wildcard: domain = '*.' + domain
+    
+    return domain
+#end def normalise_domain(domain : str):
+
+def normalise_domains(domains):
+    """Normalise a list of domains, warning about and leaving out any that are not valid."""
+    normalised = []
+    for domain in domains:
+        n = normalise_domain(domain)
+        if n:
+            normalised.append(n)
+        else:
+            print("::: {0} is not a valid domain! Skipping".format(domain) )
+        #end else
+    #end for
+    return normalised
+#end def normalise_domains(domains):
+
+def read_domains(f):
+    """Read domains from an open text file, one per line, ignoring comments and hosts file IPs."""
+    domains = []
+    for line in f:
+        split_line = line.partition('#')[0].split()
+        if len(split_line) >= 2:
+            # A hosts file line - the domain is the second component.
+            domains.append(split_line[1])
+        elif split_line:
+            domains.append(split_line[0])
+        #end elif
+    #end for
+    return domains
+#end def read_domains(f):
+
 def read_list(source_filename):
-    """Read the blacklist or whitelist file into a list object."""
+    """Read the blacklist or whitelist file into an ordered set of normalised domains.
+    
+    The "set" is an OrderedDict with domains as keys, so that lookups are
+    quick and the file keeps its order.  Lines that aren't valid domains are
+    kept as they are, so that we never lose anything a user has written.
+    """
+    domainlist = collections.OrderedDict()
     with open(source_filename) as f:
         # f.readlines() does not remove newlines
         # f.read.splitlines() does
-        list = f.read().splitlines()
+        for line in f.read().splitlines():
+            line = line.strip()
+            if line:
+                domainlist[ normalise_domain(line) or line ] = None
+            #end if
+        #end for
     #end with
-    return list
+    return domainlist
 #end def read_list(source_filename):
 
 def write_list(destination_filename, list):
@@ -586,7 +2399,7 @@ def write_list(destination_filename, list):
     #end with
 #end def write_list(destination_filename, list):
 
-def add_list_domain(filename, list):
+def add_list_domain(filename, list, quiet = False):
     """Add the domains to the list file, and return how many have been added."""
     domainlist = read_list(filename)
     basename = os.path.basename(filename)
@@ -594,11 +2407,11 @@ def add_list_domain(filename, list):
     added = 0
     for domain in list:
         if domain in domainlist:
-            print("::: {0} already exists in {1}! No need to add".format(domain, basename) )
+            if not quiet: print("::: {0} already exists in {1}! No need to add".format(domain, basename) )
         else:
             added += 1
-            print("::: Adding {0} to {1}...".format(domain, basename) )
-            domainlist.append(domain)
+            if not quiet: print("::: Adding {0} to {1}...".format(domain, basename) )
+            domainlist[domain] = None
         #end else
     #end for
     
@@ -607,9 +2420,9 @@ def add_list_domain(filename, list):
     
     return added
     
-#end def add_list_domain(filename, list):
+#end def add_list_domain(filename, list, quiet = False):
 
-def remove_list_domain(filename, list):
+def remove_list_domain(filename, list, quiet = False):
     """Remove the domains from the list file, and return how many have been removed."""
     domainlist = read_list(filename)
     basename = os.path.basename(filename)
@@ -618,10 +2431,10 @@ def remove_list_domain(filename, list):
     for domain in list:
         if domain in domainlist:
             removed += 1
-            print("::: Removing {0} from {1}...".format(domain, basename) )
-            domainlist.remove(domain)
+            if not quiet: print("::: Removing {0} from {1}...".format(domain, basename) )
+            del domainlist[domain]
         else:
-            print("::: {0} does NOT exist in {1}! No need to remove".format(domain, basename) )
+            if not quiet: print("::: {0} does NOT exist in {1}! No need to remove".format(domain, basename) )
         #end else
     #end for
     
@@ -630,7 +2443,7 @@ def remove_list_domain(filename, list):
     
     return removed
     
-#end def remove_list_domain(filename, list):
+#end def remove_list_domain(filename, list, quiet = False):
 
 def write_blacklist_hosts(destination_filename, ipv4_addr = None, ipv6_addr = None):
     """From the blacklist list file, write the blacklist hosts file."""
@@ -638,6 +2451,12 @@ def write_blacklist_hosts(destination_filename, ipv4_addr = None, ipv6_addr = No
     
     with open (destination_filename, 'wt') as outfile:
         for domain in blacklist:
+            # A hosts file can't hold wildcards.  pyhole_blacklist won't add
+            # them, but one may have been written in by hand.
+            if domain.startswith('*.'):
+                print("::: {0} in {1} is a wildcard, which the blacklist can't block! Skipping".format(domain, os.path.basename(blacklist_file) ) )
+                continue
+            #end if
             if ipv4_addr:
                 outfile.write( domain_hostformat(ipv4_addr, domain) )
                 outfile.write("\n")
@@ -650,23 +2469,231 @@ def write_blacklist_hosts(destination_filename, ipv4_addr = None, ipv6_addr = No
     #end with
 #end def write_blacklist(destination_filename, ipv4_addr = None, ipv6_addr = None):
 
-def gravity_hosts_add_whitelist(whitelist = None):
-    """In gravity.hosts, comment out any hosts that should be whitelisted."""
+class domain_matcher:
+    """Match domains against a list of exact domains and "*.example.com" wildcards.
+    
+    Exact domains are held in a set.  Wildcards are held in a trie of their
+    labels in reverse order, e.g. *.ads.example.com is stored under
+    "com" -> "example" -> "ads", so a domain is matched against every
+    wildcard at once by walking down its own labels from the right.
+    "*.example.com" matches any subdomain of example.com, but not
+    example.com itself.
+    
+    Entries may be str or bytes, but domains must be matched with the same type.
+    Use "domain in matcher" to match.
+    """
+    
+    def __init__(self, entries = ()):
+        self.exact = set()
+        self.wildcards = {}
+        for entry in entries:
+            self.add(entry)
+        #end for
+    #end def __init__(self, entries = ()):
+    
+    def add(self, entry):
+        """Add an exact domain or wildcard."""
+        dot = b"." if isinstance(entry, bytes) else "."
+        if entry.startswith(b"*." if isinstance(entry, bytes) else "*."):
+            node = self.wildcards
+            for label in reversed( entry[2:].split(dot) ):
+                node = node.setdefault(label, {})
+            #end for
+            # None can never be a label, so it marks the end of a wildcard.
+            node[None] = True
+        else:
+            self.exact.add(entry)
+        #end else
+    #end def add(self, entry):
+    
+    def __contains__(self, domain):
+        if domain in self.exact:
+            return True
+        #end if
+        if not self.wildcards:
+            return False
+        #end if
+        
+        labels = domain.split(b"." if isinstance(domain, bytes) else ".")
+        node = self.wildcards
+        # Walk from the TLD leftwards.  We match if we reach the end of a
+        # wildcard with at least one label of the domain still to go.
+        for i in range(len(labels) - 1, 0, -1):
+            node = node.get(labels[i])
+            if node is None:
+                return False
+            #end if
+            if None in node:
+                return True
+            #end if
+        #end for
+        return False
+    #end def __contains__(self, domain):
+    
+#end class domain_matcher:
+
+def gravity_hosts_find(hosts, index, domain):
+    """Find the offsets of all lines for domain in gravity.hosts, using gravity.hosts.index.
+    
+    hosts and index are open binary files, and domain is bytes.  Returns a
+    list of offsets, which is empty if the domain is not in gravity.hosts,
+    or None if the index can't be trusted.
+    """
+    header = index.read(gravity_index_header.size)
+    if len(header) != gravity_index_header.size:
+        return None
+    #end if
+    magic, hosts_size, count = gravity_index_header.unpack(header)
+    if magic != gravity_index_magic or hosts_size != os.fstat( hosts.fileno() ).st_size:
+        return None
+    #end if
+    
+    def line_at(i):
+        index.seek( gravity_index_header.size + i * 8 )
+        offset = struct.unpack( "=Q", index.read(8) )[0]
+        hosts.seek(offset)
+        return offset, hosts.readline()
+    #end def line_at(i):
+    
+    # Binary search for the domain.
+    lo = 0
+    hi = count
+    while lo < hi:
+        mid = (lo + hi) // 2
+        offset, line = line_at(mid)
+        split_line = line.split()
+        if line[:1] not in (b" ", b"#") or len(split_line) < 2:
+            # gravity.hosts has been changed behind our back.
+            return None
+        #end if
+        if split_line[1] < domain:
+            lo = mid + 1
+        else:
+            hi = mid
+        #end else
+    #end while lo < hi:
+    
+    if lo == count:
+        return []
+    #end if
+    
+    # The domain has one line for each address, one after the other.
+    offsets = []
+    offset, line = line_at(lo)
+    while line:
+        split_line = line.split()
+        if len(split_line) < 2 or split_line[1] != domain:
+            break
+        #end if
+        offsets.append(offset)
+        offset += len(line)
+        line = hosts.readline()
+    #end while line:
+    
+    return offsets
+#end def gravity_hosts_find(hosts, index, domain):
+
+def gravity_hosts_patch(domains, comment : bool):
+    """Comment or uncomment the domains in gravity.hosts in place.
+    
+    Each line starts with a space or a hash, so this is just a one byte write
+    per line.  Returns how many lines were changed, or None if gravity.hosts
+    can't be patched (e.g. there is no index) and must be rewritten instead.
+    """
+    if len(domains) >= gravity_incremental_limit:
+        return None
+    #end if
+    for domain in domains:
+        # A wildcard may cover any number of lines, so needs a rewrite.
+        if domain.startswith("*."):
+            return None
+        #end if
+    #end for
+    
+    new, old = (b"#", b" ") if comment else (b" ", b"#")
+    changed = 0
+    try:
+        with open(gravity_hosts, 'r+b') as hosts, open(gravity_hosts_index, 'rb') as index:
+            # Find everything before changing anything, so that we either
+            # patch all of the domains or none of them.
+            found = []
+            for domain in domains:
+                index.seek(0)
+                offsets = gravity_hosts_find(hosts, index, domain.encode())
+                if offsets is None:
+                    return None
+                #end if
+                found.extend(offsets)
+            #end for
+            
+            for offset in found:
+                hosts.seek(offset)
+                if hosts.read(1) == old:
+                    hosts.seek(offset)
+                    hosts.write(new)
+                    changed += 1
+                #end if
+            #end for
+        #end with
+    except FileNotFoundError:
+        return None
+    #end except
+    
+    return changed
+#end def gravity_hosts_patch(domains, comment : bool):
+
+def gravity_hosts_temp_file(hosts_filename):
+    """Return the real path of a hosts file, and an open temp file and its name to rewrite it to.
+    
+    The temp file is in the same directory, so that gravity_hosts_replace can
+    rename it into place, and if hosts_filename is a link then it is what the
+    link points to that gets replaced.
+    """
+    hosts_filename = os.path.realpath(hosts_filename)
+    temp_fd, temp_file = tempfile.mkstemp(
+                                            dir    = os.path.dirname(hosts_filename),
+                                            prefix = os.path.basename(hosts_filename) + ".",
+                                            suffix = ".tmp"
+                                         )
+    return hosts_filename, os.fdopen(temp_fd, 'wt'), temp_file
+#end def gravity_hosts_temp_file(hosts_filename):
+
+def gravity_hosts_replace(temp_file, hosts_filename, changed):
+    """Rename a rewritten hosts file into place and reindex it if anything changed, otherwise delete it."""
+    if changed > 0:
+        # mkstemp files are only readable by us, but dnsmasq needs to read this.
+        os.chmod(temp_file, 0o644)
+        os.replace(temp_file, hosts_filename)
+        gravity_hosts_build_index(hosts_filename, hosts_filename + ".index")
+    else:
+        os.remove(temp_file)
+    #end else
+#end def gravity_hosts_replace(temp_file, hosts_filename, changed):
+
+def gravity_hosts_add_whitelist(whitelist = None, hosts_filename = None):
+    """In gravity.hosts (or hosts_filename), comment out any hosts that should be whitelisted."""
     
     # For consistency with gravity_hosts_remove_whitelist, we accept a list of
     # domains as an argument.  However in this case this can be left blank in
     # which case the whitelist file is used.
     if not whitelist:
         whitelist = read_list(whitelist_file)
-    #end if
+    else:
+        # A handful of domains can be patched in place.
+        if gravity_hosts_patch(whitelist, comment = True) is not None:
+            return
+        #end if
+    #end else
+    whitelist = domain_matcher(whitelist)
+    if hosts_filename is None: hosts_filename = gravity_hosts
     
     # We're not going to edit gravity.hosts in place,
     # so we will write to a temp file first.
-    temp_file = tempfile.mkstemp()[1]
+    hosts_filename, outfile, temp_file = gravity_hosts_temp_file(hosts_filename)
     
     commented = 0
     
-    with open(gravity_hosts, 'rt') as infile, open(temp_file, 'wt') as outfile:
+    with open(hosts_filename, 'rt') as infile, outfile:
         for line in infile:
             if line.startswith('#'):
                 # Any line already commented can just pass right through
@@ -676,18 +2703,11 @@ def gravity_hosts_add_whitelist(whitelist = None):
                 split_line = line.split()
                 
                 # Do we comment it out?  i.e. Is it one of the whitelist domains?
-                comment = False
-                # If any one domain matches then we are going to comment this out.
-                for domain in whitelist:
-                    # We use strip() in the comparison to remove the /n
-                    if split_line[1].strip() == domain:
-                        comment = True
-                    #end if
-                #end for:
-                
-                if comment:
+                if len(split_line) >= 2 and split_line[1] in whitelist:
                     commented += 1
-                    # Just add a hash onto the start of the line
+                    # Swap the leading space for a hash if there is one,
+                    # otherwise just add a hash onto the start of the line
+                    if line.startswith(' '): line = line[1:]
                     outfile.write('#')
                     outfile.write(line)
                 else:
@@ -698,15 +2718,10 @@ def gravity_hosts_add_whitelist(whitelist = None):
         #end for
     #end with
     
-    if commented > 0:
-        # Copy the tempfile over the original
-        shutil.copyfile(temp_file, gravity_hosts)
-    #end if
-    
-    # Delete the temp file.
-    os.remove(temp_file)
+    # Rename the temp file over the original, so that dnsmasq never sees half of it.
+    gravity_hosts_replace(temp_file, hosts_filename, commented)
     
-#end gravity_hosts_add_whitelist():
+#end gravity_hosts_add_whitelist(whitelist = None, hosts_filename = None):
 
 def gravity_hosts_remove_whitelist(unwhitelist):
     """In gravity.hosts, uncomment out any hosts that should be unwhitelisted."""
@@ -717,13 +2732,24 @@ def gravity_hosts_remove_whitelist(unwhitelist):
     # whitelist.  This has the downside of ruining any comments a user has
     # made themselves.
     
+    # With wildcards, a domain we are unwhitelisting may still be covered by
+    # another whitelist entry, in which case it must stay commented.
+    whitelist = domain_matcher( read_list(whitelist_file) )
+    
+    # A handful of domains can be patched in place.
+    if gravity_hosts_patch( [ d for d in unwhitelist if not d in whitelist ], comment = False ) is not None:
+        return
+    #end if
+    
+    unwhitelist = domain_matcher(unwhitelist)
+    
     # We're not going to edit gravity.hosts in place,
     # so we will write to a temp file first.
-    temp_file = tempfile.mkstemp()[1]
+    hosts_filename, outfile, temp_file = gravity_hosts_temp_file(gravity_hosts)
     
     uncommented = 0
     
-    with open(gravity_hosts, 'rt') as infile, open(temp_file, 'wt') as outfile:
+    with open(hosts_filename, 'rt') as infile, outfile:
         for line in infile:
             if not line.startswith('#'):
                 # Any line not commented can just pass right through
@@ -734,19 +2760,10 @@ def gravity_hosts_remove_whitelist(unwhitelist):
                 split_line = line.split()
                 
                 # Do we uncomment it out?  i.e. Is it one of the unwhitelist domains?
-                uncomment = False
-                # If any one domain matches then we are going to comment this out.
-                for domain in unwhitelist:
-                    # We use strip() in the comparison to remove the /n
-                    if split_line[1].strip() == domain:
-                        uncomment = True
-                    #end if
-                #end for:
-                
-                if uncomment:
+                if len(split_line) >= 2 and split_line[1] in unwhitelist and not split_line[1] in whitelist:
                     uncommented += 1
-                    # Remove leading hashes and then write
-                    line = line.lstrip('#')
+                    # Swap leading hashes for a space and then write
+                    line = ' ' + line.lstrip('#')
                     outfile.write(line)
                 else:
                     # Write the original line
@@ -756,27 +2773,63 @@ def gravity_hosts_remove_whitelist(unwhitelist):
         #end for
     #end with
     
-    if uncommented > 0:
-        # Copy the tempfile over the original.
-        shutil.copyfile(temp_file, gravity_hosts)
-    #end if
-    
-    # Delete the temp file.
-    os.remove(temp_file)
+    # Rename the temp file over the original, so that dnsmasq never sees half of it.
+    gravity_hosts_replace(temp_file, hosts_filename, uncommented)
     
 #end def gravity_hosts_remove_whitelist(gravity_hosts, unwhitelist):
 
-def pyhole_blacklist(domains = None, delete = False, force = False, no_reload = False):
+def gravity_hosts_sync_whitelist(hosts_filename):
+    """In a hosts file written by gravity, comment out the whitelisted hosts and uncomment all others.
+    
+    Unlike gravity_hosts_remove_whitelist this uncomments every line that is
+    not whitelisted, so it must only be used on files gravity wrote itself -
+    such as an older generation that predates changes to the whitelist.
+    Returns how many lines were changed.
+    """
+    whitelist = domain_matcher( read_list(whitelist_file) )
+    hosts_filename, outfile, temp_file = gravity_hosts_temp_file(hosts_filename)
+    
+    changed = 0
+    
+    with open(hosts_filename, 'rt') as infile, outfile:
+        for line in infile:
+            split_line = line.split()
+            if len(split_line) >= 2:
+                slot = '#' if split_line[1] in whitelist else ' '
+                if line[0] != slot:
+                    changed += 1
+                    line = slot + line[1:]
+                #end if
+            #end if
+            outfile.write(line)
+        #end for
+    #end with
+    
+    gravity_hosts_replace(temp_file, hosts_filename, changed)
+    return changed
+#end def gravity_hosts_sync_whitelist(hosts_filename):
+
+def pyhole_blacklist(domains = None, delete = False, force = False, no_reload = False, quiet = False):
     
     changed = 0
     # Either add to or remove from the list depending on the mode of operation.
     # Only if we're actually given domains to add or remove of course.
     if domains:
+        domains = normalise_domains(domains)
         if delete:
-            changed = remove_list_domain(blacklist_file, domains)
+            changed = remove_list_domain(blacklist_file, domains, quiet)
         else:
-            changed = add_list_domain(blacklist_file, domains)
+            # Blacklisted domains are blocked exactly, through blacklist.hosts,
+            # which can't hold wildcards.  (Wildcards can still be deleted.)
+            for domain in domains:
+                if domain.startswith('*.'):
+                    print("::: {0} is a wildcard, which the blacklist can't block! Skipping".format(domain) )
+                #end if
+            #end for
+            domains = [ domain for domain in domains if not domain.startswith('*.') ]
+            changed = add_list_domain(blacklist_file, domains, quiet)
         #end else:
+        if quiet: print("::: {0} domain(s) changed in {1}.".format(changed, os.path.basename(blacklist_file) ) )
     #end if domains:
 
     if force or changed > 0:
@@ -791,30 +2844,40 @@ def pyhole_blacklist(domains = None, delete = False, force = False, no_reload =
     gravity_resetpermissions()
     
     
-#end def pyhole_blacklist(domains = None, delete = False, force = False, no_reload = False):
+#end def pyhole_blacklist(domains = None, delete = False, force = False, no_reload = False, quiet = False):
 
-def pyhole_whitelist(domains = None, delete = False, force = False, no_reload = False):
+def pyhole_whitelist(domains = None, delete = False, force = False, no_reload = False, quiet = False):
     
     changed = 0
     # Either add to or remove from the list depending on the mode of operation.
     # And comment or uncomment in gravity.hosts
     # Only if we're actually given domains to add or remove.
     if domains:
+        domains = normalise_domains(domains)
         if delete:
-            changed = remove_list_domain(whitelist_file, domains)
-            gravity_hosts_remove_whitelist(domains)
+            changed = remove_list_domain(whitelist_file, domains, quiet)
+            if domains and gravity_output != "dnsmasq": gravity_hosts_remove_whitelist(domains)
         else:
-            changed = add_list_domain(whitelist_file, domains)
-            gravity_hosts_add_whitelist(domains)
+            changed = add_list_domain(whitelist_file, domains, quiet)
+            if domains and gravity_output != "dnsmasq": gravity_hosts_add_whitelist(domains)
         #end else:
+        if quiet: print("::: {0} domain(s) changed in {1}.".format(changed, os.path.basename(whitelist_file) ) )
     #end if domains:
     
-    # If force is specified then this applies regardless of whether we have
-    # been given any domains or not.
-    if force:
+    if gravity_output == "dnsmasq":
+        # Whitelisting a domain can uncover subdomains that were collapsed
+        # into it, so gravity.conf is rebuilt from our last downloads.
+        if force or changed > 0:
+            sources_meta = read_sources_meta()
+            gravity_dnsmasq(gravity_downloaded_sources(), gravity_conf, sources_meta)
+            write_sources_meta(sources_meta)
+        #end if
+    elif force:
+        # If force is specified then this applies regardless of whether we have
+        # been given any domains or not.
         # In gravity.hosts, recomment all domains that are in gravity.txt.
         gravity_hosts_add_whitelist()
-    #end if force:
+    #end elif force:
     
     if force or changed > 0:
         if not no_reload:
@@ -825,4 +2888,329 @@ def pyhole_whitelist(domains = None, delete = False, force = False, no_reload =
     # Try to ensure all files in /var/lib/pyhole are chowned pyhole:pyhole
     gravity_resetpermissions()
     
-#end def pyhole_whitelist(domains = None, delete = False, force = False, no_reload = False):
+#end def pyhole_whitelist(domains = None, delete = False, force = False, no_reload = False, quiet = False):
+
+########################
+###       Query      ###
+########################
+
+def query_table():
+    """Open gravity.domains, for query_domain."""
+    return domaintable.DomainTable(gravity_domains)
+#end def query_table():
+
+def query_lists():
+    """Read what query_domain needs to know: the whitelist, the blacklist and the domains dnsmasq is told to allow."""
+    whitelist_domains = [ domain.encode() for domain in read_list(whitelist_file) ]
+    whitelist = domain_matcher(whitelist_domains)
+    blacklist = set( domain.encode() for domain in read_list(blacklist_file) )
+    # As in gravity_dnsmasq, "*.example.com" allows example.com too.
+    allowed = set( domain[2:] if domain.startswith(b"*.") else domain for domain in whitelist_domains )
+    return whitelist, blacklist, allowed
+#end def query_lists():
+
+def query_domain(domain, table, whitelist, blacklist, allowed):
+    """Work out whether dnsmasq blocks a normalised domain (bytes), and why.
+    
+    Returns a 3-tuple of the status, the domain or nearest parent domain
+    that is in gravity.domains, and its row there (or None and -1).  The
+    status is one of:
+        "blacklisted" - in the blacklist.
+        "blocked"     - blocked by gravity.  With the "dnsmasq" output
+                        this may be because a parent domain is listed.
+        "whitelisted" - whitelisted, so not blocked by gravity.
+        "allowed"     - not blocked.  A parent may still be listed, as
+                        gravity.hosts only blocks the exact domain.
+    """
+    status = "blacklisted" if domain in blacklist else None
+    listed = None
+    listed_row = -1
+    
+    suffix = domain
+    while suffix:
+        row = table.find(suffix)
+        if status is not None:
+            pass
+        elif gravity_output == "dnsmasq":
+            # dnsmasq goes by the longest matching server=/ line, and
+            # gravity_dnsmasq leaves whitelisted domains out altogether.
+            if suffix in allowed:
+                status = "whitelisted"
+            elif row >= 0 and not suffix in whitelist:
+                status = "blocked"
+            #end elif
+        elif domain in whitelist:
+            status = "whitelisted"
+        else:
+            status = "blocked" if row >= 0 else "allowed"
+        #end else
+        
+        if row >= 0 and listed is None:
+            listed = suffix
+            listed_row = row
+        #end if
+        if status is not None and listed is not None:
+            break
+        #end if
+        suffix = suffix.partition(b".")[2]
+    #end while suffix:
+    
+    return status or "allowed", listed, listed_row
+#end def query_domain(domain, table, whitelist, blacklist, allowed):
+
+########################
+###     Query log    ###
+########################
+
+def querylog_read_state():
+    """Read where pyhole_querylog got to last time, and its totals so far."""
+    try:
+        with open(querylog_state, 'rt') as f:
+            state = json.load(f)
+        #end with
+    except (OSError, ValueError):
+        # Missing or corrupt - we'll start from the beginning of the log.
+        state = {}
+    #end except
+    return state
+#end def querylog_read_state():
+
+def querylog_write_json(destination_filename, data):
+    """Write data to a JSON file, replacing it in one go so that the admin pages never read half of it."""
+    fd, temp_file = tempfile.mkstemp(prefix = os.path.basename(destination_filename) + ".", dir = os.path.dirname(destination_filename))
+    try:
+        with os.fdopen(fd, 'wt') as f:
+            json.dump(data, f, separators = (',', ':'))
+        #end with
+        # mkstemp makes it readable by us only, but the web server reads it too.
+        os.chmod(temp_file, 0o644)
+        os.replace(temp_file, destination_filename)
+    except:
+        os.remove(temp_file)
+        raise
+    #end except
+#end def querylog_write_json(destination_filename, data):
+
+def querylog_domains_being_blocked():
+    """How many domains our adlists list, whitelisted or not."""
+    try:
+        with query_table() as table:
+            return len(table)
+        #end with
+    except (OSError, ValueError):
+        return 0
+    #end except
+#end def querylog_domains_being_blocked():
+
+def querylog_lock():
+    """Take the lock that stops two processes following the query log at once, and counting it twice.
+    
+    Returns the open lock file, which holds the lock until it is closed, or
+    None if another process holds the lock.
+    """
+    lock = open(querylog_lock_file, 'a')
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock.close()
+        return None
+    #end except
+    return lock
+#end def querylog_lock():
+
+class querylog_follower:
+    """The query log's running totals and statistics database, kept up to date by update.
+    
+    Used by pyhole_querylog and pyhole-statsd, which must hold querylog_lock.
+    """
+    
+    def __init__(self):
+        self.state = querylog_read_state()
+        self.tailer = querylog.LogTailer(querylog_file, **self.state.get('tailer', {}))
+        self.stats = querylog.QueryStats(self.state.get('stats'))
+        self.store = statsdb.StatsStore(querylog_db, stats_keep)
+        # Bumped whenever summary may have changed.
+        self.generation = 0
+        # gravity.domains, as last counted by update_blocklist.
+        self.blocklist_stat = None
+        self.domains_being_blocked = 0
+        # summary's result, for generation summary_generation.
+        self.summary_cache = None
+        self.summary_generation = None
+        self.summary_written = 0
+    #end def __init__(self):
+    
+    def update_blocklist(self):
+        """Count the domains in gravity.domains again if it has changed.  Returns whether it had."""
+        try:
+            stat = os.stat(gravity_domains)
+            blocklist_stat = (stat.st_ino, stat.st_size, stat.st_mtime)
+        except OSError:
+            blocklist_stat = None
+        #end except
+        if blocklist_stat == self.blocklist_stat:
+            return False
+        #end if
+        self.blocklist_stat = blocklist_stat
+        self.domains_being_blocked = querylog_domains_being_blocked()
+        return True
+    #end def update_blocklist(self):
+    
+    def update(self):
+        """Count anything new in the log, and save our state and querylog.json.  Returns whether anything changed."""
+        changed = querylog_update(self.tailer, self.stats, self.store)
+        if changed or not self.state:
+            self.state = { 'tailer' : self.tailer.to_state(), 'stats' : self.stats.to_state() }
+            querylog_write_json(querylog_state, self.state)
+        #end if
+        changed = self.update_blocklist() or changed
+        if changed:
+            self.generation += 1
+        #end if
+        
+        now = time.time()
+        if changed or now - self.summary_written >= querylog_summary_interval:
+            summary = dict( self.summary() )
+            summary['updated'] = int(now)
+            querylog_write_json(querylog_summary, summary)
+            self.summary_written = now
+        #end if
+        return changed
+    #end def update(self):
+    
+    def summary(self):
+        """Return QueryStats.summary, which is only worked out again when something has changed."""
+        if self.summary_generation != self.generation:
+            self.summary_cache = self.stats.summary(self.domains_being_blocked)
+            self.summary_generation = self.generation
+        #end if
+        return self.summary_cache
+    #end def summary(self):
+    
+#end class querylog_follower:
+
+def querylog_update(tailer, stats, store):
+    """Count any new lines in the log, and add them to the statistics database.  Returns whether there were any."""
+    changed = False
+    for lines in tailer.read_lines():
+        if lines is None:
+            # The log has been rotated, which happens at the end of each day.
+            stats.new_day()
+        else:
+            records = stats.parser.parse(lines)
+            stats.add_records(records)
+            store.add_records(records)
+        #end else
+        changed = True
+    #end for
+    store.commit()
+    return changed
+#end def querylog_update(tailer, stats, store):
+
+def pyhole_querylog(follow = False, interval = 10):
+    """Count what has been added to the query log since last time, and save the totals for the admin pages.
+    
+    With follow, keep checking for more every interval seconds.  Returns
+    False, having done nothing, if another process is following the log.
+    """
+    lock = querylog_lock()
+    if lock is None:
+        return False
+    #end if
+    
+    with lock:
+        follower = querylog_follower()
+        while True:
+            follower.update()
+            if not follow:
+                break
+            #end if
+            time.sleep(interval)
+        #end while True:
+    #end with lock:
+    return True
+#end def pyhole_querylog(follow = False, interval = 10):
+
+########################
+###     Resolver     ###
+########################
+
+class resolver_blocklist:
+    """Which domains pyhole-dns blocks: those dnsmasq would block with our lists - see query_domain.
+    
+    reload_if_changed opens gravity.domains and reads the whitelist and
+    blacklist again whenever any of them has changed, e.g. once pyhole-gravity
+    has switched generations, so that changes apply without a restart.
+    """
+    
+    def __init__(self):
+        self.table = None
+        self.files = None
+        self.reload_if_changed()
+    #end def __init__(self):
+    
+    def stat_files(self):
+        """Return what we know of gravity.domains, the whitelist and the blacklist, to tell whether they have changed."""
+        files = []
+        for filename in (gravity_domains, whitelist_file, blacklist_file):
+            try:
+                stat = os.stat(filename)
+                files.append( (stat.st_ino, stat.st_size, stat.st_mtime) )
+            except OSError:
+                files.append(None)
+            #end except
+        #end for
+        return files
+    #end def stat_files(self):
+    
+    def reload(self):
+        """Open gravity.domains and read the whitelist and blacklist again."""
+        self.files = self.stat_files()
+        try:
+            table = query_table()
+        except (OSError, ValueError):
+            # No gravity.domains yet, so only the blacklist is blocked.
+            table = None
+        #end except
+        self.whitelist, self.blacklist, self.allowed = query_lists()
+        old_table, self.table = self.table, table
+        if old_table is not None:
+            old_table.close()
+        #end if
+    #end def reload(self):
+    
+    def warm(self):
+        """Ask for gravity.domains to be read into the page cache now, rather than a page at a time as queries need it."""
+        try:
+            with open(gravity_domains, 'rb') as f:
+                os.posix_fadvise( f.fileno(), 0, 0, os.POSIX_FADV_WILLNEED )
+            #end with
+        except (OSError, AttributeError):
+            pass
+        #end except
+    #end def warm(self):
+    
+    def reload_if_changed(self):
+        """reload if anything has changed.  Returns whether it had."""
+        if self.stat_files() == self.files:
+            return False
+        #end if
+        self.reload()
+        return True
+    #end def reload_if_changed(self):
+    
+    def check(self, domain):
+        """Return how dnsmasq would block a domain (bytes), as it would log it, or None if it isn't blocked."""
+        if self.table is None:
+            return blacklist_hosts if domain in self.blacklist else None
+        #end if
+        status = query_domain(domain, self.table, self.whitelist, self.blacklist, self.allowed)[0]
+        if status == "blacklisted":
+            return blacklist_hosts
+        elif status == "blocked":
+            return "config" if gravity_output == "dnsmasq" else gravity_hosts
+        #end elif
+        return None
+    #end def check(self, domain):
+    
+#end class resolver_blocklist:
@@ -0,0 +1,474 @@
+#!/usr/bin/env python3
+
+# pyhole - a clone of the Pi-hole DNS adblocker, written in Python.
+# pyhole  (c) 2016 by ryt51V
+# Pi-Hole (c) 2015, 2016 by Jacob Salmela
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Follows dnsmasq's log-queries output in /var/log/pyhole.log, and keeps
+# running totals of what it says, so that the admin pages don't have to read
+# the whole log on every page load.
+#
+# LogTailer reads whatever has been added to the log since last time,
+# remembering the inode and byte offset it got to so that it can pick up
+# where it left off, even across logrotate.  LogParser picks out the queries,
+# forwards and blocks in the lines it reads, and QueryStats adds them up.
+# LogTailer and QueryStats can be saved to and restored from a dict, for JSON.
+
+########################
+###      Imports     ###
+########################
+
+# For stat-ing the log.
+import os
+# For turning syslog timestamps into times.
+import time
+# For counting domains, clients and so on.
+import collections
+
+# For counting domains and clients in fixed memory.
+from pyhole import sketch
+
+########################
+###     Variables    ###
+########################
+
+# How much of the log is read at a time.
+log_block_size = 1048576
+
+# Queries and blocked queries are counted in buckets of this many seconds,
+# and this many seconds worth of buckets are kept.
+bucket_size    = 600
+bucket_history = 86400
+
+# How many recent queries are kept.
+recent_size = 100
+
+# How many of the most queried domains, most blocked domains and busiest
+# clients are counted.  Their counts are too low by at most 1 / (top_capacity
+# + 1) of the queries (or blocked queries) counted - see sketch.TopK.
+top_capacity = 1000
+
+# How many different domains and clients there have been is estimated to
+# within 1.04 / sqrt(2 ** unique_precision), i.e. 1.6% - see sketch.HyperLogLog.
+unique_precision = 12
+
+# How many past days' sketches are kept and merged with today's.
+past_days = 6
+
+# syslog timestamps, e.g. "Jun  8 10:01:02", have no year.
+month_numbers = { month : number for number, month in enumerate(
+                    (b"Jan", b"Feb", b"Mar", b"Apr", b"May", b"Jun", b"Jul", b"Aug", b"Sep", b"Oct", b"Nov", b"Dec"), 1 ) }
+
+########################
+###     LogTailer    ###
+########################
+
+class LogTailer:
+    """Read the lines added to a log file since last time, following it across logrotate.
+    
+    inode and offset say where we got to.  If the log's inode has changed then
+    it has been rotated, so we finish off the old log first if it is still
+    around as rotated_filename (logrotate's delaycompress leaves it
+    uncompressed), then start the new log from the beginning.
+    """
+    
+    def __init__(self, filename, inode = None, offset = 0, rotated_filename = None):
+        self.filename = filename
+        self.inode = inode
+        self.offset = offset
+        self.rotated_filename = rotated_filename if rotated_filename is not None else filename + ".1"
+    #end def __init__(self, filename, inode = None, offset = 0, rotated_filename = None):
+    
+    def read_lines(self):
+        """Yield lists of new, complete lines, without line breaks.  Yields None when moving on to a new log."""
+        try:
+            stat = os.stat(self.filename)
+        except FileNotFoundError:
+            return
+        #end except
+        
+        if self.inode is not None and stat.st_ino != self.inode:
+            # Rotated.  Finish the old log, if we can still find it.
+            try:
+                if os.stat(self.rotated_filename).st_ino == self.inode:
+                    for lines in self.read_file(self.rotated_filename):
+                        yield lines
+                    #end for
+                #end if
+            except FileNotFoundError:
+                pass
+            #end except
+            self.inode = stat.st_ino
+            self.offset = 0
+            yield None
+        elif self.inode is None or stat.st_size < self.offset:
+            # New to us, or truncated.
+            if self.inode is not None: yield None
+            self.inode = stat.st_ino
+            self.offset = 0
+        #end elif
+        
+        for lines in self.read_file(self.filename):
+            yield lines
+        #end for
+    #end def read_lines(self):
+    
+    def read_file(self, filename):
+        """Yield lists of the complete lines in filename after our offset, moving our offset past them."""
+        with open(filename, 'rb') as f:
+            f.seek(self.offset)
+            carry = b""
+            while True:
+                block = f.read(log_block_size)
+                if not block: break
+                data = carry + block
+                # Leave any partial last line for next time.
+                cut = data.rfind(b"\n")
+                if cut < 0:
+                    carry = data
+                    continue
+                #end if
+                carry = data[cut + 1:]
+                self.offset += cut + 1
+                yield data[:cut].split(b"\n")
+            #end while
+        #end with
+    #end def read_file(self, filename):
+    
+    def to_state(self):
+        return { 'inode' : self.inode, 'offset' : self.offset }
+    #end def to_state(self):
+    
+#end class LogTailer:
+
+########################
+###     LogParser    ###
+########################
+
+# The kinds of record LogParser.parse returns.
+record_query     = 0
+record_forwarded = 1
+record_blocked   = 2
+
+class LogParser:
+    """Turn dnsmasq log lines into records of the queries, forwards and blocks in them."""
+    
+    def __init__(self):
+        # The start of each minute we have seen, keyed by its timestamp.
+        self.minutes = {}
+        # The client that last asked for each domain, as blocked replies don't say.
+        self.askers = {}
+    #end def __init__(self):
+    
+    def minute(self, timestamp):
+        """Return the time at the start of the minute of a syslog timestamp such as b"Jun  8 10:01"."""
+        try:
+            return self.minutes[timestamp]
+        except KeyError:
+            pass
+        #end except
+        
+        fields = timestamp.split()
+        month = month_numbers[ fields[0] ]
+        now = time.localtime()
+        # Logs from December read in January are from last year.
+        year = now.tm_year - 1 if month > now.tm_mon else now.tm_year
+        hour, minute = fields[2].split(b":")
+        start = int( time.mktime( (year, month, int(fields[1]), int(hour), int(minute), 0, 0, 0, -1) ) )
+        
+        if len(self.minutes) > 1440: self.minutes.clear()
+        self.minutes[timestamp] = start
+        return start
+    #end def minute(self, timestamp):
+    
+    def parse(self, lines):
+        """Parse a list of log lines, e.g. b"Jun  8 10:01:02 dnsmasq[123]: query[A] example.com from 192.168.0.5".
+        
+        Returns a list of (kind, time, domain, other, query type) records, one
+        per line we are interested in, where kind is one of:
+            record_query     - other is the client asking, and the query type is e.g. b"query[A]".
+            record_forwarded - other is the server the query was forwarded to.
+            record_blocked   - other is the client that asked, if we saw it ask, or b"".
+        Query types are None but for record_query.
+        """
+        records = []
+        askers = self.askers
+        for line in lines:
+            colon = line.find(b": ", 15)
+            if colon < 0: continue
+            fields = line[colon + 2:].split(b" ")
+            what = fields[0]
+            
+            if what.startswith(b"query["):
+                if len(fields) < 4: continue
+                kind = record_query
+                other = fields[3]
+                if len(askers) > 65536: askers.clear()
+                askers[ fields[1] ] = other
+            elif what == b"forwarded":
+                kind = record_forwarded
+                other = fields[-1]
+            elif what == b"config" or what.endswith(b"/gravity.hosts"):
+                # Blocked by gravity.conf ("config example.com is NXDOMAIN")
+                # or gravity.hosts.
+                if len(fields) < 2: continue
+                kind = record_blocked
+                other = askers.get(fields[1], b"")
+            else:
+                continue
+            #end else
+            
+            try:
+                when = self.minute(line[:12]) + int(line[13:15])
+            except (KeyError, ValueError, IndexError, OverflowError):
+                continue
+            #end except
+            records.append( (kind, when, fields[1], other, what if kind == record_query else None) )
+        #end for line in lines:
+        return records
+    #end def parse(self, lines):
+    
+#end class LogParser:
+
+########################
+###    QueryStats    ###
+########################
+
+class QueryStats:
+    """Running totals of the queries in a dnsmasq log.
+    
+    Everything but the buckets, recent queries and past days covers the
+    current log only, i.e. today, as the log is rotated daily - see new_day.
+    
+    Domains and clients are counted with sketch.TopK, and how many different
+    ones there were with sketch.HyperLogLog, so the memory we use stays the
+    same however many different domains we see - see top_capacity.  Each
+    day's sketches are kept for past_days days, and merged for the summary.
+    """
+    
+    def __init__(self, state = None):
+        if state is None: state = {}
+        self.started  = state.get('started')
+        self.queries  = state.get('queries', 0)
+        self.blocked  = state.get('blocked', 0)
+        # Keyed by bytes, just as they come out of the log.
+        counter = lambda name: collections.Counter( { key.encode() : value for key, value in state.get(name, {}).items() } )
+        self.forwards        = counter('forwards')
+        self.types           = counter('types')
+        topk = lambda name: sketch.TopK.from_state( state.get(name), top_capacity )
+        self.domains         = topk('top_domains')
+        self.blocked_domains = topk('top_blocked')
+        self.clients         = topk('top_clients')
+        self.unique_domains  = sketch.HyperLogLog.from_state( state.get('unique_domains'), unique_precision )
+        self.unique_clients  = sketch.HyperLogLog.from_state( state.get('unique_clients'), unique_precision )
+        # The to_state of each past day's sketches, oldest first.
+        self.days = collections.deque( state.get('days', []), past_days )
+        # [queries, blocked] for each bucket, keyed by the time it starts.
+        self.buckets = { int(start) : counts for start, counts in state.get('buckets', {}).items() }
+        # (time, domain, client), oldest first.
+        self.recent = collections.deque( ( (t, d.encode(), c.encode()) for t, d, c in state.get('recent', []) ), recent_size )
+        self.parser = LogParser()
+    #end def __init__(self, state = None):
+    
+    def sketches(self):
+        """Return the to_state of today's sketches, keyed as in to_state."""
+        return {
+            'top_domains'    : self.domains.to_state(),
+            'top_blocked'    : self.blocked_domains.to_state(),
+            'top_clients'    : self.clients.to_state(),
+            'unique_domains' : self.unique_domains.to_state(),
+            'unique_clients' : self.unique_clients.to_state(),
+        }
+    #end def sketches(self):
+    
+    def new_day(self):
+        """Start counting afresh, as the log has been rotated."""
+        if self.started is not None:
+            self.days.append( self.sketches() )
+        #end if
+        self.started = None
+        self.queries = 0
+        self.blocked = 0
+        for counter in (self.forwards, self.types, self.domains, self.blocked_domains, self.clients, self.unique_domains, self.unique_clients):
+            counter.clear()
+        #end for
+    #end def new_day(self):
+    
+    def add_lines(self, lines):
+        """Count a list of log lines - see LogParser.parse."""
+        self.add_records( self.parser.parse(lines) )
+    #end def add_lines(self, lines):
+    
+    def add_records(self, records):
+        """Count a list of records from LogParser.parse."""
+        buckets = self.buckets
+        for kind, when, domain, other, qtype in records:
+            if kind == record_forwarded:
+                self.forwards[other] += 1
+                continue
+            #end if
+            
+            bucket = when - when % bucket_size
+            counts = buckets.get(bucket)
+            if counts is None:
+                counts = buckets[bucket] = [0, 0]
+            #end if
+            
+            if kind == record_query:
+                if self.started is None: self.started = when
+                self.queries += 1
+                # Most queries are for domains (and from clients) we are
+                # already counting, which we can add to directly.  Anything
+                # else may be new, so goes through the sketches.
+                domains = self.domains.counts
+                if domain in domains:
+                    domains[domain] += 1
+                    self.domains.total += 1
+                else:
+                    self.domains.add(domain)
+                    self.unique_domains.add(domain)
+                #end else
+                clients = self.clients.counts
+                if other in clients:
+                    clients[other] += 1
+                    self.clients.total += 1
+                else:
+                    self.clients.add(other)
+                    self.unique_clients.add(other)
+                #end else
+                self.types[qtype] += 1
+                self.recent.append( (when, domain, other) )
+                counts[0] += 1
+            else:
+                self.blocked += 1
+                self.blocked_domains.add(domain)
+                counts[1] += 1
+            #end else
+        #end for kind, when, domain, other, qtype in records:
+        
+        # Forget buckets that are too old to matter.
+        if buckets:
+            oldest = max(buckets) - bucket_history
+            for start in [ start for start in buckets if start <= oldest ]:
+                del buckets[start]
+            #end for
+        #end if
+    #end def add_records(self, records):
+    
+    def to_state(self):
+        """Return everything we know as a dict, for JSON and QueryStats(state)."""
+        counter = lambda c: { key.decode('utf-8', 'replace') : value for key, value in c.items() }
+        state = {
+            'started'         : self.started,
+            'queries'         : self.queries,
+            'blocked'         : self.blocked,
+            'forwards'        : counter(self.forwards),
+            'types'           : counter(self.types),
+            'days'            : list(self.days),
+            'buckets'         : { str(start) : counts for start, counts in self.buckets.items() },
+            'recent'          : [ [ t, d.decode('utf-8', 'replace'), c.decode('utf-8', 'replace') ] for t, d, c in self.recent ],
+        }
+        state.update( self.sketches() )
+        return state
+    #end def to_state(self):
+    
+    def merged(self):
+        """Return today's sketches merged with those of the past days, keyed as in to_state."""
+        merged = {
+            'top_domains'    : sketch.TopK.from_state( self.domains.to_state() ),
+            'top_blocked'    : sketch.TopK.from_state( self.blocked_domains.to_state() ),
+            'top_clients'    : sketch.TopK.from_state( self.clients.to_state() ),
+            'unique_domains' : sketch.HyperLogLog.from_state( self.unique_domains.to_state() ),
+            'unique_clients' : sketch.HyperLogLog.from_state( self.unique_clients.to_state() ),
+        }
+        for day in self.days:
+            for name, summary in merged.items():
+                summary.merge( type(summary).from_state( day.get(name) ) )
+            #end for
+        #end for
+        return merged
+    #end def merged(self):
+    
+    def summary(self, domains_being_blocked = 0, top = 10):
+        """Return what the admin pages show, in the same shapes as data.php returns them."""
+        text = lambda key: key.decode('utf-8', 'replace')
+        
+        def top_items(domains, blocked_domains):
+            top_ads = collections.OrderedDict( (text(d), n) for d, n in blocked_domains.most_common(top) )
+            top_queries = collections.OrderedDict()
+            for domain, n in domains.most_common():
+                if len(top_queries) >= top: break
+                if text(domain) in top_ads: continue
+                top_queries[ text(domain) ] = n
+            #end for
+            return { 'top_queries' : top_queries, 'top_ads' : top_ads }
+        #end def top_items(domains, blocked_domains):
+        
+        merged = self.merged()
+        
+        # Queries and blocked queries today, by hour of the day.
+        domains_over_time = {}
+        ads_over_time = {}
+        for start, (queries, blocked) in self.buckets.items():
+            if self.started is None or start < self.started - self.started % bucket_size: continue
+            hour = time.localtime(start).tm_hour
+            domains_over_time[hour] = domains_over_time.get(hour, 0) + queries
+            ads_over_time[hour]     = ads_over_time.get(hour, 0) + blocked
+        #end for
+        if domains_over_time:
+            for hour in range( min(domains_over_time), max(domains_over_time) + 1 ):
+                domains_over_time.setdefault(hour, 0)
+                ads_over_time.setdefault(hour, 0)
+            #end for
+        #end if
+        
+        return {
+            'summary' : {
+                'domains_being_blocked' : domains_being_blocked,
+                'dns_queries_today'     : self.queries,
+                'ads_blocked_today'     : self.blocked,
+                'ads_percentage_today'  : self.blocked / self.queries * 100 if self.queries else 0,
+            },
+            'over_time' : {
+                'domains_over_time' : collections.OrderedDict( sorted(domains_over_time.items()) ),
+                'ads_over_time'     : collections.OrderedDict( sorted(ads_over_time.items()) ),
+            },
+            'top_items' : top_items(self.domains, self.blocked_domains),
+            # Today and the past days together.
+            'top_items_days' : top_items(merged['top_domains'], merged['top_blocked']),
+            # Estimates, to within about 2%.
+            'unique' : {
+                'domains_today'  : self.unique_domains.estimate(),
+                'clients_today'  : self.unique_clients.estimate(),
+                'domains_days'   : merged['unique_domains'].estimate(),
+                'clients_days'   : merged['unique_clients'].estimate(),
+                'days'           : len(self.days) + 1,
+            },
+            # How much the counts in top_items and query_sources may be too
+            # low by - see sketch.TopK.
+            'top_error' : {
+                'today' : max(self.domains.error, self.blocked_domains.error, self.clients.error),
+                'days'  : max(merged['top_domains'].error, merged['top_blocked'].error, merged['top_clients'].error),
+            },
+            # Newest first.
+            'recent_queries'       : [ [ t, text(d), text(c) ] for t, d, c in reversed(self.recent) ],
+            'query_types'          : { text(k) : n for k, n in self.types.items() },
+            'forward_destinations' : { text(k) : n for k, n in self.forwards.items() },
+            'query_sources'        : { text(k) : n for k, n in self.clients.counts.items() },
+            'buckets'              : collections.OrderedDict( (str(start), counts) for start, counts in sorted(self.buckets.items()) ),
+        }
+    #end def summary(self, domains_being_blocked = 0, top = 10):
+    
+#end class QueryStats:
@@ -0,0 +1,1101 @@
+#!/usr/bin/env python3
+
+# pyhole - a clone of the Pi-hole DNS adblocker, written in Python.
+# pyhole  (c) 2016 by ryt51V
+# Pi-Hole (c) 2015, 2016 by Jacob Salmela
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# A DNS sinkhole resolver, used by pyhole-dns instead of dnsmasq.
+#
+# Queries for blocked domains are answered straight away, with our own
+# addresses (or NXDOMAIN with the "dnsmasq" gravity output), and everything
+# else is forwarded to the upstream DNS servers chosen in pyhole-config, with
+# their replies cached - see dnscache.
+# Which domains are blocked is up to the blocklist we are given - see
+# pyhole.resolver_blocklist - which can be changed while we run.
+#
+# Queries can be logged in the same format as dnsmasq's log-queries, so that
+# pyhole-querylog, pyhole-statsd and the admin pages work as before.
+#
+# To use more than one core, a WorkerPool runs several resolver processes,
+# sharing the port with SO_REUSEPORT.
+
+########################
+###      Imports     ###
+########################
+
+# For the server itself.
+import asyncio
+# For packing and unpacking DNS messages.
+import struct
+# For our own addresses.
+import ipaddress
+# For transaction IDs.
+import random
+# For logging.
+import time
+import os
+# For binding our sockets ourselves, and running several worker processes.
+import socket
+import signal
+import sys
+import traceback
+# For skipping over names in the records after a query's question.
+from pyhole import dnscache
+
+########################
+###     Variables    ###
+########################
+
+# Record types, classes and response codes we deal with.
+type_a    = 1
+type_aaaa = 28
+type_opt  = 41
+type_any  = 255
+class_in  = 1
+
+rcode_noerror  = 0
+rcode_formerr  = 1
+rcode_servfail = 2
+rcode_nxdomain = 3
+rcode_refused  = 5
+
+# How dnsmasq logs each query type, e.g. "query[AAAA]".  Others are "query[type=N]".
+type_names = { 1 : "A", 2 : "NS", 5 : "CNAME", 6 : "SOA", 12 : "PTR", 15 : "MX", 16 : "TXT",
+               28 : "AAAA", 33 : "SRV", 35 : "NAPTR", 43 : "DS", 48 : "DNSKEY", 64 : "SVCB", 65 : "HTTPS", 255 : "ANY" }
+
+# The largest UDP response a client takes unless its EDNS OPT record says otherwise.
+udp_size = 512
+
+# The TTL of our answers for blocked domains, as dnsmasq's local-ttl.
+sinkhole_ttl = 300
+
+# How long to wait for an upstream server before trying the next.
+upstream_timeout = 2.0
+
+# How many UDP sockets each upstream server is sent queries from.  Spreading
+# queries over several source ports (as well as random transaction IDs) makes
+# forged answers harder to slip in.
+upstream_sockets = 4
+
+# How many of the fastest upstream servers each query is sent to at once.  The
+# first answer wins.
+upstream_race = 2
+
+# How much each reply (or timeout) moves an upstream server's average latency.
+latency_weight = 0.2
+
+# An upstream server is demoted - no longer raced, only asked once the others
+# have had their chance - after this many timeouts in a row, or while its
+# average latency is this many seconds worse than the fastest server's.
+demote_failures = 3
+demote_latency  = 0.1
+
+# One query in this many is also sent to a server that isn't being raced, so
+# that slow and demoted servers are measured again, and promoted once better.
+probe_interval = 50
+
+# If no server has answered in this many times the raced servers' average
+# latency (but at least hedge_minimum seconds), the next server along is
+# asked as well.
+hedge_factor  = 4
+hedge_minimum = 0.05
+
+# How long a client's TCP connection may sit idle before we close it.
+tcp_idle_timeout = 10
+
+# A worker that exits within worker_stable seconds of starting is restarted
+# after a delay, doubling each time it does so again, up to worker_restart_max
+# seconds, so that one that can't start isn't restarted every second.
+worker_stable      = 30
+worker_restart_max = 60
+
+########################
+###     Messages     ###
+########################
+
+def parse_question(message):
+    """Return the (lower cased, dotted) name, type and class of a query's question, and where the question ends.
+    
+    Raises ValueError for anything but a query with one question, or for a
+    question using name compression.
+    """
+    if len(message) < 12:
+        raise ValueError("short message")
+    #end if
+    flags, qdcount = struct.unpack_from("!HH", message, 2)
+    if flags & 0x8000 or qdcount != 1:
+        raise ValueError("not a query with one question")
+    #end if
+    
+    labels = []
+    offset = 12
+    while True:
+        length = message[offset]
+        offset += 1
+        if length == 0:
+            break
+        #end if
+        if length & 0xC0:
+            raise ValueError("compressed question")
+        #end if
+        labels.append( message[offset : offset + length] )
+        offset += length
+    #end while True:
+    if offset + 4 > len(message):
+        raise ValueError("short question")
+    #end if
+    qtype, qclass = struct.unpack_from("!HH", message, offset)
+    return b".".join(labels).lower(), qtype, qclass, offset + 4
+#end def parse_question(message):
+
+def response_header(query, rcode, answers = 0, questions = 1, authoritative = False):
+    """Return the header of our own response to a query: its ID, opcode and RD flag, with QR and RA set."""
+    flags = struct.unpack_from("!H", query, 2)[0]
+    flags = 0x8000 | (flags & 0x7900) | 0x0080 | rcode | (0x0400 if authoritative else 0)
+    return query[:2] + struct.pack("!HHHHH", flags, questions, answers, 0, 0)
+#end def response_header(query, rcode, answers = 0, questions = 1, authoritative = False):
+
+def error_response(query, rcode, question_end = None):
+    """Return an empty response to a query with an error code, repeating its question if we could parse it."""
+    if len(query) < 12:
+        return None
+    #end if
+    if question_end is None:
+        return response_header(query, rcode, questions = 0)
+    #end if
+    return response_header(query, rcode) + query[12:question_end]
+#end def error_response(query, rcode, question_end = None):
+
+def udp_payload_size(query, question_end):
+    """Return the largest response a query may be sent over UDP: udp_size, or more if its OPT record says so."""
+    ancount, nscount, arcount = struct.unpack_from("!HHH", query, 6)
+    if not arcount:
+        return udp_size
+    #end if
+    offset = question_end
+    try:
+        for index in range(ancount + nscount + arcount):
+            offset = dnscache.skip_name(query, offset)
+            rtype, rclass, ttl, rdlength = struct.unpack_from("!HHIH", query, offset)
+            if rtype == type_opt:
+                # The OPT record's class is its sender's UDP payload size.
+                return max(udp_size, rclass)
+            #end if
+            offset += 10 + rdlength
+        #end for
+    except (IndexError, struct.error):
+        pass
+    #end except
+    return udp_size
+#end def udp_payload_size(query, question_end):
+
+def truncated_response(response, question_end):
+    """Return a response cut down to its header and question, with TC set, so that the client asks again over TCP."""
+    truncated = bytearray(response[:question_end])
+    truncated[2] |= 0x02
+    truncated[6:12] = bytes(6)
+    return bytes(truncated)
+#end def truncated_response(response, question_end):
+
+def address_record(address, ttl):
+    """Return an answer for the question's name (a pointer to offset 12) with an A or AAAA record."""
+    packed = address.packed
+    return b"\xc0\x0c" + struct.pack("!HHIH", type_a if len(packed) == 4 else type_aaaa, class_in, ttl, len(packed)) + packed
+#end def address_record(address, ttl):
+
+def sinkhole_response(query, question_end, qtype, addresses, nxdomain = False, ttl = sinkhole_ttl):
+    """Return our answer to a query for a blocked domain: our own addresses of the type asked for, or NXDOMAIN."""
+    if nxdomain:
+        return response_header(query, rcode_nxdomain, authoritative = True) + query[12:question_end]
+    #end if
+    records = [ address_record(address, ttl) for address in addresses
+                if qtype == type_any or qtype == (type_a if address.version == 4 else type_aaaa) ]
+    return response_header(query, rcode_noerror, answers = len(records), authoritative = True) + query[12:question_end] + b"".join(records)
+#end def sinkhole_response(query, question_end, qtype, addresses, nxdomain = False, ttl = sinkhole_ttl):
+
+class SinkholeResponses:
+    """Our answers to queries for blocked domains, as sinkhole_response gives them, but encoded once up front.
+    
+    response copies a query's ID, flags and question into a buffer kept for
+    the purpose, and puts the header and answers for its type after them, so
+    blocked queries are answered without building a new message each time.
+    The buffer is reused for the next response, so send or copy it first.
+    """
+    
+    def __init__(self, addresses, ttl = sinkhole_ttl):
+        # Made from an empty question, so that each is the 10 bytes of the
+        # header after the ID, then the answers.  Queries' opcode and RD flag
+        # are added in.
+        empty = bytes(12)
+        def template(qtype, nxdomain = False):
+            response = sinkhole_response(empty, 12, qtype, addresses, nxdomain, ttl)
+            return response[2:12], response[12:]
+        #end def template(qtype, nxdomain = False):
+        self.templates = { qtype : template(qtype) for qtype in (type_a, type_aaaa, type_any) }
+        # Other types have no answers.
+        self.nodata = template(0)
+        self.nxdomain = template(0, nxdomain = True)
+        self.buffer = bytearray(512)
+    #end def __init__(self, addresses, ttl = sinkhole_ttl):
+    
+    def response(self, query, question_end, qtype, nxdomain = False):
+        """Return the answer to a query for a blocked domain, in the shared buffer."""
+        header, answers = self.nxdomain if nxdomain else self.templates.get(qtype, self.nodata)
+        buffer = self.buffer
+        buffer[:] = query
+        # Anything after the question, e.g. an EDNS record, is dropped.
+        buffer[question_end:] = answers
+        buffer[2:12] = header
+        buffer[2] |= query[2] & 0x79
+        return buffer
+    #end def response(self, query, question_end, qtype, nxdomain = False):
+    
+#end class SinkholeResponses:
+
+def parse_server(server):
+    """Return the (host, port) of an upstream server written as dnsmasq does, e.g. "8.8.8.8" or "192.168.0.1#5353"."""
+    host, _, port = server.partition("#")
+    return str( ipaddress.ip_address(host) ), int(port or 53)
+#end def parse_server(server):
+
+########################
+###      Logging     ###
+########################
+
+class QueryLog:
+    """Writes dnsmasq style log-queries lines, e.g. "Jun  8 10:01:02 dnsmasq[123]: query[A] example.com from 192.168.0.5".
+    
+    Lines are buffered, and written by flush, as dnsmasq's log-async does.  The
+    log is reopened if logrotate has moved it.
+    """
+    
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = open(filename, 'ab')
+        self.lines = []
+        self.prefix_second = None
+        self.prefix = b""
+        self.tag = " pyhole-dns[{0}]: ".format( os.getpid() ).encode()
+    #end def __init__(self, filename):
+    
+    def log(self, message):
+        now = int(time.time())
+        if now != self.prefix_second:
+            t = time.localtime(now)
+            self.prefix = (time.strftime("%b ", t) + "{0:2d}".format(t.tm_mday) + time.strftime(" %H:%M:%S", t)).encode() + self.tag
+            self.prefix_second = now
+        #end if
+        self.lines.append(self.prefix + message + b"\n")
+    #end def log(self, message):
+    
+    def flush(self):
+        if self.lines:
+            self.file.write( b"".join(self.lines) )
+            self.file.flush()
+            self.lines = []
+        #end if
+        # Reopen the log if it has been rotated.
+        try:
+            if os.stat(self.filename).st_ino != os.fstat( self.file.fileno() ).st_ino:
+                self.file.close()
+                self.file = open(self.filename, 'ab')
+            #end if
+        except OSError:
+            pass
+        #end except
+    #end def flush(self):
+    
+#end class QueryLog:
+
+########################
+###     Upstreams    ###
+########################
+
+class UpstreamProtocol(asyncio.DatagramProtocol):
+    """One of the UDP sockets we forward queries from."""
+    
+    def __init__(self, forwarder):
+        self.forwarder = forwarder
+        self.transport = None
+    #end def __init__(self, forwarder):
+    
+    def connection_made(self, transport):
+        self.transport = transport
+    #end def connection_made(self, transport):
+    
+    def datagram_received(self, data, addr):
+        self.forwarder.reply_received(self, data, addr)
+    #end def datagram_received(self, data, addr):
+    
+    def error_received(self, exc):
+        # e.g. ICMP port unreachable.  The query will time out.
+        pass
+    #end def error_received(self, exc):
+    
+#end class UpstreamProtocol(asyncio.DatagramProtocol):
+
+class UpstreamConnection:
+    """A persistent TCP connection to one upstream server, with queries pipelined over it.
+    
+    Each message is preceded by its length, as for DNS over TCP and DNS over
+    TLS, so this is also how we talk to a local DNS over TLS stub (such as
+    stubby or unbound) without a connection per query.
+    """
+    
+    def __init__(self, server, timeout = upstream_timeout):
+        self.server = server
+        self.timeout = timeout
+        self.writer = None
+        self.lock = asyncio.Lock()
+        # The futures waiting for replies, keyed by transaction ID, each with its question.
+        self.pending = {}
+        self.random = random.SystemRandom()
+    #end def __init__(self, server, timeout = upstream_timeout):
+    
+    async def connect(self):
+        async with self.lock:
+            if self.writer is None:
+                reader, writer = await asyncio.wait_for( asyncio.open_connection(self.server[0], self.server[1]), self.timeout )
+                self.writer = writer
+                asyncio.ensure_future( self.read_replies(reader, writer) )
+            #end if
+        #end async with
+    #end async def connect(self):
+    
+    async def read_replies(self, reader, writer):
+        try:
+            while True:
+                length = struct.unpack( "!H", await reader.readexactly(2) )[0]
+                reply = await reader.readexactly(length)
+                waiting = self.pending.get(reply[:2])
+                if waiting is None: continue
+                future, question = waiting
+                if reply[12 : 12 + len(question)] == question and not future.done():
+                    future.set_result(reply)
+                #end if
+            #end while True:
+        except (asyncio.IncompleteReadError, OSError):
+            pass
+        finally:
+            writer.close()
+            if self.writer is writer:
+                self.writer = None
+            #end if
+            # Anything still waiting was asked on this connection, and won't be answered now.
+            for future, question in self.pending.values():
+                if not future.done():
+                    future.set_result(None)
+                #end if
+            #end for
+        #end finally
+    #end async def read_replies(self, reader, writer):
+    
+    async def query(self, message, question_end):
+        """Send a query, and return the reply, or None.  Raises asyncio.TimeoutError or OSError."""
+        # Servers close idle connections, which we may not notice until we
+        # have asked on one, so a query is asked again on a fresh connection.
+        for attempt in range(2):
+            await self.connect()
+            while True:
+                query_id = struct.pack("!H", self.random.getrandbits(16))
+                if query_id not in self.pending: break
+            #end while
+            future = asyncio.Future()
+            self.pending[query_id] = (future, message[12:question_end])
+            try:
+                self.writer.write( struct.pack("!H", len(message)) + query_id + message[2:] )
+                reply = await asyncio.wait_for(future, self.timeout)
+            finally:
+                del self.pending[query_id]
+            #end finally
+            if reply is not None:
+                return message[:2] + reply[2:]
+            #end if
+        #end for
+        return None
+    #end async def query(self, message, question_end):
+    
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        #end if
+    #end def close(self):
+    
+#end class UpstreamConnection:
+
+class Upstream:
+    """An upstream server, and how it has been doing."""
+    
+    def __init__(self, server):
+        self.server = server
+        self.family = 6 if ":" in server[0] else 4
+        # Average latency in seconds.  Servers we haven't heard from yet come first, to find out.
+        self.latency = 0.0
+        # Timeouts since the last reply.
+        self.failures = 0
+        # When we first asked it something since its last reply, or None.
+        self.silent_since = None
+        self.queries = 0
+        self.replies = 0
+        self.timeouts = 0
+        # For persistent TCP, the UpstreamConnection.
+        self.connection = None
+    #end def __init__(self, server):
+    
+    def answered(self, seconds):
+        self.replies += 1
+        # Its average since it started timing out says little about it now it's back.
+        if self.failures:
+            self.latency = seconds
+        else:
+            self.latency += latency_weight * (seconds - self.latency)
+        #end else
+        self.failures = 0
+        self.silent_since = None
+    #end def answered(self, seconds):
+    
+    def timed_out(self, seconds):
+        self.timeouts += 1
+        self.failures += 1
+        self.latency += latency_weight * (seconds - self.latency)
+    #end def timed_out(self, seconds):
+    
+#end class Upstream:
+
+class Forwarder:
+    """Forwards queries to the upstream servers, racing the fastest few of them.
+    
+    Each query is sent to the upstream_race fastest servers that aren't
+    demoted, and the first answer wins.  If none have answered by the time
+    they usually would have, the next server along is asked as well, and so
+    on until one answers, or all have timed out.
+    
+    With tcp, queries are sent over a persistent TCP connection to each
+    server instead of over UDP.
+    """
+    
+    def __init__(self, servers, timeout = upstream_timeout, race = upstream_race, tcp = False):
+        self.upstreams = [ Upstream( parse_server(server) ) for server in servers ]
+        if not self.upstreams:
+            raise ValueError("no upstream DNS servers")
+        #end if
+        self.timeout = timeout
+        self.race = max(1, race)
+        self.tcp = tcp
+        # The futures waiting for replies over UDP, keyed by (socket, transaction ID).
+        # Each holds the server and question it is waiting for.
+        self.pending = {}
+        self.sockets = []
+        self.random = random.SystemRandom()
+        # Queries forwarded, for deciding when to probe.
+        self.count = 0
+    #end def __init__(self, servers, timeout = upstream_timeout, race = upstream_race, tcp = False):
+    
+    async def start(self):
+        if self.tcp:
+            for upstream in self.upstreams:
+                upstream.connection = UpstreamConnection(upstream.server, self.timeout)
+            #end for
+            return
+        #end if
+        loop = asyncio.get_event_loop()
+        for i in range(upstream_sockets):
+            for family in set( upstream.family for upstream in self.upstreams ):
+                transport, protocol = await loop.create_datagram_endpoint( lambda: UpstreamProtocol(self),
+                                                                           local_addr = ("::" if family == 6 else "0.0.0.0", 0) )
+                self.sockets.append( (family, protocol) )
+            #end for
+        #end for
+    #end async def start(self):
+    
+    def close(self):
+        for family, protocol in self.sockets:
+            protocol.transport.close()
+        #end for
+        for upstream in self.upstreams:
+            if upstream.connection is not None:
+                upstream.connection.close()
+            #end if
+        #end for
+    #end def close(self):
+    
+    def reply_received(self, protocol, data, addr):
+        if len(data) < 12: return
+        waiting = self.pending.get( (protocol, data[:2]) )
+        if waiting is None: return
+        future, server, question = waiting
+        # Only accept the reply from the server we asked, to the question we asked.
+        if (addr[0], addr[1]) != server or data[12 : 12 + len(question)] != question: return
+        if not future.done():
+            future.set_result(data)
+        #end if
+    #end def reply_received(self, protocol, data, addr):
+    
+    async def query_udp(self, message, question_end, upstream):
+        """Send a query to one upstream server over UDP, and return its reply.  Raises asyncio.TimeoutError or OSError."""
+        protocol = self.random.choice( [ protocol for family, protocol in self.sockets if family == upstream.family ] )
+        while True:
+            query_id = struct.pack("!H", self.random.getrandbits(16))
+            if (protocol, query_id) not in self.pending: break
+        #end while
+        future = asyncio.Future()
+        self.pending[ (protocol, query_id) ] = (future, upstream.server, message[12:question_end])
+        try:
+            protocol.transport.sendto(query_id + message[2:], upstream.server)
+            reply = await asyncio.wait_for(future, self.timeout)
+        finally:
+            del self.pending[ (protocol, query_id) ]
+        #end finally
+        return message[:2] + reply[2:]
+    #end async def query_udp(self, message, question_end, upstream):
+    
+    async def query_server(self, message, question_end, upstream):
+        """Send a query to one upstream server, and return (its reply or None, upstream), keeping its score."""
+        loop = asyncio.get_event_loop()
+        upstream.queries += 1
+        start = loop.time()
+        if upstream.silent_since is None:
+            upstream.silent_since = start
+        #end if
+        try:
+            if upstream.connection is not None:
+                reply = await upstream.connection.query(message, question_end)
+            else:
+                reply = await self.query_udp(message, question_end, upstream)
+            #end else
+        except (asyncio.TimeoutError, OSError):
+            reply = None
+        #end except
+        if reply is not None:
+            upstream.answered( loop.time() - start )
+        else:
+            # Whether it timed out or failed sooner, count it as having taken the full time.
+            upstream.timed_out(self.timeout)
+        #end else
+        return reply, upstream
+    #end async def query_server(self, message, question_end, upstream):
+    
+    async def query_server_tcp(self, message, server):
+        """Send a query to one upstream server over a TCP connection of its own, and return its reply, or None."""
+        try:
+            reader, writer = await asyncio.wait_for( asyncio.open_connection(server[0], server[1]), self.timeout )
+        except (asyncio.TimeoutError, OSError):
+            return None
+        #end except
+        try:
+            writer.write( struct.pack("!H", len(message)) + message )
+            length = struct.unpack( "!H", await asyncio.wait_for(reader.readexactly(2), self.timeout) )[0]
+            return await asyncio.wait_for(reader.readexactly(length), self.timeout)
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, OSError):
+            return None
+        finally:
+            writer.close()
+        #end finally
+    #end async def query_server_tcp(self, message, server):
+    
+    def demoted(self, upstream, fastest, now):
+        # A server that has gone quiet is demoted well before its queries time out.
+        return ( upstream.failures >= demote_failures or upstream.latency > fastest + demote_latency or
+                 (upstream.silent_since is not None and now - upstream.silent_since > fastest + demote_latency) )
+    #end def demoted(self, upstream, fastest, now):
+    
+    def fastest(self):
+        """Return the average latency of the fastest server that isn't failing."""
+        healthy = [ upstream.latency for upstream in self.upstreams if upstream.failures < demote_failures ]
+        return min(healthy) if healthy else 0.0
+    #end def fastest(self):
+    
+    def ranked(self):
+        """Return the upstream servers, best first, and how many of them to race."""
+        fastest = self.fastest()
+        now = asyncio.get_event_loop().time()
+        ranked = sorted( self.upstreams, key = lambda upstream: (self.demoted(upstream, fastest, now), upstream.latency) )
+        race = 1
+        while race < min( self.race, len(ranked) ) and not self.demoted(ranked[race], fastest, now):
+            race += 1
+        #end while
+        return ranked, race
+    #end def ranked(self):
+    
+    async def query(self, message, question_end, tcp = False):
+        """Forward a query upstream until a server answers.  Returns (reply, server), or (None, None).
+    
+        With tcp, a truncated reply over UDP is asked for again over TCP.
+        """
+        ranked, race = self.ranked()
+        asking = [ asyncio.ensure_future( self.query_server(message, question_end, upstream) ) for upstream in ranked[:race] ]
+        waiting = ranked[race:]
+        self.count += 1
+        if waiting and self.count % probe_interval == 0:
+            upstream = self.random.choice(waiting)
+            waiting.remove(upstream)
+            asking.append( asyncio.ensure_future( self.query_server(message, question_end, upstream) ) )
+        #end if
+        hedge = min( self.timeout, max( hedge_minimum, hedge_factor * max( upstream.latency for upstream in ranked[:race] ) ) )
+    
+        pending = set(asking)
+        while pending:
+            done, pending = await asyncio.wait(pending, timeout = hedge if waiting else None, return_when = asyncio.FIRST_COMPLETED)
+            for task in done:
+                reply, upstream = task.result()
+                if reply is not None:
+                    # The others carry on in the background, so that their latency is still measured.
+                    if tcp and upstream.connection is None and reply[2] & 0x02:
+                        reply = await self.query_server_tcp(message, upstream.server)
+                        if reply is None:
+                            return None, None
+                        #end if
+                    #end if
+                    return reply, upstream.server
+                #end if
+            #end for
+            # No answer yet, or only failures: ask the next server along as well.
+            if waiting and (not done or not pending):
+                pending.add( asyncio.ensure_future( self.query_server(message, question_end, waiting.pop(0)) ) )
+            #end if
+        #end while pending:
+        return None, None
+    #end async def query(self, message, question_end, tcp = False):
+    
+    def scoreboard(self):
+        """Return how each upstream server has been doing, best first."""
+        ranked, race = self.ranked()
+        fastest = self.fastest()
+        now = asyncio.get_event_loop().time()
+        return [ { 'server' : "{0}#{1}".format(*upstream.server), 'latency' : upstream.latency, 'queries' : upstream.queries,
+                   'replies' : upstream.replies, 'timeouts' : upstream.timeouts,
+                   'state' : "raced" if i < race else "demoted" if self.demoted(upstream, fastest, now) else "standby" }
+                 for i, upstream in enumerate(ranked) ]
+    #end def scoreboard(self):
+    
+#end class Forwarder:
+
+########################
+###      Server      ###
+########################
+
+class Resolver:
+    """Answers DNS queries, from the blocklist or by forwarding them.
+    
+    blocklist.check(name) returns None for names that aren't blocked, or how
+    they are blocked, as dnsmasq would log it: the path of gravity.hosts or
+    blacklist.hosts (answered with our addresses), or "config" (answered
+    with NXDOMAIN).  addresses are our ipaddress addresses, log a QueryLog
+    or None, and cache a dnscache.ResponseCache or None.
+    """
+    
+    def __init__(self, blocklist, forwarder, addresses, log = None, cache = None):
+        self.blocklist = blocklist
+        self.forwarder = forwarder
+        self.addresses = addresses
+        self.sinkhole = SinkholeResponses(addresses)
+        # What we log blocked queries as being answered with, as dnsmasq does:
+        # the first address of the type asked for (IPv4 unless AAAA).
+        self.logged = {}
+        for version in (4, 6):
+            answers = [ address for address in addresses if address.version == version ]
+            self.logged[version] = str(answers[0]).encode() if answers else b"NODATA"
+        #end for
+        self.log = log
+        self.cache = cache
+        # Counters, for the curious.
+        self.queries = 0
+        self.blocked = 0
+        self.forwarded = 0
+        self.failed = 0
+    #end def __init__(self, blocklist, forwarder, addresses, log = None, cache = None):
+    
+    def answer_locally(self, message, client, tcp = False):
+        """Answer a query we don't need to forward.  Returns (response, None), or (None, (key, question end)) if it needs forwarding.
+        
+        The key is the query's (name, type, class), which its reply is cached
+        under.  Responses for blocked domains are in self.sinkhole's buffer, so
+        send or copy them before answering another query.  Unless tcp, cached
+        replies too big for the client to take over UDP are asked for again.
+        
+        Messages too short to have a header, and responses, get no reply at
+        all: returns (None, None).  Answering a response with FORMERR (itself
+        a response) could otherwise start two servers answering each other
+        forever.
+        """
+        if len(message) < 12 or message[2] & 0x80:
+            return None, None
+        #end if
+        try:
+            name, qtype, qclass, question_end = parse_question(message)
+        except (ValueError, IndexError, struct.error):
+            return error_response(message, rcode_formerr), None
+        #end except
+        self.queries += 1
+        log = self.log
+        if log is not None:
+            log.log( b"query[" + type_names.get(qtype, "type={0}".format(qtype)).encode() + b"] " + name + b" from " + client.encode() )
+        #end if
+        
+        blocked = self.blocklist.check(name) if qclass == class_in else None
+        if blocked is None:
+            if not name:
+                # The root zone.  Not something our clients have any business asking us.
+                return error_response(message, rcode_refused, question_end), None
+            #end if
+            key = (name, qtype, qclass)
+            if self.cache is not None:
+                limit = None if tcp else udp_payload_size(message, question_end)
+                response, stale = self.cache.get(key, message, question_end, limit = limit)
+                if response is not None:
+                    if log is not None: log.log(b"cached " + name)
+                    if stale is not None and not stale.refreshing:
+                        stale.refreshing = True
+                        asyncio.ensure_future( self.refresh(stale, message, key, question_end) )
+                    #end if
+                    return response, None
+                #end if
+            #end if
+            return None, (key, question_end)
+        #end if
+        
+        self.blocked += 1
+        if blocked == "config":
+            if log is not None: log.log(b"config " + name + b" is NXDOMAIN")
+            return self.sinkhole.response(message, question_end, qtype, nxdomain = True), None
+        #end if
+        if log is not None:
+            log.log( blocked.encode() + b" " + name + b" is " + self.logged[6 if qtype == type_aaaa else 4] )
+        #end if
+        return self.sinkhole.response(message, question_end, qtype), None
+    #end def answer_locally(self, message, client, tcp = False):
+    
+    async def forward(self, message, key, question_end, tcp = False):
+        """Forward a query upstream, returning the reply (which is cached), or SERVFAIL if no server answers."""
+        reply, server = await self.forwarder.query(message, question_end, tcp)
+        if reply is None:
+            self.failed += 1
+            return error_response(message, rcode_servfail, question_end)
+        #end if
+        self.forwarded += 1
+        if self.log is not None:
+            self.log.log( b"forwarded " + key[0] + b" to " + server[0].encode() )
+        #end if
+        if self.cache is not None:
+            self.cache.put(key, reply, question_end)
+        #end if
+        return reply
+    #end async def forward(self, message, key, question_end, tcp = False):
+    
+    async def refresh(self, entry, message, key, question_end):
+        """Ask upstream again for a stale cached reply, in the background."""
+        try:
+            await self.forward(message, key, question_end)
+        finally:
+            entry.refreshing = False
+        #end finally
+    #end async def refresh(self, entry, message, key, question_end):
+    
+    async def resolve(self, message, client, tcp = False):
+        """Return the response to a query."""
+        response, question = self.answer_locally(message, client, tcp)
+        if question is None:
+            return bytes(response) if response is not None else None
+        #end if
+        key, question_end = question
+        return await self.forward(message, key, question_end, tcp)
+    #end async def resolve(self, message, client, tcp = False):
+    
+    async def handle_tcp(self, reader, writer):
+        """Answer the queries on a TCP connection, each preceded by its length."""
+        client = writer.get_extra_info('peername')[0]
+        try:
+            while True:
+                length = struct.unpack( "!H", await asyncio.wait_for(reader.readexactly(2), tcp_idle_timeout) )[0]
+                message = await reader.readexactly(length)
+                response = await self.resolve(message, client, tcp = True)
+                if response is None:
+                    break
+                #end if
+                writer.write( struct.pack("!H", len(response)) + response )
+                await writer.drain()
+            #end while True:
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+        #end finally
+    #end async def handle_tcp(self, reader, writer):
+    
+#end class Resolver:
+
+class ResolverProtocol(asyncio.DatagramProtocol):
+    """Answers UDP queries for a Resolver."""
+    
+    def __init__(self, resolver):
+        self.resolver = resolver
+        self.transport = None
+    #end def __init__(self, resolver):
+    
+    def connection_made(self, transport):
+        self.transport = transport
+    #end def connection_made(self, transport):
+    
+    def datagram_received(self, data, addr):
+        # Blocked domains are answered here and now, without a task.
+        response, question = self.resolver.answer_locally(data, addr[0])
+        if question is None:
+            if response is not None:
+                self.transport.sendto(response, addr)
+            #end if
+            return
+        #end if
+        key, question_end = question
+        asyncio.ensure_future( self.forward(data, key, question_end, addr) )
+    #end def datagram_received(self, data, addr):
+    
+    async def forward(self, data, key, question_end, addr):
+        response = await self.resolver.forward(data, key, question_end)
+        if response is not None:
+            # e.g. a reply fetched over TCP, from a persistent upstream connection.
+            if len(response) > udp_size and len(response) > udp_payload_size(data, question_end):
+                response = truncated_response(response, question_end)
+            #end if
+            self.transport.sendto(response, addr)
+        #end if
+    #end async def forward(self, data, key, question_end, addr):
+    
+    def error_received(self, exc):
+        pass
+    #end def error_received(self, exc):
+    
+#end class ResolverProtocol(asyncio.DatagramProtocol):
+
+def listen_sockets(addresses, port = 53, reuse_port = False):
+    """Bind a UDP socket and a listening TCP socket on each of our listening addresses, for serve.
+    
+    With reuse_port, each worker process binds its own, and the kernel shares
+    queries and connections out between them.
+    """
+    sockets = []
+    try:
+        for address in addresses:
+            family = socket.AF_INET6 if ":" in address else socket.AF_INET
+            for kind in (socket.SOCK_DGRAM, socket.SOCK_STREAM):
+                sock = socket.socket(family, kind)
+                sockets.append(sock)
+                if kind == socket.SOCK_STREAM:
+                    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                #end if
+                if reuse_port:
+                    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+                #end if
+                sock.bind( (address, port) )
+                if kind == socket.SOCK_STREAM:
+                    sock.listen(100)
+                #end if
+            #end for
+        #end for
+    except:
+        for sock in sockets:
+            sock.close()
+        #end for
+        raise
+    #end except
+    return sockets
+#end def listen_sockets(addresses, port = 53, reuse_port = False):
+
+async def serve(resolver, sockets):
+    """Start answering queries over UDP and TCP on sockets from listen_sockets.  Returns the transports and servers."""
+    loop = asyncio.get_event_loop()
+    listening = []
+    for sock in sockets:
+        if sock.type == socket.SOCK_DGRAM:
+            transport, protocol = await loop.create_datagram_endpoint( lambda: ResolverProtocol(resolver), sock = sock )
+            listening.append(transport)
+        else:
+            listening.append( await asyncio.start_server(resolver.handle_tcp, sock = sock) )
+        #end else
+    #end for
+    return listening
+#end async def serve(resolver, sockets):
+
+async def every(interval, function):
+    """Call function every interval seconds, forever."""
+    while True:
+        await asyncio.sleep(interval)
+        function()
+    #end while True:
+#end async def every(interval, function):
+
+########################
+###      Workers     ###
+########################
+
+class WorkerPool:
+    """Runs the resolver in several processes, so that it can use more than one core.
+    
+    Each worker answers from sockets of its own, bound with SO_REUSEPORT to
+    the same addresses and port as the others', so the kernel shares queries
+    out between them.  We keep every worker's sockets open, so that if one
+    dies, queries sent its way wait in its sockets until it is restarted.
+    
+    run(sockets) runs a worker until it is sent SIGTERM.  Workers start with
+    SIGHUP and SIGUSR1 ignored, so signals sent before they are ready for
+    them aren't fatal.
+    """
+    
+    def __init__(self, sockets, run):
+        # A list of sockets for each worker.
+        self.sockets = sockets
+        self.run = run
+        # Which worker each process is, by pid.
+        self.workers = {}
+        self.stopping = False
+        # When each worker last started, how long its last restart was put
+        # off for, and when to start any being put off now, by index.
+        self.started = {}
+        self.delays = {}
+        self.restarts = {}
+    #end def __init__(self, sockets, run):
+    
+    def start_worker(self, index):
+        sys.stdout.flush()
+        pid = os.fork()
+        if pid:
+            self.workers[pid] = index
+            self.started[index] = time.monotonic()
+            return
+        #end if
+        # In the worker.
+        status = 1
+        try:
+            for signum in (signal.SIGHUP, signal.SIGUSR1):
+                signal.signal(signum, signal.SIG_IGN)
+            #end for
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            for i, sockets in enumerate(self.sockets):
+                if i != index:
+                    for sock in sockets:
+                        sock.close()
+                    #end for
+                #end if
+            #end for
+            self.run(self.sockets[index])
+            status = 0
+        except KeyboardInterrupt:
+            status = 0
+        except:
+            traceback.print_exc()
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(status)
+        #end finally
+    #end def start_worker(self, index):
+    
+    def signal(self, signum):
+        """Send a signal to every worker."""
+        for pid in self.workers:
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+            #end except
+        #end for
+    #end def signal(self, signum):
+    
+    def reap(self):
+        """Notice workers that have exited, and start them again unless we are stopping.
+        
+        One that exited soon after starting is only started again once its
+        delay is up - see worker_stable.
+        """
+        now = time.monotonic()
+        while self.workers:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            if not pid:
+                break
+            #end if
+            index = self.workers.pop(pid, None)
+            if index is None or self.stopping:
+                continue
+            #end if
+            if now - self.started[index] < worker_stable:
+                delay = self.delays[index] = min( worker_restart_max, max(1, self.delays.get(index, 0) * 2) )
+            else:
+                delay = self.delays[index] = 0
+            #end else
+            if delay:
+                print("::: Worker {0} (pid {1}) exited with status {2}, restarting it in {3} second(s)".format(index, pid, status, delay) )
+            else:
+                print("::: Worker {0} (pid {1}) exited with status {2}, restarting it".format(index, pid, status) )
+            #end else
+            self.restarts[index] = now + delay
+        #end while
+        
+        if not self.stopping:
+            for index, when in list( self.restarts.items() ):
+                if when <= now:
+                    del self.restarts[index]
+                    self.start_worker(index)
+                #end if
+            #end for
+        #end if
+    #end def reap(self):
+    
+    def serve_forever(self, changed, interval = 1):
+        """Start the workers, and look after them until SIGTERM or SIGINT.
+        
+        Every interval seconds, changed() says whether the blocklist has
+        changed, and if so the workers are all sent SIGHUP to reload it
+        together.  SIGHUP and SIGUSR1 sent to us are passed on to the workers.
+        """
+        def stop(signum, frame):
+            raise SystemExit(0)
+        #end def stop(signum, frame):
+        signal.signal( signal.SIGHUP, lambda signum, frame: self.signal(signum) )
+        signal.signal( signal.SIGUSR1, lambda signum, frame: self.signal(signum) )
+        signal.signal(signal.SIGTERM, stop)
+        try:
+            for index in range( len(self.sockets) ):
+                self.start_worker(index)
+            #end for
+            while True:
+                time.sleep(interval)
+                self.reap()
+                if changed():
+                    self.signal(signal.SIGHUP)
+                #end if
+            #end while True:
+        except (KeyboardInterrupt, SystemExit):
+            pass
+        finally:
+            self.stop()
+        #end finally
+    #end def serve_forever(self, changed, interval = 1):
+    
+    def stop(self):
+        """Stop the workers, and wait for them to finish."""
+        self.stopping = True
+        self.signal(signal.SIGTERM)
+        while self.workers:
+            try:
+                pid, status = os.waitpid(-1, 0)
+            except ChildProcessError:
+                break
+            except KeyboardInterrupt:
+                continue
+            #end except
+            self.workers.pop(pid, None)
+        #end while
+    #end def stop(self):
+    
+#end class WorkerPool:
@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+
+# pyhole - a clone of the Pi-hole DNS adblocker, written in Python.
+# pyhole  (c) 2016 by ryt51V
+# Pi-Hole (c) 2015, 2016 by Jacob Salmela
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Fixed size summaries of the domains and clients in the query log, so that
+# the memory pyhole-querylog uses doesn't grow with the number of different
+# domains it sees.  Both kinds can be merged, e.g. to cover several days.
+#
+# TopK keeps the most common keys and roughly how often each was seen.
+# HyperLogLog estimates how many different keys were seen.
+
+########################
+###      Imports     ###
+########################
+
+# For hashing keys for HyperLogLog.
+import hashlib
+# For saving HyperLogLog registers as text.
+import binascii
+# For the HyperLogLog small range correction.
+import math
+
+########################
+###       TopK       ###
+########################
+
+class TopK:
+    """The most common keys in a stream, with counts that are at most a known amount too low.
+    
+    This is the Misra-Gries summary (the counting dual of Space-Saving), in
+    the batched, mergeable form of Agarwal et al, "Mergeable Summaries" (2012).
+    Keys are counted exactly until there are more than 2 * capacity of them.
+    Then the (capacity + 1)th largest count is taken off every count, and any
+    left at zero or less are dropped, so that at most capacity keys remain.
+    
+    Each count is then too low by at most error, and error is at most
+    total / (capacity + 1), where total is the number of keys added.  So any
+    key seen more than total / (capacity + 1) times is still here.
+    """
+    
+    def __init__(self, capacity = 1000):
+        self.capacity = capacity
+        # The counts, keyed by key.  Callers may add 1 to a key that is
+        # already here directly, to save a method call - see QueryStats.
+        self.counts = {}
+        # How many keys have been added, and how much any count may be too low by.
+        self.total = 0
+        self.error = 0
+    #end def __init__(self, capacity = 1000):
+    
+    def add(self, key, count = 1):
+        counts = self.counts
+        counts[key] = counts.get(key, 0) + count
+        self.total += count
+        if len(counts) > 2 * self.capacity:
+            self.shrink()
+        #end if
+    #end def add(self, key, count = 1):
+    
+    def shrink(self):
+        """Take the (capacity + 1)th largest count off every count, keeping those left above zero."""
+        counts = self.counts
+        if len(counts) <= self.capacity: return
+        cut = sorted(counts.values(), reverse = True)[self.capacity]
+        self.counts = { key : count - cut for key, count in counts.items() if count > cut }
+        self.error += cut
+    #end def shrink(self):
+    
+    def merge(self, other):
+        """Add another TopK's keys to ours.  The error bound still holds, for the combined total."""
+        counts = self.counts
+        for key, count in other.counts.items():
+            counts[key] = counts.get(key, 0) + count
+        #end for
+        self.total += other.total
+        self.error += other.error
+        self.shrink()
+    #end def merge(self, other):
+    
+    def most_common(self, n = None):
+        """Return the top n (key, count) pairs, most common first."""
+        top = sorted(self.counts.items(), key = lambda item: (-item[1], item[0]))
+        return top if n is None else top[:n]
+    #end def most_common(self, n = None):
+    
+    def clear(self):
+        self.counts = {}
+        self.total = 0
+        self.error = 0
+    #end def clear(self):
+    
+    def to_state(self):
+        """Return ourselves as a dict, for JSON and from_state.  Keys must be bytes."""
+        return {
+            'capacity' : self.capacity,
+            'total'    : self.total,
+            'error'    : self.error,
+            'counts'   : { key.decode('utf-8', 'replace') : count for key, count in self.counts.items() },
+        }
+    #end def to_state(self):
+    
+    @classmethod
+    def from_state(cls, state, capacity = None):
+        """Make a TopK from to_state's dict (or None for an empty one), with a new capacity if given."""
+        topk = cls(capacity or (state or {}).get('capacity', 1000))
+        if state:
+            topk.counts = { key.encode() : count for key, count in state.get('counts', {}).items() }
+            topk.total = state.get('total', 0)
+            topk.error = state.get('error', 0)
+            topk.shrink()
+        #end if
+        return topk
+    #end def from_state(cls, state, capacity = None):
+    
+#end class TopK:
+
+########################
+###    HyperLogLog   ###
+########################
+
+class HyperLogLog:
+    """An estimate of how many different keys have been added.
+    
+    This is HyperLogLog (Flajolet et al, 2007), with linear counting for small
+    numbers of keys, on a 64 bit hash.  It uses 2 ** precision registers of a
+    byte each, and its standard error is 1.04 / sqrt(2 ** precision), i.e.
+    1.6% with the default precision of 12 (4 KB).
+    
+    Keys are hashed with MD5 rather than hash(), so that estimates saved by
+    one process can be merged with another's.
+    """
+    
+    def __init__(self, precision = 12):
+        self.precision = precision
+        self.registers = bytearray(1 << precision)
+    #end def __init__(self, precision = 12):
+    
+    def add(self, key):
+        h = int.from_bytes(hashlib.md5(key).digest()[:8], 'big')
+        bits = 64 - self.precision
+        index = h >> bits
+        # The position of the first 1 bit in the rest of the hash.
+        rank = bits - (h & ((1 << bits) - 1)).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+        #end if
+    #end def add(self, key):
+    
+    def merge(self, other):
+        """Add another HyperLogLog's keys to ours.  Both must have the same precision."""
+        if other.precision != self.precision:
+            raise ValueError("cannot merge HyperLogLogs of precision {0} and {1}".format(self.precision, other.precision))
+        #end if
+        self.registers = bytearray( map(max, self.registers, other.registers) )
+    #end def merge(self, other):
+    
+    def estimate(self):
+        """Return roughly how many different keys have been added."""
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum( 2.0 ** -r for r in self.registers )
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * math.log(m / zeros)
+        #end if
+        return int(round(estimate))
+    #end def estimate(self):
+    
+    def clear(self):
+        self.registers = bytearray(len(self.registers))
+    #end def clear(self):
+    
+    def to_state(self):
+        """Return ourselves as a dict, for JSON and from_state."""
+        return { 'precision' : self.precision, 'registers' : binascii.hexlify(self.registers).decode() }
+    #end def to_state(self):
+    
+    @classmethod
+    def from_state(cls, state, precision = 12):
+        """Make a HyperLogLog from to_state's dict, or None for an empty one."""
+        if not state:
+            return cls(precision)
+        #end if
+        hll = cls(state['precision'])
+        hll.registers = bytearray( binascii.unhexlify(state['registers']) )
+        return hll
+    #end def from_state(cls, state, precision = 12):
+    
+#end class HyperLogLog:
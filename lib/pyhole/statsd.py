@@ -0,0 +1,275 @@
+#!/usr/bin/env python3
+
+# pyhole - a clone of the Pi-hole DNS adblocker, written in Python.
+# pyhole  (c) 2016 by ryt51V
+# Pi-Hole (c) 2015, 2016 by Jacob Salmela
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# A small HTTP server for the admin pages' statistics, used by pyhole-statsd.
+#
+# It answers the same requests as api.php (e.g. "/api.php?summary&topItems"),
+# with the same JSON, but from running totals kept in memory and brought up
+# to date every few seconds, rather than by reading the whole log each time.
+# Responses have an ETag, so polling for statistics that haven't changed
+# costs a 304 with no body.
+
+########################
+###      Imports     ###
+########################
+
+# For the server itself.
+import asyncio
+# For parsing query strings.
+import urllib.parse
+# For the responses.
+import json
+import collections
+# For formatting the times of recent queries.
+import time
+# For ETags.
+import hashlib
+# For the errors updating the statistics database may raise.
+import sqlite3
+
+########################
+###     Variables    ###
+########################
+
+# The paths we answer on.  Anything else is a 404.
+api_paths = ('/', '/api.php', '/admin/api.php')
+
+# The most each request line and header may be.
+line_limit = 8192
+
+status_reasons = {
+    200 : "OK",
+    304 : "Not Modified",
+    400 : "Bad Request",
+    404 : "Not Found",
+    405 : "Method Not Allowed",
+}
+
+########################
+###     Responses    ###
+########################
+
+def number_format(number, decimals = 0):
+    """Format a number as PHP's number_format does by default, e.g. "1,234"."""
+    return "{0:,.{1}f}".format(number, decimals)
+#end def number_format(number, decimals = 0):
+
+def api_data(summary, query):
+    """Return what api.php would, for a query string parsed by parse_qs, from querylog.QueryStats.summary."""
+    data = collections.OrderedDict()
+    
+    if 'summaryRaw' in query:
+        data.update( summary['summary'] )
+    #end if
+    
+    if 'summary' in query or not query:
+        raw = summary['summary']
+        data.update( [
+            ('domains_being_blocked', number_format( raw['domains_being_blocked'] )),
+            ('dns_queries_today'    , number_format( raw['dns_queries_today'] )),
+            ('ads_blocked_today'    , number_format( raw['ads_blocked_today'] )),
+            ('ads_percentage_today' , number_format( raw['ads_percentage_today'], 1 ).replace(",", "")),
+        ] )
+    #end if
+    
+    if 'overTimeData' in query:
+        data.update( summary['over_time'] )
+    #end if
+    
+    if 'topItems' in query:
+        data.update( summary['top_items'] )
+    #end if
+    
+    if 'recentItems' in query and query['recentItems'][0].isdigit():
+        data['recent_queries'] = [
+            collections.OrderedDict( [ ('time', time.strftime("%I:%M:%S %p", time.localtime(when)).lower()), ('domain', domain), ('ip', client) ] )
+            for when, domain, client in summary['recent_queries'][ : int(query['recentItems'][0]) ]
+        ]
+    #end if
+    
+    if 'getQueryTypes' in query:
+        data.update( summary['query_types'] )
+    #end if
+    
+    if 'getForwardDestinations' in query:
+        data.update( summary['forward_destinations'] )
+    #end if
+    
+    if 'getQuerySources' in query:
+        data.update( summary['query_sources'] )
+    #end if
+    
+    return data
+#end def api_data(summary, query):
+
+########################
+###      Server      ###
+########################
+
+class StatsServer:
+    """Serves api_data for a pyhole.querylog_follower, calling its update every interval seconds.
+    
+    Updates run in another thread, so that a long one (reading a busy log
+    after it has been rotated, say) doesn't hold up requests.  Requests are
+    answered from the follower's summary as of the last update to finish, and
+    the follower itself is only touched in between updates.
+    """
+    
+    def __init__(self, follower, interval = 2):
+        self.follower = follower
+        self.interval = interval
+        # The follower's summary, and (ETag, body) for each query string,
+        # for follower generation cache_generation.
+        self.summary = None
+        self.cache = {}
+        self.cache_generation = None
+        self.refresh()
+        # Counters, for the curious.
+        self.requests = 0
+        self.not_modified = 0
+    #end def __init__(self, follower, interval = 2):
+    
+    def refresh(self):
+        """Take the follower's summary, if it has changed.  Must not be called during an update."""
+        if self.cache_generation != self.follower.generation:
+            self.summary = self.follower.summary()
+            self.cache.clear()
+            self.cache_generation = self.follower.generation
+        #end if
+    #end def refresh(self):
+    
+    async def follow(self):
+        """Keep our follower up to date, forever.
+        
+        A failed update, whether reading the log or writing the statistics
+        database, is reported and tried again next time round.
+        """
+        loop = asyncio.get_event_loop()
+        while True:
+            try:
+                await loop.run_in_executor(None, self.follower.update)
+            except (OSError, sqlite3.Error, ValueError) as e:
+                print("::: Unable to update the query statistics: {0}".format(e) )
+            #end except
+            self.refresh()
+            await asyncio.sleep(self.interval)
+        #end while True:
+    #end async def follow(self):
+    
+    def response(self, query_string):
+        """Return the ETag and body of the response to an api.php query string."""
+        try:
+            return self.cache[query_string]
+        except KeyError:
+            pass
+        #end except
+        
+        query = urllib.parse.parse_qs(query_string, keep_blank_values = True)
+        body = json.dumps( api_data(self.summary, query), separators = (',', ':') ).encode()
+        etag = '"' + hashlib.md5(body).hexdigest()[:16] + '"'
+        if len(self.cache) > 256: self.cache.clear()
+        self.cache[query_string] = (etag, body)
+        return etag, body
+    #end def response(self, query_string):
+    
+    def respond(self, method, target, headers):
+        """Return the status, headers and body of the response to a request."""
+        path, _, query_string = target.partition('?')
+        if method not in ("GET", "HEAD"):
+            return 405, [ ("Allow", "GET, HEAD") ], b""
+        #end if
+        if path not in api_paths:
+            return 404, [], b""
+        #end if
+        
+        self.requests += 1
+        etag, body = self.response(query_string)
+        response_headers = [ ("Content-Type", "application/json"), ("ETag", etag), ("Cache-Control", "no-cache") ]
+        if etag in [ tag.strip() for tag in headers.get('if-none-match', '').split(",") ]:
+            self.not_modified += 1
+            return 304, response_headers, b""
+        #end if
+        return 200, response_headers, body
+    #end def respond(self, method, target, headers):
+    
+    async def handle(self, reader, writer):
+        """Answer the requests on a connection, until the client is done with it."""
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                #end if
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    #end if
+                    if len(headers) > 100:
+                        raise ValueError("too many headers")
+                    #end if
+                    name, _, value = line.decode('latin-1').partition(":")
+                    headers[ name.strip().lower() ] = value.strip()
+                #end while True:
+                
+                fields = request_line.decode('latin-1').split()
+                if len(fields) != 3 or not fields[2].startswith("HTTP/"):
+                    method = None
+                    status, response_headers, body = 400, [], b""
+                    keep_alive = False
+                else:
+                    method, target, version = fields
+                    status, response_headers, body = self.respond(method, target, headers)
+                    connection = headers.get('connection', '').lower()
+                    keep_alive = connection == 'keep-alive' if version == "HTTP/1.0" else connection != 'close'
+                #end else
+                
+                head = [ "HTTP/1.1 {0} {1}".format(status, status_reasons[status]) ]
+                head += [ "{0}: {1}".format(name, value) for name, value in response_headers ]
+                head.append( "Content-Length: {0}".format( len(body) ) )
+                head.append( "Connection: " + ("keep-alive" if keep_alive else "close") )
+                writer.write( ("\r\n".join(head) + "\r\n\r\n").encode('latin-1') )
+                if method != "HEAD":
+                    writer.write(body)
+                #end if
+                await writer.drain()
+                if not keep_alive:
+                    break
+                #end if
+            #end while True:
+        except (ConnectionError, ValueError, asyncio.IncompleteReadError):
+            # Including lines longer than line_limit.
+            pass
+        finally:
+            writer.close()
+        #end finally
+    #end async def handle(self, reader, writer):
+    
+    def start(self, loop, host = None, port = None, socket_path = None):
+        """Start serving on a TCP host and port, or a unix socket, and following the log.  Returns the server."""
+        if socket_path:
+            server = loop.run_until_complete( asyncio.start_unix_server(self.handle, socket_path, limit = line_limit) )
+        else:
+            server = loop.run_until_complete( asyncio.start_server(self.handle, host, port, limit = line_limit) )
+        #end else
+        loop.create_task( self.follow() )
+        return server
+    #end def start(self, loop, host = None, port = None, socket_path = None):
+    
+#end class StatsServer:
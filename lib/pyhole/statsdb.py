@@ -0,0 +1,329 @@
+#!/usr/bin/env python3
+
+# pyhole - a clone of the Pi-hole DNS adblocker, written in Python.
+# pyhole  (c) 2016 by ryt51V
+# Pi-Hole (c) 2015, 2016 by Jacob Salmela
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Keeps the query statistics from the dnsmasq log for longer than the log
+# itself is kept, in an SQLite database, so that pyhole-stats can answer
+# questions such as "which domains were blocked most in the last 30 days"
+# without going back to the logs.
+#
+# StatsStore adds up the records from querylog.LogParser into rollup tables
+# by minute, hour and day, and writes them in one transaction at a time.
+# Each rollup is only kept for so many days - see StatsStore.prune.
+
+########################
+###      Imports     ###
+########################
+
+# For the database.
+import sqlite3
+# For picking out the top domains and clients.
+import heapq
+# For working out the hour and day each query is in.
+import time
+# For opening the database read-only.
+import os
+import urllib.parse
+
+# For the kinds of record we are given.
+from pyhole import querylog
+
+########################
+###     Variables    ###
+########################
+
+# How many days each rollup is kept for by default.
+keep_defaults = { 'minute' : 2, 'hour' : 14, 'day' : 400 }
+
+# Once this many rows are waiting to be written, add_records writes them.
+pending_limit = 100000
+
+# How many domains or clients StatsStore.top adds up one at a time before it
+# gives up on stopping early, and adds up every row instead.
+top_candidates = 1000
+
+# totals_<period>  - queries and blocked queries in each minute, hour and day.
+# domains_<period> - for each domain, in each hour and day.
+# clients_<period> - for each client, in each hour and day.  Blocked queries
+#                    are only counted against a client if we saw it ask.
+# Times are when each minute, hour or (local) day starts.
+#
+# Each domains and clients table has an index by name, which holds the counts
+# too, so that adding up a name's rows doesn't touch the table, and indexes
+# by time and queries and by time and blocked, for StatsStore.top.  The
+# indexes by name that didn't hold the counts are replaced.
+schema = """
+CREATE TABLE IF NOT EXISTS totals_minute (time INTEGER PRIMARY KEY, queries INTEGER NOT NULL, blocked INTEGER NOT NULL);
+CREATE TABLE IF NOT EXISTS totals_hour   (time INTEGER PRIMARY KEY, queries INTEGER NOT NULL, blocked INTEGER NOT NULL);
+CREATE TABLE IF NOT EXISTS totals_day    (time INTEGER PRIMARY KEY, queries INTEGER NOT NULL, blocked INTEGER NOT NULL);
+CREATE TABLE IF NOT EXISTS domains_hour  (time INTEGER NOT NULL, domain TEXT NOT NULL, queries INTEGER NOT NULL, blocked INTEGER NOT NULL, PRIMARY KEY (time, domain));
+CREATE TABLE IF NOT EXISTS domains_day   (time INTEGER NOT NULL, domain TEXT NOT NULL, queries INTEGER NOT NULL, blocked INTEGER NOT NULL, PRIMARY KEY (time, domain));
+CREATE TABLE IF NOT EXISTS clients_hour  (time INTEGER NOT NULL, client TEXT NOT NULL, queries INTEGER NOT NULL, blocked INTEGER NOT NULL, PRIMARY KEY (time, client));
+CREATE TABLE IF NOT EXISTS clients_day   (time INTEGER NOT NULL, client TEXT NOT NULL, queries INTEGER NOT NULL, blocked INTEGER NOT NULL, PRIMARY KEY (time, client));
+DROP INDEX IF EXISTS domains_hour_domain;
+DROP INDEX IF EXISTS domains_day_domain;
+DROP INDEX IF EXISTS clients_hour_client;
+DROP INDEX IF EXISTS clients_day_client;
+CREATE INDEX IF NOT EXISTS domains_hour_name    ON domains_hour (domain, time, queries, blocked);
+CREATE INDEX IF NOT EXISTS domains_day_name     ON domains_day  (domain, time, queries, blocked);
+CREATE INDEX IF NOT EXISTS clients_hour_name    ON clients_hour (client, time, queries, blocked);
+CREATE INDEX IF NOT EXISTS clients_day_name     ON clients_day  (client, time, queries, blocked);
+CREATE INDEX IF NOT EXISTS domains_hour_queries ON domains_hour (time, queries);
+CREATE INDEX IF NOT EXISTS domains_day_queries  ON domains_day  (time, queries);
+CREATE INDEX IF NOT EXISTS clients_hour_queries ON clients_hour (time, queries);
+CREATE INDEX IF NOT EXISTS clients_day_queries  ON clients_day  (time, queries);
+CREATE INDEX IF NOT EXISTS domains_hour_blocked ON domains_hour (time, blocked);
+CREATE INDEX IF NOT EXISTS domains_day_blocked  ON domains_day  (time, blocked);
+CREATE INDEX IF NOT EXISTS clients_hour_blocked ON clients_hour (time, blocked);
+CREATE INDEX IF NOT EXISTS clients_day_blocked  ON clients_day  (time, blocked);
+"""
+
+# The tables each rollup period has.
+period_tables = {
+    'minute' : ('totals_minute',),
+    'hour'   : ('totals_hour', 'domains_hour', 'clients_hour'),
+    'day'    : ('totals_day' , 'domains_day' , 'clients_day' ),
+}
+
+########################
+###      Helpers     ###
+########################
+
+def hour_start(when):
+    """Return when the (local) hour of a time starts."""
+    t = time.localtime(when)
+    return when - when % 60 - t.tm_min * 60
+#end def hour_start(when):
+
+def day_start(when):
+    """Return when the (local) day of a time starts."""
+    t = time.localtime(when)
+    return int( time.mktime( (t.tm_year, t.tm_mon, t.tm_mday, 0, 0, 0, 0, 0, -1) ) )
+#end def day_start(when):
+
+########################
+###    StatsStore    ###
+########################
+
+class StatsStore:
+    """The query statistics database.
+    
+    keep is how many days to keep each rollup for, keyed by 'minute', 'hour'
+    and 'day'.  Any left out use keep_defaults.
+    
+    With read_only, the database is opened read-only, and left as it is, so
+    that anyone who can read it can use it, as with pyhole-stats.  It must
+    already exist.
+    """
+    
+    def __init__(self, filename, keep = None, read_only = False):
+        self.filename = filename
+        self.keep = dict(keep_defaults)
+        self.keep.update(keep or {})
+        if read_only:
+            uri = "file:{0}?mode=ro".format( urllib.parse.quote( os.path.abspath(filename) ) )
+            self.db = sqlite3.connect(uri, uri = True)
+            try:
+                self.db.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()
+            except sqlite3.OperationalError:
+                # A write-ahead log needs its shared memory file, which we
+                # can't create without write access to the directory.  The
+                # file only goes missing when nothing has the database open,
+                # so nothing was writing to it when we looked.
+                self.db.close()
+                self.db = sqlite3.connect(uri + "&immutable=1", uri = True)
+            #end except
+        else:
+            # pyhole-statsd updates from another thread than the one that
+            # opened us, though only ever one at a time.
+            self.db = sqlite3.connect(filename, check_same_thread = False)
+            # We write a batch at a time, while pyhole-stats and the admin pages
+            # may be reading.
+            self.db.execute("PRAGMA journal_mode = WAL")
+            self.db.execute("PRAGMA synchronous = NORMAL")
+            self.db.executescript(schema)
+        #end else
+        # Rows waiting to be written, as [queries, blocked], keyed by table
+        # then by time or (time, name).
+        self.pending = { table : {} for tables in period_tables.values() for table in tables }
+        self.pending_rows = 0
+        # The hour and day each minute is in.
+        self.starts = {}
+    #end def __init__(self, filename, keep = None, read_only = False):
+    
+    def __enter__(self):
+        return self
+    #end def __enter__(self):
+    
+    def __exit__(self, *exc):
+        self.close()
+    #end def __exit__(self, *exc):
+    
+    def close(self):
+        self.db.close()
+    #end def close(self):
+    
+    def add_records(self, records):
+        """Add the records from querylog.LogParser.parse, writing them if enough are waiting."""
+        pending = self.pending
+        starts = self.starts
+        totals_minute, totals_hour, totals_day = pending['totals_minute'], pending['totals_hour'], pending['totals_day']
+        domains_hour, domains_day = pending['domains_hour'], pending['domains_day']
+        clients_hour, clients_day = pending['clients_hour'], pending['clients_day']
+        
+        for kind, when, domain, client, qtype in records:
+            if kind == querylog.record_forwarded: continue
+            blocked = kind == querylog.record_blocked
+            
+            minute = when - when % 60
+            try:
+                hour, day = starts[minute]
+            except KeyError:
+                if len(starts) > 1440: starts.clear()
+                hour, day = starts[minute] = ( hour_start(minute), day_start(minute) )
+            #end except
+            
+            keys = ( (totals_minute, minute), (totals_hour, hour), (totals_day, day),
+                     (domains_hour, (hour, domain)), (domains_day, (day, domain)) )
+            if client:
+                keys += ( (clients_hour, (hour, client)), (clients_day, (day, client)) )
+            #end if
+            for rows, key in keys:
+                counts = rows.get(key)
+                if counts is None:
+                    counts = rows[key] = [0, 0]
+                    self.pending_rows += 1
+                #end if
+                counts[blocked] += 1
+            #end for
+        #end for kind, when, domain, client, qtype in records:
+        
+        if self.pending_rows >= pending_limit:
+            self.commit()
+        #end if
+    #end def add_records(self, records):
+    
+    def commit(self):
+        """Write any rows waiting to be written, and throw away anything older than we keep, in one transaction."""
+        with self.db:
+            for table, rows in self.pending.items():
+                if not rows: continue
+                if table.startswith('totals_'):
+                    self.db.executemany("INSERT OR IGNORE INTO {0} VALUES (?, 0, 0)".format(table),
+                                        ( (key,) for key in rows ) )
+                    self.db.executemany("UPDATE {0} SET queries = queries + ?, blocked = blocked + ? WHERE time = ?".format(table),
+                                        ( (queries, blocked, key) for key, (queries, blocked) in rows.items() ) )
+                else:
+                    column = 'domain' if table.startswith('domains_') else 'client'
+                    rows = [ (start, name.decode('utf-8', 'replace'), counts) for (start, name), counts in rows.items() ]
+                    self.db.executemany("INSERT OR IGNORE INTO {0} VALUES (?, ?, 0, 0)".format(table),
+                                        ( (start, name) for start, name, counts in rows ) )
+                    self.db.executemany("UPDATE {0} SET queries = queries + ?, blocked = blocked + ? WHERE time = ? AND {1} = ?".format(table, column),
+                                        ( (queries, blocked, start, name) for start, name, (queries, blocked) in rows ) )
+                #end else
+            #end for table, rows in self.pending.items():
+            self.prune()
+        #end with self.db:
+        
+        for rows in self.pending.values():
+            rows.clear()
+        #end for
+        self.pending_rows = 0
+    #end def commit(self):
+    
+    def prune(self, now = None):
+        """Throw away each rollup's rows from before the days it is kept for."""
+        if now is None: now = time.time()
+        for period, tables in period_tables.items():
+            oldest = day_start(now) - self.keep[period] * 86400
+            for table in tables:
+                self.db.execute("DELETE FROM {0} WHERE time < ?".format(table), (oldest,))
+            #end for
+        #end for
+    #end def prune(self, now = None):
+    
+    def totals(self, period, since = 0):
+        """Return (time, queries, blocked) for each minute, hour or day since a time, oldest first."""
+        return self.db.execute("SELECT time, queries, blocked FROM totals_{0} WHERE time >= ? ORDER BY time".format(period),
+                               (since,) ).fetchall()
+    #end def totals(self, period, since = 0):
+    
+    def top(self, what, period, since = 0, blocked = False, limit = 10):
+        """Return the top (name, queries, blocked) of 'domains' or 'clients' since a time, by queries or by blocked queries.
+        
+        period is which rollup to add up, 'hour' or 'day'.
+        
+        Rather than adding up every row since the time, we read each hour or
+        day's rows busiest first, adding up each name we come across, and
+        stop once no name further down any of them could make the top - the
+        "threshold algorithm".  As a few domains and clients make most
+        queries, that is usually after a few hundred names.  If it isn't
+        after top_candidates, we add up every row after all.
+        """
+        column = 'domain' if what == 'domains' else 'client'
+        order = 'blocked' if blocked else 'queries'
+        table = "{0}_{1}".format(what, period)
+        by_order = "SELECT {1}, {2} FROM {0} WHERE time = ? AND {2} > 0 ORDER BY {2} DESC".format(table, column, order)
+        by_name = "SELECT SUM(queries), SUM(blocked) FROM {0} WHERE {1} = ? AND time >= ?".format(table, column)
+        
+        starts = [ start for start, in self.db.execute("SELECT time FROM totals_{0} WHERE time >= ?".format(period), (since,) ) ]
+        # For each hour or day still being read, its rows and the count of the last one read.
+        lists = [ [ self.db.execute(by_order, (start,)), 0 ] for start in starts ]
+        totals = {}
+        index = 1 if blocked else 0
+        while lists:
+            for rows in list(lists):
+                row = rows[0].fetchone()
+                if row is None:
+                    lists.remove(rows)
+                    continue
+                #end if
+                name, rows[1] = row
+                if name not in totals:
+                    totals[name] = self.db.execute(by_name, (name, since) ).fetchone()
+                #end if
+            #end for
+            if len(totals) > top_candidates:
+                return self.top_by_adding_up(what, period, since, blocked, limit)
+            #end if
+            # A name we haven't seen is no busier than the last rows read.
+            if len(totals) >= limit and heapq.nlargest( limit, (counts[index] for counts in totals.values()) )[-1] > sum( rows[1] for rows in lists ):
+                break
+            #end if
+        #end while lists:
+        
+        return sorted( ( (name, queries, blocked) for name, (queries, blocked) in totals.items() ),
+                       key = lambda row: (-row[1 + index], row[0]) )[:limit]
+    #end def top(self, what, period, since = 0, blocked = False, limit = 10):
+    
+    def top_by_adding_up(self, what, period, since = 0, blocked = False, limit = 10):
+        """Return the same as top, by adding up every row since the time."""
+        column = 'domain' if what == 'domains' else 'client'
+        order = 'blocked' if blocked else 'queries'
+        return self.db.execute("SELECT {1}, SUM(queries), SUM(blocked) FROM {0}_{2} WHERE time >= ? "
+                               "GROUP BY {1} HAVING SUM({3}) > 0 ORDER BY SUM({3}) DESC, {1} LIMIT ?".format(what, column, period, order),
+                               (since, limit) ).fetchall()
+    #end def top_by_adding_up(self, what, period, since = 0, blocked = False, limit = 10):
+    
+    def history(self, what, name, period, since = 0):
+        """Return (time, queries, blocked) for a domain or client in each hour or day since a time, oldest first."""
+        column = 'domain' if what == 'domains' else 'client'
+        return self.db.execute("SELECT time, queries, blocked FROM {0}_{2} WHERE {1} = ? AND time >= ? ORDER BY time".format(what, column, period),
+                               (name, since) ).fetchall()
+    #end def history(self, what, name, period, since = 0):
+    
+#end class StatsStore:
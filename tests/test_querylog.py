@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+
+# pyhole - a clone of the Pi-hole DNS adblocker, written in Python.
+# pyhole  (c) 2016 by ryt51V
+# Pi-Hole (c) 2015, 2016 by Jacob Salmela
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Tests for querylog.LogTailer.
+#
+# Usage: python3 -m unittest discover tests
+
+# For our paths.
+import os
+import sys
+# For the tests themselves.
+import unittest
+# For temporary logs.
+import tempfile
+
+sys.path.insert( 0, os.path.join( os.path.dirname( os.path.abspath(__file__) ), "..", "lib" ) )
+
+from pyhole import querylog
+
+class LogTailerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.directory.name, "pyhole.log")
+        self.block_size = querylog.log_block_size
+    #end def setUp(self):
+
+    def tearDown(self):
+        querylog.log_block_size = self.block_size
+        self.directory.cleanup()
+    #end def tearDown(self):
+
+    def read(self, tailer):
+        return [ line for lines in tailer.read_lines() if lines is not None for line in lines ]
+    #end def read(self, tailer):
+
+    def test_multi_block_log_is_read_once(self):
+        # Lines longer than a block, so that every read carries a partial line over.
+        querylog.log_block_size = 10
+        lines = [ "line {0:02d} of the log".format(i).encode() for i in range(20) ]
+        with open(self.filename, 'wb') as f:
+            f.write( b"".join( line + b"\n" for line in lines ) )
+        #end with
+
+        tailer = querylog.LogTailer(self.filename)
+        self.assertEqual( self.read(tailer), lines )
+        self.assertEqual( tailer.offset, os.path.getsize(self.filename) )
+        self.assertEqual( self.read(tailer), [] )
+    #end def test_multi_block_log_is_read_once(self):
+
+    def test_partial_line_is_read_once_finished(self):
+        querylog.log_block_size = 10
+        with open(self.filename, 'wb') as f:
+            f.write(b"first line of the log\nsecond li")
+        #end with
+
+        tailer = querylog.LogTailer(self.filename)
+        self.assertEqual( self.read(tailer), [ b"first line of the log" ] )
+        with open(self.filename, 'ab') as f:
+            f.write(b"ne of the log\n")
+        #end with
+        self.assertEqual( self.read(tailer), [ b"second line of the log" ] )
+        self.assertEqual( self.read(tailer), [] )
+    #end def test_partial_line_is_read_once_finished(self):
+
+#end class LogTailerTest(unittest.TestCase):
+
+if __name__ == "__main__":
+    unittest.main()
+#end if